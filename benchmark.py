@@ -0,0 +1,284 @@
+"""llm_report_tool のオーバーヘッドを模擬サーバー (mock_openrouter.py) に対して計測するベンチマーク
+
+APIの利用枠を使わずに、ペイロード構築から送受信までのスループット、添付ファイルのエンコード時の
+メモリ使用量、長い出力を画面に反映するコストを計測し、結果をJSONで保存する。
+
+    python benchmark.py                          # bench_results/ にレポートを保存
+    python benchmark.py --compare bench_results/old.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import llm_report_tool as tool
+import report_generation
+import report_materials
+import report_metrics
+import report_transport
+
+SCENARIOS = ("transport", "attachments", "ui_dispatch")
+BASE_DIR = Path(__file__).resolve().parent
+HIGHER_IS_BETTER = ("per_second",) # 比較時、名前がこれで終わる指標は大きいほど良い
+CONDITION_KEYS = {"requests", "concurrency", "file_bytes", "bytes_sent", "deltas", "frame_batch", "chars"}
+
+class MockServerProcess:
+    """mock_openrouter.py を別プロセスで起動する (計測対象のメモリ・GILに影響させないため)"""
+
+    def __init__(self, *args):
+        self.process = subprocess.Popen([sys.executable, str(BASE_DIR / "mock_openrouter.py"), "--port", "0", *args],
+                                        stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline().strip()
+        if not line.startswith("listening on "):
+            self.process.kill()
+            raise RuntimeError(f"模擬サーバーを起動できませんでした: {line!r}")
+        self.url = line[len("listening on "):]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+def _percentile(values, percent):
+    return report_metrics._percentile(values, percent)
+
+def _configure_tool():
+    """ベンチマーク用に設定を初期化する (キャッシュ・ログ・画像変換は計測対象外)"""
+    config = {
+        "http": {"max_retries": 0},
+        "cache": {"enabled": False},
+        "image_preprocess": {"enabled": False},
+        "metrics": {"enabled": False},
+        "token_budget": {"policy": "none"},
+        "length_control": {"enabled": False},
+        "rate_limit": {"enabled": False}, # 手元での送信待ちを計測に含めない (":free" のモデル名でも 20回/分 に絞らない)
+        "providers": {}                   # すべて OPENROUTER_API_URL (模擬サーバー) に送る
+    }
+    tool.configure_all(config)
+
+def bench_transport(requests_count, concurrency, material_chars=20000):
+    """テキスト資料付きのリクエストを繰り返し送り、スループットと1件あたりの時間を計測する"""
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="ベンチマーク", material_type="テキスト資料",
+                    text_material="資料の本文です。" * (material_chars // 8))
+    results = {}
+    for stream in (False, True):
+        latencies = []
+        cpu_start = time.process_time()
+
+        def _one(index):
+            started = time.perf_counter()
+            payload = report_materials.build_api_payload(settings)
+            payload["model"] = "mock/model"
+            report_generation.request_completion("mock-key", payload, stream=stream, use_cache=False)
+            return time.perf_counter() - started
+
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(_one, range(requests_count)))
+        wall = time.perf_counter() - wall_start
+        results["stream" if stream else "non_stream"] = {
+            "requests": requests_count,
+            "concurrency": concurrency,
+            "requests_per_second": requests_count / wall,
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p95": _percentile(latencies, 95),
+            "client_cpu_per_request": (time.process_time() - cpu_start) / requests_count
+        }
+    return results
+
+def _write_random_file(path, size_mb):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+def bench_attachments(sizes_mb):
+    """サイズごとのPDF添付 (native エンジン) を送信し、所要時間とPython側のピークメモリを計測する"""
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size_mb in sizes_mb:
+            path = Path(temp_dir) / f"attachment_{size_mb}mb.pdf"
+            _write_random_file(path, size_mb)
+            settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="ベンチマーク", material_type="PDF",
+                            material_path=str(path), pdf_engine="native")
+            tracemalloc.start()
+            started = time.perf_counter()
+            payload = report_materials.build_api_payload(settings)
+            payload["model"] = "mock/model"
+            metrics = report_metrics.RequestMetrics("benchmark", "mock/model")
+            report_generation.request_completion("mock-key", payload, use_cache=False, metrics=metrics)
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f"{size_mb}mb"] = {
+                "file_bytes": size_mb * 1024 * 1024,
+                "bytes_sent": metrics.bytes_sent,
+                "seconds": elapsed,
+                "mb_per_second": size_mb / elapsed,
+                "encode_seconds": metrics.spans.get("encode", 0.0),
+                "peak_traced_bytes": peak,
+                "peak_to_file_ratio": peak / (size_mb * 1024 * 1024)
+            }
+            path.unlink()
+    return results
+
+def bench_ui_dispatch(deltas=20000, frame_batch=8):
+    """長い出力を Text ウィジェットへ反映するコストを、差分ごとの反映とフレーム単位の反映で比較する"""
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception as e: # ディスプレイが無い環境
+        return {"skipped": f"Tk を初期化できませんでした: {e}"}
+    root.withdraw()
+    text = tk.Text(root)
+    tokens = [f"トークン{i % 100} " for i in range(deltas)]
+    results = {}
+    try:
+        # 以前の方式: 差分ごとに挿入し、全文を取得して文字数を数える
+        text.delete("1.0", "end")
+        started = time.perf_counter()
+        for index, token in enumerate(tokens):
+            text.insert("end", token)
+            text.see("end")
+            len(text.get("1.0", "end").strip())
+            if index % frame_batch == 0:
+                root.update_idletasks()
+        root.update_idletasks()
+        per_delta = time.perf_counter() - started
+
+        # 現在の方式: フレームごとに連続した差分をまとめて挿入し、文字数は差分から加算する
+        text.delete("1.0", "end")
+        token_marker = object()
+        started = time.perf_counter()
+        char_count = 0
+        for offset in range(0, len(tokens), frame_batch):
+            messages = [("request", (token_marker, "delta", token)) for token in tokens[offset:offset + frame_batch]]
+            for _, (_, _, chunk) in tool.PromptGeneratorGUI._coalesce_messages(messages):
+                text.insert("end", chunk)
+                text.see("end")
+                char_count += len(chunk)
+            root.update_idletasks()
+        coalesced = time.perf_counter() - started
+        results = {
+            "deltas": deltas,
+            "frame_batch": frame_batch,
+            "chars": char_count,
+            "per_delta_seconds": per_delta,
+            "coalesced_seconds": coalesced,
+            "coalesced_deltas_per_second": deltas / coalesced
+        }
+    finally:
+        root.destroy()
+    return results
+
+def _version_info():
+    """比較用に、計測したコードのバージョンと実行環境を返す"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+def _flatten(data, prefix=""):
+    """入れ子の dict を "a.b.c" → 数値 の dict にする"""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare_reports(base, current, threshold):
+    """2つのレポートの共通指標を比較し、(表の行, 悪化した指標名のリスト) を返す"""
+    base_metrics = _flatten(base.get("scenarios", {}))
+    current_metrics = _flatten(current.get("scenarios", {}))
+    rows = []
+    regressions = []
+    for name in sorted(base_metrics.keys() & current_metrics.keys()):
+        before, after = base_metrics[name], current_metrics[name]
+        # 件数・サイズなどの条件値は比較しない
+        if not before or name.rsplit(".", 1)[-1] in CONDITION_KEYS:
+            continue
+        change = (after - before) / before
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        flag = "悪化" if worse > threshold else ("改善" if worse < -threshold else "")
+        if flag == "悪化":
+            regressions.append(name)
+        rows.append(f"{name:<55} {before:>14.4f} {after:>14.4f} {change:>+8.1%} {flag}")
+    return rows, regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="模擬サーバーに対して llm_report_tool のオーバーヘッドを計測する")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"実行するシナリオ (カンマ区切り、既定: {','.join(SCENARIOS)})")
+    parser.add_argument("--requests", type=int, default=200, help="transport で送信するリクエスト数 (既定: 200)")
+    parser.add_argument("--concurrency", type=int, default=4, help="transport の同時実行数 (既定: 4)")
+    parser.add_argument("--sizes", default="1,10,100", help="attachments で使う添付ファイルのサイズ (MB、カンマ区切り)")
+    parser.add_argument("--deltas", type=int, default=20000, help="ui_dispatch で反映する差分の数")
+    parser.add_argument("--output", help="レポートの保存先 (既定: bench_results/bench-<日時>.json)")
+    parser.add_argument("--compare", metavar="BASE", help="以前のレポートと比較し、悪化した指標があれば終了コード 1 を返す")
+    parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす変化率 (既定: 0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f"エラー: 不明なシナリオです: {', '.join(unknown)}")
+        return 2
+    _configure_tool()
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "version": _version_info(),
+        "scenarios": {}
+    }
+    with MockServerProcess("--completion-tokens", "200") as mock:
+        report_transport.OPENROUTER_API_URL = mock.url
+        if "transport" in scenarios:
+            print(f"transport: {args.requests}件 × 同時{args.concurrency} ...", flush=True)
+            report["scenarios"]["transport"] = bench_transport(args.requests, args.concurrency)
+        if "attachments" in scenarios:
+            sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+            print(f"attachments: {', '.join(f'{size}MB' for size in sizes)} ...", flush=True)
+            report["scenarios"]["attachments"] = bench_attachments(sizes)
+    if "ui_dispatch" in scenarios:
+        print(f"ui_dispatch: {args.deltas}差分 ...", flush=True)
+        report["scenarios"]["ui_dispatch"] = bench_ui_dispatch(args.deltas)
+
+    output = Path(args.output or BASE_DIR / "bench_results" / f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(json.dumps(report["scenarios"], ensure_ascii=False, indent=2))
+    print(f"レポートを保存しました: {output}")
+
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        rows, regressions = compare_reports(base, report, args.threshold)
+        print(f"\n比較: {base.get('version', {}).get('git_commit')} → {report['version']['git_commit']}")
+        print(f"{'指標':<55} {'以前':>14} {'今回':>14} {'変化':>8}")
+        print("\n".join(rows))
+        if regressions:
+            print(f"\n{args.threshold:.0%} 以上悪化した指標: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,87 @@
+import time
+_PROCESS_IMPORT_STARTED = time.perf_counter() # --profile-startup 用 (モジュール読み込み開始時刻)
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, StringVar, BooleanVar, END, filedialog
-import ttkbootstrap as ttk
-from ttkbootstrap.constants import *
-# ttkbootstrap.scrolled.ScrolledText を使用
-from ttkbootstrap.scrolled import ScrolledText
-from ttkbootstrap.tooltip import ToolTip # ToolTip をインポート
-import requests
+from tkinter.constants import *
+import importlib
 import json
 import threading
 import queue
 import os
-import base64
 from pathlib import Path # Path をインポート
-import mimetypes
+import argparse
+import csv
+import re
+import sys
+import hashlib
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from report_metrics import (DEFAULT_METRICS_SETTINGS, METRICS_SETTINGS, RequestMetrics, configure_metrics, format_metrics_summary,
+                            get_cached_tokens, load_metrics_records, summarize_metrics)
+from report_transport import (APIRequestError, CancelToken, DEFAULT_HTTP_SETTINGS, DEFAULT_RATE_LIMIT_SETTINGS, LazyModule,
+                              RequestCancelled, configure_http, configure_providers, configure_rate_limit, get_http_session,
+                              provider_requires_app_key, rate_limiter_snapshots, requests)
+from report_materials import (ATTACHMENT_SETTINGS, DEFAULT_ATTACHMENT_SETTINGS, DEFAULT_IMAGE_SETTINGS, DEFAULT_PDF_LOCAL_SETTINGS,
+                              DEFAULT_REPORT_SETTINGS, IMAGE_EXTENSIONS, LOCAL_PDF_ENGINE, MATERIAL_TYPES, MULTI_MATERIAL_TYPE,
+                              PDFTextReference, PDF_ENGINE_OPTIONS, STRUCTURE_OPTIONS, TONE_OPTIONS, attachment_material_type,
+                              build_api_payload, configure_attachments, configure_image_preprocess, configure_pdf_local, format_bytes)
+from report_catalog import (DEFAULT_CATALOG_SETTINGS, configure_model_catalog, filter_models_for_material, format_model_info,
+                            get_model_catalog, model_supports_material)
+from report_stores import (DEFAULT_ARCHIVE_SETTINGS, DEFAULT_CACHE_SETTINGS, DEFAULT_JOB_STORE_SETTINGS, JOB_STORE_SETTINGS, archive_report,
+                           configure_archive, configure_cache, configure_job_store, get_job_store, get_report_archive, make_job_key,
+                           payload_has_attachments)
+from report_generation import (DEFAULT_FALLBACK_SETTINGS, DEFAULT_LENGTH_SETTINGS, DEFAULT_SECTIONED_SETTINGS,
+                               DEFAULT_TOKEN_BUDGET_SETTINGS, TOKEN_BUDGET_POLICIES, TOKEN_BUDGET_SETTINGS, configure_fallback,
+                               configure_length_control, configure_sectioned, configure_token_budget, estimate_payload_tokens,
+                               format_result_stats, generate_sectioned_report, get_fallback_chain, get_input_token_budget,
+                               get_model_context_limit, length_target, request_completion, request_with_fallback, should_generate_sectioned)
+
+# --- 遅延 import (起動時間短縮のため、重いモジュールは最初に使うときに読み込む) ---
+def _lazy_class(module_name, class_name):
+    """呼び出されたときに module_name を import して class_name のインスタンスを作る関数を返す"""
+    def _create(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), class_name)(*args, **kwargs)
+    _create.__name__ = class_name
+    return _create
+
+ttk = LazyModule("ttkbootstrap")   # バッチ実行では読み込まない (テーマ・Pillow の初期化を含むため重い)
+ScrolledText = _lazy_class("ttkbootstrap.scrolled", "ScrolledText")
+ToolTip = _lazy_class("ttkbootstrap.tooltip", "ToolTip")
+# ttkbootstrap.constants と同じ値 (constants を import すると ttkbootstrap 全体が読み込まれるため)
+PRIMARY, SECONDARY, SUCCESS, WARNING, DANGER, OUTLINE = "primary", "secondary", "success", "warning", "danger", "outline"
 
 # --- 設定ファイル関連 ---
 CONFIG_FILE = "config.json"
-PDF_ENGINE_OPTIONS = ["pdf-text", "mistral-ocr", "native"]
+# 辞書型の設定セクション (不足しているキーのみデフォルト値で補完する)
+CONFIG_SECTIONS = {
+    "http": DEFAULT_HTTP_SETTINGS,
+    "rate_limit": DEFAULT_RATE_LIMIT_SETTINGS,
+    "cache": DEFAULT_CACHE_SETTINGS,
+    "image_preprocess": DEFAULT_IMAGE_SETTINGS,
+    "pdf_local": DEFAULT_PDF_LOCAL_SETTINGS,
+    "token_budget": DEFAULT_TOKEN_BUDGET_SETTINGS,
+    "length_control": DEFAULT_LENGTH_SETTINGS,
+    "sectioned": DEFAULT_SECTIONED_SETTINGS,
+    "fallback": DEFAULT_FALLBACK_SETTINGS,
+    "metrics": DEFAULT_METRICS_SETTINGS,
+    "model_catalog": DEFAULT_CATALOG_SETTINGS,
+    "attachments": DEFAULT_ATTACHMENT_SETTINGS,
+    "job_store": DEFAULT_JOB_STORE_SETTINGS,
+    "archive": DEFAULT_ARCHIVE_SETTINGS
+}
 
-def load_config():
-    """設定ファイルを読み込む。存在しない場合はデフォルト設定で作成する。"""
+def load_config(interactive=True):
+    """設定ファイルを読み込む。存在しない場合はデフォルト設定で作成する。
+    interactive=False の場合はエラーダイアログを表示しない (バッチ実行用)。"""
     default_config = {
         "openrouter_api_key": "",
         "models": [ "google/gemini-2.0-flash-exp:free", "meta-llama/llama-4-maverick:free", "qwen/qwen3-235b-a22b:free", "deepseek/deepseek-chat-v3-0324:free", "deepseek/deepseek-r1:free" ],
-        "pdf_engine": PDF_ENGINE_OPTIONS[0]
+        "pdf_engine": PDF_ENGINE_OPTIONS[0],
+        "stream": True,
+        "providers": {}, # OpenRouter 以外の送信先 (名前 → PROVIDER_DEFAULTS と同じキーの辞書)
+        **{section: dict(defaults) for section, defaults in CONFIG_SECTIONS.items()}
     }
     if not os.path.exists(CONFIG_FILE):
         try:
@@ -45,6 +103,12 @@ def load_config():
             if not isinstance(config.get("models"), list) or not config.get("models"):
                 config["models"] = default_config["models"]
                 print(f"警告: 設定ファイル '{CONFIG_FILE}' の 'models' が不正または空です。デフォルトのモデルリストを使用します。")
+            # 辞書型の設定セクションは不足しているキーのみ補完
+            for section, defaults in CONFIG_SECTIONS.items():
+                if not isinstance(config.get(section), dict):
+                    config[section] = {}
+                for key, value in defaults.items():
+                    config[section].setdefault(key, value)
             # PDFエンジンの検証と修正
             if config.get("pdf_engine") not in PDF_ENGINE_OPTIONS:
                 print(f"警告: 設定ファイル '{CONFIG_FILE}' の 'pdf_engine' ('{config.get('pdf_engine')}') が無効です。デフォルトの '{default_config['pdf_engine']}' を使用します。")
@@ -52,37 +116,216 @@ def load_config():
             return config
         except (json.JSONDecodeError, IOError) as e:
             print(f"エラー: 設定ファイル '{CONFIG_FILE}' の読み込みに失敗しました: {e}")
-            messagebox.showerror("設定エラー", f"設定ファイル '{CONFIG_FILE}' の読み込みに失敗しました。\nデフォルト設定を使用します。\n\n詳細: {e}")
+            if interactive:
+                messagebox.showerror("設定エラー", f"設定ファイル '{CONFIG_FILE}' の読み込みに失敗しました。\nデフォルト設定を使用します。\n\n詳細: {e}")
             return default_config
 
-# --- 定数 ---
-STRUCTURE_OPTIONS = {
-    "連続文章": "セクション（見出し）は設けず、一つの連続した文章としてください。",
-    "セクション分け": "適切なセクション（見出し）を設けて、構造化されたレポートを作成してください。",
-    "箇条書き": "主要なポイントを箇条書き形式で記述してください。"
-}
-TONE_OPTIONS = ["である/だ調", "です/ます調"]
-MATERIAL_TYPES = ["PDF", "画像", "テキスト資料", "資料なし"]
-
-# --- ファイルエンコード関数 ---
-def encode_file_to_base64(file_path):
-    """ファイルを読み込み、Base64エンコードされた文字列を返す"""
+def configure_all(config):
+    """設定ファイルの各セクション (CONFIG_SECTIONS と providers) を各モジュールに反映する"""
+    configure_http(config)
+    configure_rate_limit(config)
+    configure_cache(config)
+    configure_image_preprocess(config)
+    configure_attachments(config)
+    configure_providers(config)
+    configure_pdf_local(config)
+    configure_token_budget(config)
+    configure_length_control(config)
+    configure_sectioned(config)
+    configure_fallback(config)
+    configure_metrics(config)
+    configure_model_catalog(config)
+    configure_job_store(config)
+    configure_archive(config)
+
+def _job_store_call(method, *args):
+    """ジョブの記録を更新する (記録の失敗で生成そのものは止めない)"""
     try:
-        with open(file_path, "rb") as file:
-            return base64.b64encode(file.read()).decode('utf-8')
-    except FileNotFoundError:
-        messagebox.showerror("エラー", f"ファイルが見つかりません:\n{file_path}")
-        return None
-    except Exception as e:
-        messagebox.showerror("エラー", f"ファイルの読み込みまたはエンコード中にエラーが発生しました:\n{e}")
+        return method(*args)
+    except sqlite3.Error as e:
+        print(f"ジョブ記録の更新エラー: {e}")
         return None
 
-def get_mime_type(file_path):
-    """ファイルパスからMIMEタイプを取得する"""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type or 'application/octet-stream' # 不明な場合はデフォルト
+# --- バッチ実行 (ヘッドレス) ---
+BATCH_RESULTS_FILE = "results.jsonl"
+
+def load_batch_jobs(jobs_path):
+    """JSONL または CSV のジョブファイルを読み込み、レポート設定 (dict) のリストを返す"""
+    jobs_path = Path(jobs_path)
+    if jobs_path.suffix.lower() == ".csv":
+        with open(jobs_path, "r", encoding="utf-8-sig", newline="") as f:
+            rows = [dict(row) for row in csv.DictReader(f)]
+    else:
+        rows = []
+        with open(jobs_path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{jobs_path}:{line_no} をJSONとして解析できません: {e}")
+
+    jobs = []
+    for index, row in enumerate(rows, 1):
+        job = dict(DEFAULT_REPORT_SETTINGS)
+        job.update({k: v for k, v in row.items() if v not in (None, "")})
+        job["id"] = str(row.get("id") or f"job{index:04d}")
+        for key in ("session_mode", "stream"):
+            if isinstance(job.get(key), str): # CSV では文字列になる
+                job[key] = job[key].strip().lower() in ("1", "true", "yes", "on")
+        if isinstance(job.get("attachments"), str): # CSV では ";" 区切り
+            job["attachments"] = [path.strip() for path in job["attachments"].split(";") if path.strip()]
+        if job.get("attachments") and not row.get("material_type"):
+            job["material_type"] = MULTI_MATERIAL_TYPE
+        # material_type 未指定の場合はファイル拡張子から推定
+        material_path = job.get("material_path")
+        if material_path and not row.get("material_type") and not job.get("attachments"):
+            suffix = Path(material_path).suffix.lower()
+            if suffix == ".pdf":
+                job["material_type"] = "PDF"
+            elif suffix in IMAGE_EXTENSIONS:
+                job["material_type"] = "画像"
+            else:
+                job["material_type"] = "テキスト資料"
+        # テキスト資料はファイルからも読み込めるようにする
+        if job["material_type"] == "テキスト資料" and material_path and not job.get("text_material"):
+            job["text_material"] = Path(material_path).read_text(encoding="utf-8")
+        jobs.append(job)
+    return jobs
+
+def _safe_filename(name):
+    """ジョブIDをファイル名として安全な文字列に変換する"""
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", name).strip("_") or "job"
+
+def run_batch_job(api_key, job, stream=False, use_cache=True, job_key=None):
+    """1件のジョブを実行し、状態レコード (dict) を返す
+
+    job_key を渡すとジョブの記録 (JobStore) に状態と結果を残す。
+    ジョブに "stream" があれば stream より優先する (ストリーミング時は目標の長さを超えた時点で打ち切る)。
+    """
+    if job.get("stream") is not None:
+        stream = bool(job["stream"])
+    record = {"id": job["id"], "model": job.get("model"), "theme": job.get("theme")}
+    metrics = RequestMetrics("batch", job.get("model"))
+    store = get_job_store() if job_key else None
+    if store:
+        _job_store_call(store.start, job_key)
+    try:
+        with metrics.span("build_payload"):
+            payload = build_api_payload(job)
+        models = get_fallback_chain(job["model"], job.get("fallback_models") or [])
+        if should_generate_sectioned(job):
+            result = generate_sectioned_report(api_key, payload, models, job, stream=stream, use_cache=use_cache, metrics=metrics)
+        else:
+            result = request_with_fallback(api_key, payload, models, stream=stream, use_cache=use_cache, metrics=metrics,
+                                           target=length_target(job))
+        record.update({"status": "ok", "model": result["model"], "content": result["content"], "ttft": result["ttft"], "elapsed": result["elapsed"],
+                       "cached": result.get("cached", False), "cached_tokens": get_cached_tokens(result.get("usage")),
+                       "stopped_early": bool(result.get("stopped_early"))})
+        metrics.finish("ok", result=result)
+        archive_report("batch", job, result)
+    except (ValueError, OSError, APIRequestError) as e: # PIL.UnidentifiedImageError は OSError のサブクラス
+        record.update({"status": "error", "error": str(e)})
+        metrics.finish("error", error=e)
+    except Exception as e: # 1件の想定外のエラーでバッチ全体を止めない
+        record.update({"status": "error", "error": f"予期せぬエラーが発生しました: {e}"})
+        metrics.finish("error", error=e)
+    if store:
+        if record["status"] == "ok":
+            _job_store_call(store.complete, job_key, record)
+        else:
+            _job_store_call(store.fail, job_key, record["error"])
+    return record
+
+def _session_key(job):
+    """同じ資料で連続作成するジョブをまとめるためのキー (session_mode でないジョブは None)"""
+    if not job.get("session_mode") or job.get("material_type") == "資料なし":
+        return None
+    return (job.get("model"), job.get("material_type"), job.get("material_path"), tuple(job.get("attachments") or ()),
+            job.get("pdf_engine"), hashlib.sha256((job.get("text_material") or "").encode("utf-8")).hexdigest())
+
+def run_batch(jobs, api_key, output_dir, workers=4, default_model=None, stream=False, use_cache=True, fallback_models=None,
+              session_mode=False):
+    """ジョブを並列実行し、完了した順に結果と状態を出力ディレクトリへ書き出す
+
+    session_mode (またはジョブの session_mode) が有効な場合、同じ資料を使うジョブは最初の1件が完了してから
+    残りを送信する (最初の1件でプロバイダ側のプロンプトキャッシュを作らせるため)。
+    ジョブの記録が有効な場合、前回までに完了しているジョブは再送信せずに記録から結果を書き出す
+    (use_cache=False の場合は再生成する)。中断したバッチは同じジョブファイルで再実行すれば続きから再開できる。
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for job in jobs:
+        job["model"] = job.get("model") or default_model
+        job.setdefault("fallback_models", fallback_models or [])
+        if session_mode:
+            job["session_mode"] = True
+    store = get_job_store()
+    job_keys = {}
+    finished_records = []
+    pending_jobs = []
+    for job in jobs:
+        if store:
+            job_key = make_job_key(job)
+            stored = _job_store_call(store.submit, job_key, "batch", job)
+            if stored and stored["status"] == "done" and use_cache:
+                finished_records.append(dict(stored["result"], resumed=True))
+                continue
+            job_keys[id(job)] = job_key
+        pending_jobs.append(job)
+    # 資料ごとに最初のジョブだけを先に送り、残りはそのジョブの完了後に送る
+    first_jobs = []
+    waiting = {}
+    for job in pending_jobs:
+        key = _session_key(job)
+        if key is not None and key in waiting:
+            waiting[key].append(job)
+        else:
+            first_jobs.append(job)
+            if key is not None:
+                waiting[key] = []
+    results_path = output_dir / BATCH_RESULTS_FILE
+    succeeded = 0
+    done_count = 0
+    with open(results_path, "a", encoding="utf-8") as results_file, \
+         ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for record in finished_records: # 前回までに完了しているジョブ
+            done_count += 1
+            succeeded += _write_batch_record(record, output_dir, results_file, done_count, len(jobs))
+        futures = {executor.submit(run_batch_job, api_key, job, stream, use_cache, job_keys.get(id(job))): job for job in first_jobs}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                for follower in waiting.pop(_session_key(job), []):
+                    futures[executor.submit(run_batch_job, api_key, follower, stream, use_cache, job_keys.get(id(follower)))] = follower
+                done_count += 1
+                succeeded += _write_batch_record(future.result(), output_dir, results_file, done_count, len(jobs))
+    return succeeded
+
+def _write_batch_record(record, output_dir, results_file, done_count, total):
+    """完了したジョブの出力ファイルと状態レコードを書き出し、成功なら 1 を返す"""
+    succeeded = 0
+    content = record.pop("content", None)
+    if content is not None:
+        output_path = output_dir / f"{_safe_filename(record['id'])}.txt"
+        output_path.write_text(content, encoding="utf-8")
+        record["output"] = output_path.name
+        succeeded = 1
+    # 完了したジョブから順に追記する (途中で中断しても結果が残る)
+    results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    results_file.flush()
+    status_text = record["status"] if record["status"] == "ok" else f"error: {record['error']}"
+    if record.get("resumed"):
+        status_text += " (前回の結果)"
+    print(f"[{done_count}/{total}] {record['id']} ({record['model']}): {status_text}")
+    return succeeded
 
 # --- GUIクラス ---
+UI_FRAME_INTERVAL_MS = 33  # 受信メッセージをまとめて画面に反映する間隔 (約30fps)
+UI_POLL_INTERVAL_MS = 100  # スレッド非対応の Tcl でのキュー監視間隔
+
 class PromptGeneratorGUI:
     def __init__(self, root):
         self.root = root
@@ -90,6 +333,13 @@ class PromptGeneratorGUI:
         self.api_key_var = StringVar(value=self.config.get("openrouter_api_key", ""))
         self.available_models = self.config.get("models", ["(モデルなし)"])
         self.pdf_engine_var = StringVar(value=self.config.get("pdf_engine", PDF_ENGINE_OPTIONS[0]))
+        self.stream_var = BooleanVar(value=bool(self.config.get("stream", True)))
+        self.session_mode_var = BooleanVar(value=bool(self.config.get("session_mode", False)))
+        self.fallback_var = BooleanVar(value=bool(self.config.get("fallback", {}).get("enabled", False)))
+        self.bypass_cache_var = BooleanVar(value=False) # 実行ごとの一時設定のため保存しない
+        budget_policy = self.config.get("token_budget", {}).get("policy", DEFAULT_TOKEN_BUDGET_SETTINGS["policy"])
+        self.budget_policy_var = StringVar(value=TOKEN_BUDGET_POLICIES.get(budget_policy, TOKEN_BUDGET_POLICIES[DEFAULT_TOKEN_BUDGET_SETTINGS["policy"]]))
+        configure_all(self.config)
 
         if not self.available_models or self.available_models[0] == "(モデルなし)":
              messagebox.showwarning("設定警告", f"設定ファイル '{CONFIG_FILE}' から有効なモデルを読み込めませんでした。")
@@ -97,8 +347,28 @@ class PromptGeneratorGUI:
 
         root.title("LLM Report Tool"); root.geometry("750x1000")
         self.result_queue = queue.Queue() # API結果受け渡し用キュー
-        self.material_type_var = StringVar(value=MATERIAL_TYPES[3]) # デフォルトは資料なし
+        # ワーカースレッドからのメッセージが届いたときだけ process_queue を予約する。
+        # スレッド対応の Tcl では root.after を別スレッドから呼べる (メインループ側で実行される)
+        self.dispatch_lock = threading.Lock()
+        self.dispatch_scheduled = False
+        self.wakeup_supported = root.tk.eval("expr {[info exists tcl_platform(threaded)] && $tcl_platform(threaded)}") == "1"
+        self.result_char_count = 0 # 実行結果の文字数 (前後の空白を除く、差分から逐次更新する)
+        self.result_trailing_spaces = 0 # 末尾の空白の文字数 (続きの本文が来たら文字数に加える)
+        self.fanout_tabs = {} # 複数モデル実行のタブ: モデルID → {"frame", "text", "stats"}
+        self.fanout_pending = 0
+        self.fanout_started_at = 0.0
+        self.request_token = None # 実行中の単一モデル実行の CancelToken
+        self.fanout_token = None  # 実行中の複数モデル実行の CancelToken
+        self.closing = False      # ウィンドウを閉じる操作による中断 (ジョブの記録を未完了のまま残す)
+        self.request_metrics = None # 実行中の単一モデル実行の RequestMetrics
+        self.resume_job_key = None  # 前回終了時に完了していなかったジョブを再開する場合のキー
+        self.archive_window = None  # 「履歴」ウィンドウ (同時に1つだけ開く)
+        self.fanout_metrics = {}    # 複数モデル実行の RequestMetrics: モデルID → RequestMetrics
+        self.material_type_var = StringVar(value=MATERIAL_TYPES[-1]) # デフォルトは資料なし
         self.pdf_path_var = StringVar(); self.image_path_var = StringVar()
+        has_models = self.available_models and self.available_models[0] != "(モデルなし)"
+        self.model_var = StringVar(value=self.available_models[0] if has_models else "")
+        self.model_var.trace_add("write", lambda *args: self._update_model_info())
 
         # --- メインレイアウト (PanedWindow) ---
         main_pane = ttk.PanedWindow(root, orient=VERTICAL)
@@ -107,6 +377,7 @@ class PromptGeneratorGUI:
         # --- 上部ペイン (設定エリア) ---
         settings_frame = ttk.Frame(main_pane); main_pane.add(settings_frame, weight=3) # 設定エリアの初期比率を調整
         settings_notebook = ttk.Notebook(settings_frame); settings_notebook.pack(fill=BOTH, expand=YES)
+        self.settings_notebook = settings_notebook
 
         # --- 「基本設定」タブ ---
         self.basic_settings_tab = ttk.Frame(settings_notebook, padding=5)
@@ -121,6 +392,9 @@ class PromptGeneratorGUI:
             rb = ttk.Radiobutton(material_type_frame, text=type_name, variable=self.material_type_var,
                                  value=type_name, command=self.toggle_material_input_area, bootstyle="toolbutton")
             rb.pack(side=LEFT, padx=(0, 5))
+        session_check = ttk.Checkbutton(material_type_frame, text="同じ資料で連続作成", variable=self.session_mode_var, bootstyle="round-toggle")
+        session_check.pack(side=LEFT, padx=(10, 0))
+        ToolTip(session_check, text="資料を先頭・条件を末尾に置き、2回目以降は資料部分をプロバイダ側のキャッシュから読み込ませます (応答の「キャッシュ済み入力」で確認できます)")
         row_idx += 1
         # 資料入力エリア
         self.material_input_frame = ttk.Frame(self.basic_settings_tab)
@@ -144,6 +418,24 @@ class PromptGeneratorGUI:
         self.image_label = ttk.Label(self.image_frame, text="(画像ファイルが選択されていません)", anchor=W, justify=LEFT, wraplength=400)
         self.image_label.grid(row=0, column=1, sticky=EW, padx=5, pady=5)
         ToolTip(self.image_label, text="")
+        # 複数ファイル選択UI (ファイルごとのサイズと準備の進捗を表示する)
+        self.attachments_frame = ttk.Frame(self.material_input_frame)
+        self.attachments_frame.columnconfigure(0, weight=1)
+        self.attachments_frame.rowconfigure(1, weight=1)
+        attachment_buttons = ttk.Frame(self.attachments_frame)
+        attachment_buttons.grid(row=0, column=0, sticky=EW, padx=5, pady=(5, 0))
+        ttk.Button(attachment_buttons, text="ファイルを追加...", command=self.add_attachment_files, bootstyle=OUTLINE).pack(side=LEFT, padx=(0, 5))
+        ttk.Button(attachment_buttons, text="削除", command=self.remove_selected_attachments, bootstyle="outline-secondary").pack(side=LEFT, padx=(0, 5))
+        ttk.Button(attachment_buttons, text="すべて削除", command=self.clear_attachments, bootstyle="outline-secondary").pack(side=LEFT)
+        self.attachments_total_label = ttk.Label(attachment_buttons, text="(ファイルが選択されていません)", bootstyle="secondary")
+        self.attachments_total_label.pack(side=RIGHT)
+        attachment_columns = [("name", "ファイル", 260), ("kind", "種類", 50), ("size", "サイズ", 80), ("state", "状態", 180)]
+        self.attachments_tree = ttk.Treeview(self.attachments_frame, columns=[key for key, _, _ in attachment_columns], show="headings", height=4)
+        for key, heading, width in attachment_columns:
+            self.attachments_tree.heading(key, text=heading)
+            self.attachments_tree.column(key, width=width, anchor=E if key == "size" else W, stretch=key in ("name", "state"))
+        self.attachments_tree.grid(row=1, column=0, sticky=NSEW, padx=5, pady=5)
+        self.attachment_paths = []
         # テキスト資料入力UI
         self.text_material_text = ScrolledText(self.material_input_frame, height=8, wrap=tk.WORD, autohide=True)
         # テーマ、文字数、構成、口調、指示者の意見
@@ -168,26 +460,11 @@ class PromptGeneratorGUI:
         self.instructor_opinion_text.grid(row=row_idx, column=0, columnspan=2, sticky=EW+NS, padx=5, pady=1)
         self.basic_settings_tab.rowconfigure(row_idx, weight=1)
 
-        # --- 「API設定」タブ ---
-        api_settings_tab = ttk.Frame(settings_notebook, padding=5)
-        settings_notebook.add(api_settings_tab, text=" API設定 ")
-        api_settings_tab.columnconfigure(1, weight=1); row_idx_api = 0
-        ttk.Label(api_settings_tab, text="APIキー:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
-        self.api_key_entry = ttk.Entry(api_settings_tab, show='*', textvariable=self.api_key_var); self.api_key_entry.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2); row_idx_api += 1
-        ttk.Label(api_settings_tab, text="モデル:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
-        self.model_combobox = ttk.Combobox(api_settings_tab, values=self.available_models, state="readonly", width=30); self.model_combobox.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2)
-        if self.available_models and self.available_models[0] != "(モデルなし)":
-            self.model_combobox.current(0)
-        row_idx_api += 1
-        ttk.Label(api_settings_tab, text="PDFエンジン:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
-        self.pdf_engine_combobox = ttk.Combobox(api_settings_tab, values=PDF_ENGINE_OPTIONS, state="readonly", textvariable=self.pdf_engine_var)
-        self.pdf_engine_combobox.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2)
-        current_engine = self.pdf_engine_var.get()
-        if current_engine in PDF_ENGINE_OPTIONS:
-            self.pdf_engine_combobox.current(PDF_ENGINE_OPTIONS.index(current_engine))
-        else:
-            self.pdf_engine_combobox.current(0)
-        row_idx_api += 1
+        # --- 「API設定」タブ (中身は最初に開いたときに作る) ---
+        self.api_settings_tab = ttk.Frame(settings_notebook, padding=5)
+        settings_notebook.add(self.api_settings_tab, text=" API設定 ")
+        self.api_settings_built = False
+        settings_notebook.bind("<<NotebookTabChanged>>", self._on_settings_tab_changed)
 
 
         # --- 下部ペイン (アクションボタンと出力エリア) ---
@@ -205,8 +482,19 @@ class PromptGeneratorGUI:
         copy_button.pack(side=LEFT, padx=(0, 10))
         self.api_execute_button = ttk.Button(action_frame, text="実行", command=self.start_api_request, bootstyle=PRIMARY)
         self.api_execute_button.pack(side=LEFT, padx=(0, 5))
+        self.cancel_button = ttk.Button(action_frame, text="キャンセル", command=self.cancel_requests, bootstyle="outline-danger", state=DISABLED)
+        self.cancel_button.pack(side=LEFT, padx=(0, 5))
+        bypass_cache_check = ttk.Checkbutton(action_frame, text="キャッシュ無視", variable=self.bypass_cache_var, bootstyle="round-toggle")
+        bypass_cache_check.pack(side=LEFT, padx=(0, 10))
+        ToolTip(bypass_cache_check, text="オンにすると、同じ条件の過去の結果があってもAPIを呼び出して再生成します")
+        self.fanout_button = ttk.Button(action_frame, text="複数モデルで実行", command=self.start_fanout_request, bootstyle="outline-primary")
+        self.fanout_button.pack(side=LEFT, padx=(0, 5))
+        ToolTip(self.fanout_button, text="同じプロンプトを選択した複数のモデルへ同時に送信し、結果をモデルごとのタブに表示します")
         save_button = ttk.Button(action_frame, text="結果を保存", command=self.save_result_to_file, bootstyle="outline-info")
         save_button.pack(side=LEFT, padx=(0, 5))
+        archive_button = ttk.Button(action_frame, text="履歴", command=self.show_report_archive, bootstyle="outline-secondary")
+        archive_button.pack(side=LEFT, padx=(0, 5))
+        ToolTip(archive_button, text="これまでに生成したレポートを全文検索し、結果や条件を再利用します")
 
         # --- ステータスラベル ---
         self.status_label = ttk.Label(action_frame, text="")
@@ -216,6 +504,10 @@ class PromptGeneratorGUI:
         self.char_count_label = ttk.Label(action_frame, text="文字数: --", width=12, anchor=E)
         self.char_count_label.pack(side=RIGHT, padx=(5, 0))
 
+        # --- 推定入力トークン表示ラベル ---
+        self.token_estimate_label = ttk.Label(action_frame, text="", anchor=E)
+        self.token_estimate_label.pack(side=RIGHT, padx=(5, 0))
+
         # --- 出力ノートブック ---
         self.output_notebook = ttk.Notebook(bottom_frame)
         self.output_notebook.grid(row=1, column=0, sticky=NSEW)
@@ -225,31 +517,107 @@ class PromptGeneratorGUI:
         self.output_text = ScrolledText(prompt_output_tab, wrap=tk.WORD, autohide=True, vbar=True, hbar=False, height=8)
         self.output_text.pack(fill=BOTH, expand=YES, padx=1, pady=1)
 
-        result_output_tab = ttk.Frame(self.output_notebook)
-        self.output_notebook.add(result_output_tab, text=" 実行結果 ")
-        self.result_text = ScrolledText(result_output_tab, wrap=tk.WORD, autohide=True, vbar=True, hbar=False, height=8)
-        self.result_text.pack(fill=BOTH, expand=YES, padx=1, pady=1)
-
-        # --- 実行結果テキストエリアの変更イベントをバインド ---
-        # ScrolledTextの実体は内部の .text ウィジェットなので、それにバインドする
-        self.result_text.text.bind("<<Modified>>", self.update_char_count_realtime)
+        # 実行結果タブの中身は、タブを開くか結果を表示するときに作る (result_text プロパティ)
+        self.result_output_tab = ttk.Frame(self.output_notebook)
+        self.output_notebook.add(self.result_output_tab, text=" 実行結果 ")
+        self._result_text = None
+        self.output_notebook.bind("<<NotebookTabChanged>>", self._on_output_tab_changed)
 
 
         # --- 初期化処理 ---
         self.toggle_material_input_area() # 初期表示を更新
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing) # 閉じる際の処理
-        self.root.after(100, self.process_queue) # キュー監視を開始
+        if not self.wakeup_supported:
+            self.root.after(UI_POLL_INTERVAL_MS, self.process_queue) # キュー監視を開始
+        self.root.after(500, self._refresh_model_catalog) # 最初の描画を待たせないよう、表示後に取得する
+        self.root.after(700, self._offer_job_resume)
 
     # --- メソッド ---
 
+    @property
+    def result_text(self):
+        """実行結果の ScrolledText (最初に参照されたときに作る)"""
+        if self._result_text is None:
+            self._result_text = ScrolledText(self.result_output_tab, wrap=tk.WORD, autohide=True, vbar=True, hbar=False, height=8)
+            self._result_text.pack(fill=BOTH, expand=YES, padx=1, pady=1)
+            # --- 実行結果テキストエリアの変更イベントをバインド ---
+            # ScrolledTextの実体は内部の .text ウィジェットなので、それにバインドする
+            self._result_text.text.bind("<<Modified>>", self.update_char_count_realtime)
+        return self._result_text
+
+    def _on_output_tab_changed(self, event=None):
+        """「実行結果」タブが選択されたら中身を作る"""
+        if self._result_text is None and self.output_notebook.select() == str(self.result_output_tab):
+            self.result_text
+
+    def _on_settings_tab_changed(self, event=None):
+        """「API設定」タブが初めて選択されたときに中身を作る"""
+        if not self.api_settings_built and self.settings_notebook.select() == str(self.api_settings_tab):
+            self._build_api_settings_tab(self.api_settings_tab)
+
+    def _build_api_settings_tab(self, api_settings_tab):
+        """「API設定」タブのウィジェットを作る (起動時には作らず、最初に開いたときに呼ばれる)"""
+        self.api_settings_built = True
+        api_settings_tab.columnconfigure(1, weight=1); row_idx_api = 0
+        ttk.Label(api_settings_tab, text="APIキー:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        self.api_key_entry = ttk.Entry(api_settings_tab, show='*', textvariable=self.api_key_var); self.api_key_entry.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2); row_idx_api += 1
+        ttk.Label(api_settings_tab, text="モデル:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        self.model_combobox = ttk.Combobox(api_settings_tab, values=self._compatible_models(), state="readonly", width=30, textvariable=self.model_var); self.model_combobox.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2)
+        row_idx_api += 1
+        self.model_info_label = ttk.Label(api_settings_tab, text=format_model_info(self.model_var.get()), bootstyle=SECONDARY)
+        self.model_info_label.grid(row=row_idx_api, column=1, sticky=W, padx=5, pady=(0, 2))
+        ToolTip(self.model_info_label, text="OpenRouter のモデル一覧から取得した情報。資料の種類に対応していないモデルは一覧に表示されません")
+        row_idx_api += 1
+        ttk.Label(api_settings_tab, text="PDFエンジン:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        self.pdf_engine_combobox = ttk.Combobox(api_settings_tab, values=PDF_ENGINE_OPTIONS, state="readonly", textvariable=self.pdf_engine_var)
+        self.pdf_engine_combobox.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2)
+        self.pdf_engine_combobox.bind("<<ComboboxSelected>>", lambda e: self._update_model_choices())
+        current_engine = self.pdf_engine_var.get()
+        if current_engine in PDF_ENGINE_OPTIONS:
+            self.pdf_engine_combobox.current(PDF_ENGINE_OPTIONS.index(current_engine))
+        else:
+            self.pdf_engine_combobox.current(0)
+        row_idx_api += 1
+        ttk.Label(api_settings_tab, text="ストリーミング:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        ttk.Checkbutton(api_settings_tab, text="生成中のテキストを逐次表示する", variable=self.stream_var, bootstyle="round-toggle").grid(row=row_idx_api, column=1, sticky=W, padx=5, pady=2)
+        row_idx_api += 1
+        ttk.Label(api_settings_tab, text="フォールバック:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        fallback_check = ttk.Checkbutton(api_settings_tab, text="応答が遅い・失敗した場合は他のモデルにも送信する", variable=self.fallback_var, bootstyle="round-toggle")
+        fallback_check.grid(row=row_idx_api, column=1, sticky=W, padx=5, pady=2)
+        ToolTip(fallback_check, text=f"'{CONFIG_FILE}' の fallback.chain (未設定時はモデル一覧の順) に従い、最初に応答したモデルの結果を採用します")
+        row_idx_api += 1
+        ttk.Label(api_settings_tab, text="トークン超過時:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        budget_policy_combobox = ttk.Combobox(api_settings_tab, values=list(TOKEN_BUDGET_POLICIES.values()), state="readonly", textvariable=self.budget_policy_var)
+        budget_policy_combobox.grid(row=row_idx_api, column=1, sticky=EW, padx=5, pady=2)
+        budget_policy_combobox.bind("<<ComboboxSelected>>", lambda e: self._apply_budget_policy())
+        ToolTip(budget_policy_combobox, text="推定入力トークン数がモデルの上限を超える場合に、送信前に資料テキストをどう調整するか")
+        row_idx_api += 1
+        ttk.Label(api_settings_tab, text="計測:").grid(row=row_idx_api, column=0, sticky=W, padx=5, pady=2)
+        metrics_button = ttk.Button(api_settings_tab, text="モデル別の応答時間を表示", command=self.show_metrics_summary, bootstyle="outline-secondary")
+        metrics_button.grid(row=row_idx_api, column=1, sticky=W, padx=5, pady=2)
+        ToolTip(metrics_button, text=f"'{DEFAULT_METRICS_SETTINGS['log_path']}' に記録された実行の TTFT・合計時間の中央値 (p50) と95パーセンタイル (p95)")
+        row_idx_api += 1
+
+
     # === on_closing メソッド ===
     def on_closing(self):
-        """ウィンドウを閉じる際に設定を保存し、メッセージを表示"""
-        current_config = {
+        """ウィンドウを閉じる際に実行中のリクエストを中断し、設定を保存してメッセージを表示"""
+        if (self.request_token is not None or self.fanout_token is not None) and not messagebox.askyesno(
+                "確認", "実行中のリクエストがあります。終了しますか？\n(次回起動時に同じ条件で再実行できます)", parent=self.root):
+            return
+        self.closing = True
+        for token in (self.request_token, self.fanout_token):
+            if token is not None:
+                token.cancel() # 終了を待たずに接続を切断し、バックグラウンドスレッドを終了させる
+        current_config = dict(self.config) # 未知のキーも保持したまま保存する
+        current_config.update({
             "openrouter_api_key": self.api_key_var.get(),
             "models": self.config.get("models", []), # 保存時は元のリストを維持
-            "pdf_engine": self.pdf_engine_var.get()
-        }
+            "pdf_engine": self.pdf_engine_var.get(),
+            "stream": self.stream_var.get(),
+            "session_mode": self.session_mode_var.get(),
+            "fallback": dict(self.config.get("fallback", {}), enabled=self.fallback_var.get())
+        })
         save_success = False
         try:
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
@@ -302,109 +670,194 @@ class PromptGeneratorGUI:
             self.image_label.config(text=filename)
             ToolTip(self.image_label, text=filepath)
 
+    def add_attachment_files(self):
+        """「複数ファイル」の添付ファイル (PDF・画像) を選択して一覧に追加する"""
+        filepaths = filedialog.askopenfilenames(
+            title="添付ファイルを選択 (複数選択可)",
+            filetypes=[("PDF・画像ファイル", "*.pdf *.jpg *.jpeg *.png *.gif *.bmp *.webp"), ("PDFファイル", "*.pdf"),
+                       ("画像ファイル", "*.jpg *.jpeg *.png *.gif *.bmp *.webp")]
+        )
+        for filepath in filepaths:
+            if filepath not in self.attachment_paths:
+                self.attachment_paths.append(filepath)
+        self._refresh_attachments_tree()
+
+    def remove_selected_attachments(self):
+        """選択中の添付ファイルを一覧から外す"""
+        selected = set(self.attachments_tree.selection())
+        self.attachment_paths = [path for path in self.attachment_paths if path not in selected]
+        self._refresh_attachments_tree()
+
+    def clear_attachments(self):
+        self.attachment_paths = []
+        self._refresh_attachments_tree()
+
+    def _refresh_attachments_tree(self):
+        """添付ファイルの一覧と合計サイズの表示を更新し、状態を「待機中」に戻す"""
+        self.attachments_tree.delete(*self.attachments_tree.get_children())
+        total = 0
+        for path in self.attachment_paths:
+            try:
+                size = os.path.getsize(path)
+                size_text = format_bytes(size)
+            except OSError:
+                size, size_text = 0, "(見つかりません)"
+            total += size
+            self.attachments_tree.insert("", END, iid=path, values=(Path(path).name, attachment_material_type(path) or "非対応", size_text, "待機中"))
+        limit = int(ATTACHMENT_SETTINGS.get("max_total_bytes") or 0)
+        if self.attachment_paths:
+            # 画像は送信前に縮小されるため、上限の判定は送信時に前処理後のサイズで行う
+            text = f"{len(self.attachment_paths)}件 / 合計 {format_bytes(total)}" + (f" (上限 {format_bytes(limit)})" if limit else "")
+            self.attachments_total_label.config(text=text, bootstyle=WARNING if limit and total > limit else "default")
+        else:
+            self.attachments_total_label.config(text="(ファイルが選択されていません)", bootstyle="secondary")
+        self._update_model_choices()
+
+    def _update_attachment_state(self, path, state, detail):
+        """添付ファイルの準備の進捗を一覧に反映する"""
+        if self.attachments_tree.exists(path):
+            self.attachments_tree.set(path, "state", f"{state} ({detail})" if detail else state)
+
     def toggle_material_input_area(self):
         """選択された資料の種類に応じて、入力エリアの表示を切り替える"""
         self.pdf_frame.grid_forget()
         self.image_frame.grid_forget()
+        self.attachments_frame.grid_forget()
         self.text_material_text.pack_forget()
         selected_type = self.material_type_var.get()
+        self.material_input_frame.rowconfigure(0, weight=1 if selected_type == MULTI_MATERIAL_TYPE else 0) # 一覧だけを縦に伸ばす
         if selected_type == "PDF":
             self.pdf_frame.grid(row=0, column=0, columnspan=2, sticky=NSEW, padx=0, pady=0)
         elif selected_type == "画像":
             self.image_frame.grid(row=0, column=0, columnspan=2, sticky=NSEW, padx=0, pady=0)
+        elif selected_type == MULTI_MATERIAL_TYPE:
+            self.attachments_frame.grid(row=0, column=0, columnspan=2, sticky=NSEW, padx=0, pady=0)
         elif selected_type == "テキスト資料":
             self.text_material_text.pack(fill=BOTH, expand=YES, padx=5, pady=5)
-
-    def _build_api_payload(self):
-        """入力値に基づいてAPIリクエストのペイロード(messages部分)を構築する"""
-        theme = self.theme_entry.get() or "(テーマ未設定)"
-        word_count = self.word_count_entry.get() or "(文字数未設定)"
-        selected_structure_key = self.structure_var.get()
-        structure = STRUCTURE_OPTIONS.get(selected_structure_key, "（構成未選択）")
-        selected_tone = self.tone_var.get()
-        instructor_opinion_text = self.instructor_opinion_text.get("1.0", tk.END).strip()
+        self._update_model_choices()
+
+    def _compatible_models(self):
+        """選択中の資料の種類に対応しているモデルの一覧 (対応モデルが無い場合は全モデル)"""
+        models = filter_models_for_material(self.available_models, self.material_type_var.get(), self.pdf_engine_var.get(), self.attachment_paths)
+        return models or self.available_models
+
+    def _update_model_choices(self):
+        """資料の種類・PDFエンジンに合わせてモデルの選択肢を絞り込む"""
+        models = self._compatible_models()
+        if self.api_settings_built:
+            self.model_combobox.config(values=models)
+        current = self.model_var.get()
+        if current and current not in models and models[0] != "(モデルなし)":
+            self.model_var.set(models[0])
+            self.status_label.config(text=f"資料に対応していないため、モデルを {models[0]} に切り替えました", bootstyle=WARNING)
+            self.root.after(4000, lambda: self.status_label.config(text="", bootstyle="default"))
+        self._update_model_info()
+
+    def _update_model_info(self):
+        """API設定タブのモデル情報 (コンテキスト長・価格・入力形式) を更新する"""
+        if self.api_settings_built:
+            self.model_info_label.config(text=format_model_info(self.model_var.get()))
+
+    def _refresh_model_catalog(self):
+        """モデルカタログを裏で再検証し、更新されたらモデルの選択肢に反映する"""
+        catalog = get_model_catalog()
+        if catalog:
+            catalog.refresh_in_background(on_updated=lambda: self._post_message(("catalog", None)))
+
+    def _collect_settings(self):
+        """GUIの入力値をレポート設定 (dict) にまとめる"""
         material_type = self.material_type_var.get()
+        material_path = ""
+        if material_type == "PDF":
+            material_path = self.pdf_path_var.get()
+        elif material_type == "画像":
+            material_path = self.image_path_var.get()
         selected_pdf_engine = self.pdf_engine_var.get()
-
         if selected_pdf_engine not in PDF_ENGINE_OPTIONS:
-            print(f"警告: 無効なPDFエンジン '{selected_pdf_engine}' が選択されました。デフォルトの '{PDF_ENGINE_OPTIONS[0]}' を使用します。")
             selected_pdf_engine = PDF_ENGINE_OPTIONS[0]
             self.pdf_engine_var.set(selected_pdf_engine)
+        return {
+            "theme": self.theme_entry.get(),
+            "word_count": self.word_count_entry.get(),
+            "structure": self.structure_var.get(),
+            "tone": self.tone_var.get(),
+            "opinion": self.instructor_opinion_text.get("1.0", tk.END).strip(),
+            "material_type": material_type,
+            "material_path": material_path,
+            "attachments": list(self.attachment_paths) if material_type == MULTI_MATERIAL_TYPE else [],
+            "text_material": self.text_material_text.get("1.0", tk.END).strip() if material_type == "テキスト資料" else "",
+            "pdf_engine": selected_pdf_engine,
+            "session_mode": self.session_mode_var.get(),
+        }
 
-        instruction_text_parts = [
-            f"以下の条件に従いレポートを作成してください。\n",
-            "## 条件",
-            f"* **テーマ:** 「{theme}」",
-            f"* **文字数:** 「{word_count}字」程度\n    * 指定文字数を大幅に超えたり、不足したりしないように注意してください。",
-            f"* **構成:**\n    * {structure}",
-            f"* **文体:**",
-            f"    * 平易な言葉遣いを心がけ、専門用語や難解な語彙の多用は避けてください。",
-            f"    * 口調は「{selected_tone}」を使用してください。",
-        ]
-        if instructor_opinion_text:
-            instruction_text_parts.extend([
-                "\n## 指示者の意見・視点",
-                instructor_opinion_text
-            ])
-        instruction_text_parts.extend([
-            "\n## 出力に関する厳守事項",
-            "* **レポートの本文のみ**を生成してください。",
-            "* **「承知しました」「レポートを作成します」といった応答や、レポート本文以外の説明、前置き、結びの挨拶、タイトル、氏名、日付、参考文献リスト（別途指示がない限り）などは一切含めないでください。**",
-            "\n## レポート作成開始"
-        ])
-        final_instruction_text = "\n".join(instruction_text_parts)
-
-        messages = []
-        content_list = [{"type": "text", "text": final_instruction_text}]
-        plugins = None
-
+    def _apply_settings(self, settings):
+        """レポート設定 (dict) を入力欄に反映する (_collect_settings の逆)"""
+        self.theme_entry.delete(0, END)
+        self.theme_entry.insert(0, settings.get("theme") or "")
+        self.word_count_entry.delete(0, END)
+        self.word_count_entry.insert(0, settings.get("word_count") or "")
+        self.structure_var.set(settings.get("structure") or DEFAULT_REPORT_SETTINGS["structure"])
+        self.tone_var.set(settings.get("tone") or DEFAULT_REPORT_SETTINGS["tone"])
+        self.instructor_opinion_text.delete("1.0", END)
+        self.instructor_opinion_text.insert("1.0", settings.get("opinion") or "")
+        material_type = settings.get("material_type") or DEFAULT_REPORT_SETTINGS["material_type"]
+        material_path = settings.get("material_path") or ""
+        self.material_type_var.set(material_type)
         if material_type == "PDF":
-            pdf_path = self.pdf_path_var.get()
-            if not pdf_path:
-                messagebox.showwarning("警告", "PDFファイルが選択されていません。", parent=self.root)
-                return None
-            base64_pdf = encode_file_to_base64(pdf_path)
-            if not base64_pdf: return None
-            data_url = f"data:application/pdf;base64,{base64_pdf}"
-            filename = Path(pdf_path).name
-            content_list.insert(0, {"type": "text", "text": f"添付されたPDFファイル「{filename}」の内容を精読し、その情報を基にしてレポートを作成してください。"})
-            content_list.append({
-                 "type": "file",
-                 "file": { "filename": filename, "file_data": data_url }
-            })
-            plugins = [{"id": "file-parser", "pdf": {"engine": selected_pdf_engine}}]
+            self.pdf_path_var.set(material_path)
+            self.pdf_label.config(text=Path(material_path).name)
+            ToolTip(self.pdf_label, text=material_path)
         elif material_type == "画像":
-            image_path = self.image_path_var.get()
-            if not image_path:
-                messagebox.showwarning("警告", "画像ファイルが選択されていません。", parent=self.root)
-                return None
-            base64_image = encode_file_to_base64(image_path)
-            if not base64_image: return None
-            mime_type = get_mime_type(image_path)
-            data_url = f"data:{mime_type};base64,{base64_image}"
-            filename = Path(image_path).name
-            content_list.insert(0, {"type": "text", "text": f"添付された画像ファイル「{filename}」の内容を理解し、その情報を基にしてレポートを作成してください。"})
-            content_list.append({
-                "type": "image_url",
-                "image_url": { "url": data_url }
-            })
-        elif material_type == "テキスト資料":
-            text_material = self.text_material_text.get("1.0", tk.END).strip()
-            if text_material:
-                content_list.insert(0, {"type": "text", "text": "以下のテキスト資料の内容を考慮してレポートを作成してください。"})
-                content_list.append({"type": "text", "text": f"\n## 資料\n{text_material}"})
-            else:
-                content_list.insert(0, {"type": "text", "text": "あなた自身の知識ベースに基づいてレポートを作成してください。"})
-                messagebox.showinfo("情報", "テキスト資料が空のため、モデル自身の知識に基づいてレポートを作成します。", parent=self.root)
-        elif material_type == "資料なし":
-            content_list.insert(0, {"type": "text", "text": "あなた自身の知識ベースに基づいてレポートを作成してください。"})
-
-        messages.append({"role": "user", "content": content_list})
-        payload = {"messages": messages}
-        if plugins:
-            payload["plugins"] = plugins
+            self.image_path_var.set(material_path)
+            self.image_label.config(text=Path(material_path).name)
+            ToolTip(self.image_label, text=material_path)
+        elif material_type == MULTI_MATERIAL_TYPE:
+            self.attachment_paths = list(settings.get("attachments") or [])
+            self._refresh_attachments_tree()
+        self.text_material_text.delete("1.0", END)
+        self.text_material_text.insert("1.0", settings.get("text_material") or "")
+        self.pdf_engine_var.set(settings.get("pdf_engine") or PDF_ENGINE_OPTIONS[0])
+        self.session_mode_var.set(bool(settings.get("session_mode")))
+        self.toggle_material_input_area()
+        if settings.get("model") in self.available_models:
+            self.model_var.set(settings["model"])
+
+    def _build_api_payload(self):
+        """入力値に基づいてAPIリクエストのペイロード(messages部分)を構築する"""
+        settings = self._collect_settings()
+        try:
+            payload = build_api_payload(settings)
+        except ValueError as e:
+            messagebox.showwarning("警告", str(e), parent=self.root)
+            return None
+        except FileNotFoundError:
+            messagebox.showerror("エラー", f"ファイルが見つかりません:\n{settings['material_path']}", parent=self.root)
+            return None
+        except Exception as e:
+            messagebox.showerror("エラー", f"ファイルの読み込みまたはエンコード中にエラーが発生しました:\n{e}", parent=self.root)
+            return None
+        if settings["material_type"] == "テキスト資料" and not settings["text_material"]:
+            messagebox.showinfo("情報", "テキスト資料が空のため、モデル自身の知識に基づいてレポートを作成します。", parent=self.root)
         return payload
 
+    def _apply_budget_policy(self):
+        """選択されたトークン超過時の処理を設定に反映する"""
+        labels_to_keys = {label: key for key, label in TOKEN_BUDGET_POLICIES.items()}
+        policy = labels_to_keys.get(self.budget_policy_var.get(), DEFAULT_TOKEN_BUDGET_SETTINGS["policy"])
+        self.config.setdefault("token_budget", {})["policy"] = policy
+        configure_token_budget(self.config)
+
+    def _update_token_estimate(self, payload, model):
+        """推定入力トークン数と上限を表示し、(推定値, 上限) を返す"""
+        estimate = estimate_payload_tokens(payload)
+        budget = get_input_token_budget(model)
+        # PDFの内容は送信時 (またはサーバー側) で展開されるため推定値に含まれない
+        suffix = "+PDF" if any(item["type"] == "file" or isinstance(item.get("text"), PDFTextReference)
+                               for item in payload["messages"][0]["content"]) else ""
+        self.token_estimate_label.config(text=f"推定入力: {estimate:,}{suffix} / {budget:,}",
+                                         bootstyle=DANGER if estimate > budget else "default")
+        return estimate, budget
+
     def generate_prompt(self):
         """プロンプト生成ボタンが押されたときの処理"""
         payload = self._build_api_payload()
@@ -413,21 +866,29 @@ class PromptGeneratorGUI:
             user_content = payload["messages"][0]["content"]
             instruction_texts = []
             file_info_texts = []
-            if "plugins" in payload and payload["plugins"][0]["id"] == "file-parser":
+            if self.material_type_var.get() == MULTI_MATERIAL_TYPE:
+                 for path in self.attachment_paths:
+                     file_info_texts.append(f"[添付{attachment_material_type(path)}: {Path(path).name}]\n")
+            elif "plugins" in payload and payload["plugins"][0]["id"] == "file-parser":
                  pdf_path = self.pdf_path_var.get()
                  filename = Path(pdf_path).name if pdf_path else "(不明なPDF)"
                  file_info_texts.append(f"[添付ファイル: {filename} (エンジン: {payload['plugins'][0]['pdf']['engine']})]\n")
+            elif any(isinstance(item.get("text"), PDFTextReference) for item in user_content):
+                 pdf_path = self.pdf_path_var.get()
+                 filename = Path(pdf_path).name if pdf_path else "(不明なPDF)"
+                 file_info_texts.append(f"[資料PDF: {filename} (エンジン: {LOCAL_PDF_ENGINE}、送信時に抽出)]\n")
             elif any(item["type"] == "image_url" for item in user_content):
                  img_path = self.image_path_var.get()
                  filename = Path(img_path).name if img_path else "(不明な画像)"
                  file_info_texts.append(f"[添付画像: {filename}]\n")
             for item in user_content:
                 if item["type"] == "text":
-                    instruction_texts.append(item["text"])
+                    instruction_texts.append(str(item["text"]))
             display_text += "\n\n".join(instruction_texts) + "\n\n" + "".join(file_info_texts)
             self.output_text.delete("1.0", tk.END)
             self.output_text.insert("1.0", display_text.strip())
             self.output_notebook.select(0)
+            self._update_token_estimate(payload, self.model_var.get())
             self.status_label.config(text="プロンプト生成完了", bootstyle="info")
             self.root.after(2000, lambda: self.status_label.config(text="", bootstyle="default"))
         else:
@@ -445,6 +906,11 @@ class PromptGeneratorGUI:
                 widget_to_copy = self.output_text
             elif current_tab_index == 1:
                 widget_to_copy = self.result_text
+            else:
+                current_tab = self.output_notebook.select()
+                for tab in self.fanout_tabs.values():
+                    if str(tab["frame"]) == current_tab:
+                        widget_to_copy = tab["text"]
 
             if widget_to_copy:
                 text_to_copy = widget_to_copy.get("1.0", "end-1c")
@@ -466,14 +932,23 @@ class PromptGeneratorGUI:
 
     # --- 文字数リアルタイム更新用メソッド ---
     def update_char_count_realtime(self, event=None):
-        """result_textの内容変更時に文字数を計算してラベルを更新する"""
+        """result_textの内容変更時に文字数を計算してラベルを更新する
+
+        プログラムからの変更は _set_result_text / _append_result_text が文字数を更新し、
+        変更フラグも戻しているため、ここで全文を数え直すのはユーザーが直接編集したときだけになる。
+        """
         try:
             # ウィジェットが存在するか確認 (ウィンドウ закрытия 時のエラー防止)
             if not self.result_text.winfo_exists() or not self.char_count_label.winfo_exists():
                 return
+            if not self.result_text.text.edit_modified():
+                return # 反映済みのプログラムからの変更
 
-            current_content = self.result_text.get("1.0", tk.END).strip()
+            raw_content = self.result_text.get("1.0", "end-1c")
+            current_content = raw_content.strip()
             char_count = len(current_content)
+            self.result_char_count = char_count
+            self.result_trailing_spaces = len(raw_content) - len(raw_content.rstrip()) if char_count else 0
             self.char_count_label.config(text=f"文字数: {char_count}")
 
             # Text ウィジェットの変更フラグをリセット (重要)
@@ -485,103 +960,596 @@ class PromptGeneratorGUI:
         except Exception as e:
             print(f"リアルタイム文字数更新中にエラー: {e}")
 
+    def _set_result_text(self, text, show_count=True):
+        """実行結果テキストを置き換え、文字数ラベルを更新する"""
+        self.result_text.delete("1.0", END)
+        self.result_text.insert(END, text)
+        self.result_text.text.edit_modified(False) # 文字数は反映済み (Modified で数え直さない)
+        self.result_char_count = len(text.strip())
+        self.result_trailing_spaces = len(text) - len(text.rstrip()) if self.result_char_count else 0
+        self.char_count_label.config(text=f"文字数: {self.result_char_count}" if show_count else "文字数: --")
+
+    def _append_result_text(self, text):
+        """ストリーミングの差分を末尾に追記し、文字数を差分だけ加算する
+
+        文字数は _set_result_text と同じく全文の前後の空白を除いた数になるよう、
+        先頭の空白は数えず、末尾の空白は続きの本文が来た時点で加える。
+        """
+        self.result_text.insert(END, text)
+        self.result_text.text.see(END)
+        self.result_text.text.edit_modified(False)
+        if not self.result_char_count:
+            text = text.lstrip()
+        body = text.rstrip()
+        if body:
+            self.result_char_count += self.result_trailing_spaces + len(body)
+            self.result_trailing_spaces = len(text) - len(body)
+        else:
+            self.result_trailing_spaces += len(text)
+        self.char_count_label.config(text=f"文字数: {self.result_char_count}")
+
 
     def start_api_request(self):
         """APIリクエストを開始する前のチェックとスレッド起動"""
+        job_key = self.resume_job_key or uuid.uuid4().hex
+        self.resume_job_key = None
         api_key = self.api_key_var.get()
-        if not api_key:
-            messagebox.showerror("エラー", f"APIキーが設定されていません。\n'{CONFIG_FILE}'を確認するか、API設定タブで入力してください。", parent=self.root)
-            return
-
-        model = self.model_combobox.get()
+        model = self.model_var.get()
         if not model or model == "(モデルなし)":
             messagebox.showerror("エラー", "モデルが選択されていません。", parent=self.root)
             return
+        if not api_key and provider_requires_app_key(model): # ローカルサーバー等のモデルはキー不要
+            messagebox.showerror("エラー", f"APIキーが設定されていません。\n'{CONFIG_FILE}'を確認するか、API設定タブで入力してください。", parent=self.root)
+            return
+        material_type = self.material_type_var.get()
+        if not model_supports_material(model, material_type, self.pdf_engine_var.get(), self.attachment_paths):
+            if not messagebox.askyesno("確認", f"モデル {model} は{material_type}の入力に対応していません (モデル一覧の情報)。\nこのまま送信しますか？", parent=self.root):
+                return
 
-        payload = self._build_api_payload()
+        metrics = RequestMetrics("gui", model)
+        with metrics.span("build_payload"):
+            payload = self._build_api_payload()
         if not payload:
             return
+        job_settings = dict(self._collect_settings(), model=model) # 中断後に同じ条件で再開するための入力
 
         payload["model"] = model
+        self._apply_budget_policy()
+        self.config["fallback"] = dict(self.config.get("fallback", {}), enabled=self.fallback_var.get())
+        configure_fallback(self.config)
+        models = get_fallback_chain(model, self.available_models)
+        estimate, budget = self._update_token_estimate(payload, model)
+        if estimate > budget and TOKEN_BUDGET_SETTINGS["policy"] == "none":
+            if not messagebox.askyesno("確認", f"推定入力トークン数 ({estimate:,}) がモデルの上限 ({budget:,}、コンテキスト長 {get_model_context_limit(model):,} から出力分を除く) を超えています。\nこのまま送信しますか？", parent=self.root):
+                return
+        stream = self.stream_var.get()
+        use_cache = not self.bypass_cache_var.get()
 
+        self.request_token = CancelToken()
+        self.request_metrics = metrics
         self.api_execute_button.config(state=DISABLED)
+        self._update_cancel_button()
         self.status_label.config(text=f"APIリクエスト中 ({model})...", bootstyle=WARNING)
-        # --- 文字数ラベルをリセット ---
-        self.char_count_label.config(text="文字数: --")
-        self.result_text.delete("1.0", END) # 以前の結果をクリア (ここでModified発生→リセットされる)
+        # --- 以前の結果と文字数ラベルをリセット ---
+        self._set_result_text("", show_count=False)
         self.output_notebook.select(1) # 実行結果タブを表示
+        if material_type == MULTI_MATERIAL_TYPE:
+            for path in self.attachment_paths:
+                self._update_attachment_state(path, "待機中", "")
 
-        thread = threading.Thread(target=self._api_request_thread, args=(api_key, payload), daemon=True)
+        thread = threading.Thread(target=self._api_request_thread,
+                                  args=(api_key, payload, models, stream, use_cache, self.request_token, metrics, job_key, job_settings),
+                                  daemon=True)
         thread.start()
 
-    def _api_request_thread(self, api_key, payload):
-        """APIリクエストを実行し、結果をキューに入れる (バックグラウンドスレッド)"""
+    def _api_request_thread(self, api_key, payload, models, stream, use_cache, cancel_token, metrics=None, job_key=None, job_settings=None):
+        """APIリクエストを実行し、結果をキューに入れる (バックグラウンドスレッド)
+
+        添付ファイルの読み込み・ハッシュ計算・エンコードはすべてこのスレッドで行われる。
+        メッセージには cancel_token を付け、キャンセル後に届いたものは process_queue で破棄される。
+        job_key を渡すと入力・状態・結果をジョブの記録に残し、終了や異常終了で中断しても次回起動時に再開できるようにする。
+        """
+        post = lambda kind, data: self._post_message(("request", (cancel_token, kind, data)))
+        store = get_job_store() if job_key else None
+        if store:
+            _job_store_call(store.submit, job_key, "gui", job_settings or {})
+            _job_store_call(store.start, job_key)
+
+        def _fail(message, status="error"):
+            if store:
+                _job_store_call(store.fail, job_key, message, status)
+            if message is not None:
+                post("error", message)
+
+        if payload_has_attachments(payload):
+            post("status", "添付ファイルを準備中...")
+        options = dict(
+            stream=stream,
+            on_attachment=lambda path, state, detail: post("attachment", (path, state, detail)),
+            on_first_token=lambda ttft: post("first_token", ttft),
+            on_delta=lambda delta: post("delta", delta),
+            on_retry=lambda attempt, delay, reason: post(
+                "status", f"再試行中 ({reason}, {attempt}回目, {delay:.0f}秒待機)..."),
+            use_cache=use_cache,
+            on_status=lambda text: post("status", text),
+            cancel_token=cancel_token,
+            metrics=metrics
+        )
         try:
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "http://localhost",
-                "X-Title": "LLM Report Tool"
-            }
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=300
-            )
-            if not response.ok:
-                try:
-                    error_data = response.json()
-                    error_message = error_data.get("error", {}).get("message", response.text)
-                except json.JSONDecodeError:
-                    error_message = response.text
-                detailed_error = f"APIエラー (HTTP {response.status_code}): {error_message}"
-                self.result_queue.put(("error", detailed_error))
-                return
+            if job_settings and should_generate_sectioned(job_settings):
+                result = generate_sectioned_report(api_key, payload, models, job_settings, **options)
+            else:
+                result = request_with_fallback(api_key, payload, models,
+                                               target=length_target(job_settings) if job_settings else None, **options)
+        except RequestCancelled:
+            if not self.closing: # 終了による中断は、次回起動時に再開できるよう未完了のまま残す
+                _fail(None, "cancelled") # 画面側はキャンセル時点で元に戻している
+            return
+        except APIRequestError as e:
+            _fail(str(e))
+            return
+        except OSError as e:
+            _fail(f"ファイルの読み込みまたはエンコード中にエラーが発生しました: {e}")
+            return
+        except Exception as e:
+            _fail(f"予期せぬエラーが発生しました: {e}")
+            return
+        finally:
+            del payload # 送信内容 (添付ファイル参照を含む) をすぐに解放する
+        if store:
+            _job_store_call(store.complete, job_key, {key: result.get(key) for key in ("content", "model", "ttft", "elapsed", "usage", "cached")})
+        archive_report("gui", job_settings or {}, result)
+        if store: # 結果はアーカイブに残るため、古いGUIの実行の記録は削除する (バッチは再開に使うため残す)
+            _job_store_call(store.prune, "gui", JOB_STORE_SETTINGS["keep_finished_gui_jobs"])
+        if stream and not result.get("cached"):
+            post("stream_end", result)
+        else:
+            post("success", result)
 
-            response_data = response.json()
-            if response_data.get("choices") and len(response_data["choices"]) > 0:
-                content = response_data["choices"][0].get("message", {}).get("content")
-                if content:
-                    self.result_queue.put(("success", content))
-                else:
-                    self.result_queue.put(("error", "APIレスポンスに有効な 'content' が見つかりませんでした。"))
+    def _offer_job_resume(self):
+        """前回終了時に完了していなかった実行があれば、同じ条件で再実行するかを確認する"""
+        store = get_job_store()
+        if store is None:
+            return
+        _job_store_call(store.prune, "gui", JOB_STORE_SETTINGS["keep_finished_gui_jobs"])
+        jobs = _job_store_call(store.unfinished, "gui")
+        if not jobs:
+            return
+        latest = jobs[0]
+        for job in jobs[1:]: # 再開を確認するのは最新の1件のみ
+            _job_store_call(store.fail, job["key"], None, "cancelled")
+        settings = latest["settings"]
+        started_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(latest["created_at"]))
+        if not messagebox.askyesno("前回の実行", "前回終了時に完了していない実行があります。\n\n"
+                                   f"開始: {started_at}\nテーマ: {settings.get('theme') or '(未設定)'}\nモデル: {settings.get('model')}\n\n"
+                                   "同じ条件で再実行しますか？", parent=self.root):
+            _job_store_call(store.fail, latest["key"], None, "cancelled")
+            return
+        self._apply_settings(settings)
+        self.resume_job_key = latest["key"] # 同じジョブとして記録し直す (試行回数が増える)
+        self.start_api_request()
+
+    def _update_cancel_button(self):
+        """実行中のリクエストがある間だけキャンセルボタンを有効にする"""
+        active = self.request_token is not None or self.fanout_token is not None
+        self.cancel_button.config(state=NORMAL if active else DISABLED)
+
+    def cancel_requests(self):
+        """実行中のリクエスト (単一モデル・複数モデル) を中断し、画面をすぐに操作可能に戻す"""
+        if self.request_token is not None:
+            self.request_token.cancel() # 接続を切断し、バックグラウンドスレッドを終了させる
+            self.request_token = None
+            self._finish_metrics(self.request_metrics, "cancelled")
+            self.request_metrics = None
+            self._set_result_text("", show_count=False) # 途中まで受信した出力は破棄
+            self.api_execute_button.config(state=NORMAL)
+        if self.fanout_token is not None:
+            self.fanout_token.cancel()
+            self.fanout_token = None
+            for model, tab in self.fanout_tabs.items():
+                if not tab["finished"]:
+                    tab["text"].delete("1.0", END)
+                    tab["stats"].config(text="キャンセル", bootstyle="secondary")
+                    self._finish_metrics(self.fanout_metrics.get(model), "cancelled")
+            self.fanout_metrics = {}
+            self.fanout_pending = 0
+            self.fanout_button.config(state=NORMAL)
+        self._update_cancel_button()
+        self.status_label.config(text="キャンセルしました", bootstyle="warning")
+        self.root.after(2000, lambda: self.status_label.config(text="", bootstyle="default"))
+
+    # --- 複数モデル同時実行 ---
+    def _ask_fanout_models(self):
+        """実行するモデルを選択するダイアログを表示し、選択されたモデルのリストを返す"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("複数モデルで実行")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        frame = ttk.Frame(dialog, padding=10)
+        frame.pack(fill=BOTH, expand=YES)
+        ttk.Label(frame, text="同時に実行するモデルを選択してください:").pack(anchor=W, pady=(0, 5))
+        current_model = self.model_var.get()
+        material_type, pdf_engine = self.material_type_var.get(), self.pdf_engine_var.get()
+        model_vars = []
+        for model in self.available_models:
+            if model == "(モデルなし)":
+                continue
+            supported = model_supports_material(model, material_type, pdf_engine, self.attachment_paths)
+            var = BooleanVar(value=(model == current_model and supported))
+            label = model if supported else f"{model} ({material_type}に非対応)"
+            ttk.Checkbutton(frame, text=label, variable=var).pack(anchor=W, pady=1)
+            model_vars.append((model, var))
+        selected = []
+
+        def _confirm():
+            selected.extend(model for model, var in model_vars if var.get())
+            dialog.destroy()
+
+        button_frame = ttk.Frame(frame)
+        button_frame.pack(fill=X, pady=(10, 0))
+        ttk.Button(button_frame, text="実行", command=_confirm, bootstyle=PRIMARY).pack(side=RIGHT)
+        ttk.Button(button_frame, text="キャンセル", command=dialog.destroy, bootstyle="outline-secondary").pack(side=RIGHT, padx=(0, 5))
+        self.root.wait_window(dialog)
+        return selected
+
+    def _reset_fanout_tabs(self, models):
+        """前回の複数モデル実行のタブを閉じ、モデルごとのタブを作り直す"""
+        for tab in self.fanout_tabs.values():
+            self.output_notebook.forget(tab["frame"])
+            tab["frame"].destroy()
+        self.fanout_tabs = {}
+        for model in models:
+            frame = ttk.Frame(self.output_notebook)
+            self.output_notebook.add(frame, text=f" {model.split('/')[-1]} ")
+            stats_label = ttk.Label(frame, text="待機中...", anchor=W)
+            stats_label.pack(fill=X, padx=5, pady=(3, 0))
+            text = ScrolledText(frame, wrap=tk.WORD, autohide=True, vbar=True, hbar=False, height=8)
+            text.pack(fill=BOTH, expand=YES, padx=1, pady=1)
+            self.fanout_tabs[model] = {"frame": frame, "text": text, "stats": stats_label, "finished": False}
+
+    def start_fanout_request(self):
+        """同じペイロードを選択した複数モデルへ並列に送信する"""
+        api_key = self.api_key_var.get()
+        models = self._ask_fanout_models()
+        if not models:
+            return
+        if not api_key and any(provider_requires_app_key(model) for model in models):
+            messagebox.showerror("エラー", f"APIキーが設定されていません。\n'{CONFIG_FILE}'を確認するか、API設定タブで入力してください。", parent=self.root)
+            return
+        build_started = time.perf_counter()
+        payload = self._build_api_payload()
+        if not payload:
+            return
+        build_seconds = time.perf_counter() - build_started
+        settings = self._collect_settings()
+        self._apply_budget_policy()
+        stream = self.stream_var.get()
+        use_cache = not self.bypass_cache_var.get()
+
+        self._reset_fanout_tabs(models)
+        self.fanout_pending = len(models)
+        self.fanout_started_at = time.perf_counter()
+        self.fanout_token = CancelToken()
+        self.fanout_metrics = {model: RequestMetrics("fanout", model) for model in models}
+        for metrics in self.fanout_metrics.values():
+            metrics.add_time("build_payload", build_seconds) # ペイロードは全モデルで共通
+        self.fanout_button.config(state=DISABLED)
+        self._update_cancel_button()
+        self.status_label.config(text=f"{len(models)}モデルで同時実行中...", bootstyle=WARNING)
+        self.output_notebook.select(self.fanout_tabs[models[0]]["frame"])
+        for model in models:
+            thread = threading.Thread(target=self._fanout_request_thread,
+                                      args=(model, api_key, dict(payload, model=model), stream, use_cache, self.fanout_token,
+                                            self.fanout_metrics[model], dict(settings, model=model)), daemon=True)
+            thread.start()
+
+    def _fanout_request_thread(self, model, api_key, payload, stream, use_cache, cancel_token, metrics=None, settings=None):
+        """複数モデル実行の1モデル分を処理し、結果をモデルIDを付けてキューに入れる (バックグラウンドスレッド)"""
+        put = lambda kind, data: self._post_message(("fanout", (cancel_token, model, kind, data)))
+        options = dict(
+            stream=stream,
+            on_first_token=lambda ttft: put("status", f"受信中 (TTFT {ttft:.2f}秒)..."),
+            on_delta=lambda delta: put("delta", delta),
+            on_retry=lambda attempt, delay, reason: put("status", f"再試行中 ({reason}, {attempt}回目)..."),
+            use_cache=use_cache,
+            on_status=lambda text: put("status", text),
+            cancel_token=cancel_token,
+            metrics=metrics
+        )
+        try:
+            if settings and should_generate_sectioned(settings):
+                result = generate_sectioned_report(api_key, payload, [model], settings, **options)
             else:
-                error_details = response_data.get("error", {}).get("message", f"予期しない応答形式:\n{response_data}")
-                self.result_queue.put(("error", f"APIエラー: {error_details}"))
-        except requests.exceptions.Timeout:
-            self.result_queue.put(("error", "APIリクエストがタイムアウトしました。"))
-        except requests.exceptions.RequestException as e:
-            self.result_queue.put(("error", f"ネットワーク通信エラーが発生しました: {e}"))
-        except json.JSONDecodeError:
-            self.result_queue.put(("error", "APIからの応答をJSONとして解析できませんでした。"))
+                result = request_completion(api_key, payload, target=length_target(settings) if settings else None, **options)
+        except RequestCancelled:
+            return
+        except APIRequestError as e:
+            put("error", str(e))
+            return
         except Exception as e:
-            self.result_queue.put(("error", f"予期せぬエラーが発生しました: {e}"))
+            put("error", f"予期せぬエラーが発生しました: {e}")
+            return
+        archive_report("fanout", settings or {"model": model}, result)
+        put("done", result)
+
+    def _handle_fanout_message(self, cancel_token, model, kind, data):
+        """複数モデル実行のメッセージをモデルごとのタブに反映する"""
+        tab = self.fanout_tabs.get(model)
+        if tab is None or cancel_token is not self.fanout_token: # キャンセル済み・置き換え済みの実行からのメッセージ
+            return
+        if kind == "status":
+            tab["stats"].config(text=data)
+            return
+        if kind == "delta":
+            tab["text"].insert(END, data)
+            return
+        if kind == "done":
+            tab["text"].delete("1.0", END)
+            tab["text"].insert(END, data["content"])
+            tab["stats"].config(text=format_result_stats(data), bootstyle=SUCCESS)
+        elif kind == "error":
+            tab["text"].delete("1.0", END)
+            tab["text"].insert(END, f"エラーが発生しました:\n\n{data}")
+            tab["stats"].config(text="エラー", bootstyle=DANGER)
+        tab["finished"] = True
+        self.fanout_pending -= 1
+        if self.fanout_pending <= 0:
+            elapsed = time.perf_counter() - self.fanout_started_at
+            self.fanout_token = None
+            self.fanout_metrics = {}
+            self._update_cancel_button()
+            self.fanout_button.config(state=NORMAL)
+            self.status_label.config(text=f"{len(self.fanout_tabs)}モデルの実行完了 ({elapsed:.1f}秒)", bootstyle=SUCCESS)
+            self.root.after(3000, lambda: self.status_label.config(text="", bootstyle="default"))
 
+    def _post_message(self, message):
+        """ワーカースレッドからメッセージを送り、次のフレームでの画面反映を予約する"""
+        self.result_queue.put(message)
+        if not self.wakeup_supported:
+            return # process_queue の定期監視で拾われる
+        with self.dispatch_lock:
+            if self.dispatch_scheduled:
+                return # 予約済みの反映でまとめて処理される
+            self.dispatch_scheduled = True
+        try:
+            self.root.after(UI_FRAME_INTERVAL_MS, self.process_queue)
+        except (RuntimeError, tk.TclError):
+            pass # ウィンドウを閉じた後
+
+    @staticmethod
+    def _coalesce_messages(messages):
+        """同じ実行・同じ宛先への連続した delta をひとつにまとめる"""
+        merged = []
+        for message_type, data in messages:
+            if merged and message_type in ("request", "fanout") and data[-2] == "delta":
+                last_type, last_data = merged[-1]
+                if last_type == message_type and last_data[:-2] == data[:-2] and last_data[-2] == "delta":
+                    merged[-1] = (message_type, last_data[:-1] + (last_data[-1] + data[-1],))
+                    continue
+            merged.append((message_type, data))
+        return merged
 
     def process_queue(self):
-        """キューを定期的にチェックし、結果をGUIに反映する"""
+        """キューにたまったメッセージをすべて取り出し、差分をまとめてGUIに反映する"""
+        with self.dispatch_lock:
+            self.dispatch_scheduled = False # これ以降に届いたメッセージは次のフレームで反映する
+        messages = []
+        try:
+            while True:
+                messages.append(self.result_queue.get_nowait()) # ノンブロッキングで取得
+        except queue.Empty:
+            pass
+        try:
+            for message_type, data in self._coalesce_messages(messages):
+                metrics, kind, body = self._message_metrics(message_type, data)
+                render_started = time.perf_counter()
+                self._dispatch_message(message_type, data)
+                if metrics is None:
+                    continue
+                metrics.add_time("render", time.perf_counter() - render_started)
+                if kind in ("success", "stream_end", "done"):
+                    self._finish_metrics(metrics, "ok", result=body)
+                elif kind == "error":
+                    self._finish_metrics(metrics, "error", error=body)
+        finally:
+            if not self.wakeup_supported:
+                self.root.after(UI_POLL_INTERVAL_MS, self.process_queue)
+
+    def _message_metrics(self, message_type, data):
+        """メッセージが属する実行の RequestMetrics と、メッセージの種類・内容を返す (破棄されるメッセージは None)"""
+        if message_type == "request" and data[0] is self.request_token:
+            return self.request_metrics, data[1], data[2]
+        if message_type == "fanout" and data[0] is self.fanout_token:
+            return self.fanout_metrics.get(data[1]), data[2], data[3]
+        return None, None, None
+
+    def _finish_metrics(self, metrics, status, result=None, error=None):
+        """実行の計測を確定してメトリクスログに記録する"""
+        if metrics is None:
+            return
+        try:
+            metrics.finish(status, result=result, error=error)
+        except Exception as e: # 計測の失敗で画面の更新を止めない
+            print(f"メトリクスの記録中にエラー: {e}")
+
+    def show_metrics_summary(self):
+        """メトリクスログを集計し、モデルごとの応答時間 (p50/p95) を別ウィンドウに表示する"""
+        summary = summarize_metrics(load_metrics_records())
+        if not summary:
+            messagebox.showinfo("計測", f"メトリクスがまだ記録されていません。\n('{METRICS_SETTINGS['log_path']}')", parent=self.root)
+            return
+        window = ttk.Toplevel(self.root)
+        window.title("モデル別の応答時間")
+        window.geometry("820x300")
+        columns = [
+            ("model", "モデル", 260), ("runs", "件数", 50), ("errors", "失敗", 50),
+            ("ttft_p50", "TTFT p50", 80), ("ttft_p95", "TTFT p95", 80),
+            ("elapsed_p50", "合計 p50", 80), ("elapsed_p95", "合計 p95", 80), ("completion_tokens_p50", "出力トークン p50", 110)
+        ]
+        tree = ttk.Treeview(window, columns=[key for key, _, _ in columns], show="headings", bootstyle="primary")
+        for key, heading, width in columns:
+            tree.heading(key, text=heading)
+            tree.column(key, width=width, anchor=W if key == "model" else E, stretch=key == "model")
+        for row in summary:
+            values = []
+            for key, _, _ in columns:
+                value = row[key]
+                if value is None:
+                    values.append("-")
+                elif key.startswith(("ttft", "elapsed")):
+                    values.append(f"{value:.2f}秒")
+                else:
+                    values.append(f"{value:,}" if isinstance(value, int) else value)
+            tree.insert("", END, values=values)
+        tree.pack(fill=BOTH, expand=YES, padx=5, pady=5)
+        ttk.Label(window, text="キャッシュから返した実行とキャンセルした実行は集計に含めません。", bootstyle="secondary").pack(anchor=W, padx=5, pady=(0, 5))
+
+    def show_report_archive(self):
+        """アーカイブしたレポートを全文検索・閲覧するウィンドウを表示する"""
+        archive = get_report_archive()
+        if archive is None:
+            messagebox.showinfo("履歴", f"レポートのアーカイブが無効になっています ('{CONFIG_FILE}' の archive)。", parent=self.root)
+            return
+        if self.archive_window is not None and self.archive_window.winfo_exists():
+            self.archive_window.lift()
+            return
+        window = ttk.Toplevel(self.root)
+        window.title("レポートの履歴")
+        window.geometry("900x600")
+        self.archive_window = window
+        search_var = StringVar()
+        search_frame = ttk.Frame(window, padding=5)
+        search_frame.pack(fill=X)
+        ttk.Label(search_frame, text="検索:").pack(side=LEFT)
+        search_entry = ttk.Entry(search_frame, textvariable=search_var)
+        search_entry.pack(side=LEFT, fill=X, expand=YES, padx=5)
+        ToolTip(search_entry, text="テーマ・条件・本文から探します (空白で区切ると、すべての語を含むものを探します)")
+        count_label = ttk.Label(search_frame, text="", bootstyle="secondary")
+        count_label.pack(side=RIGHT)
+
+        paned = ttk.Panedwindow(window, orient=VERTICAL)
+        paned.pack(fill=BOTH, expand=YES, padx=5)
+        columns = [("created_at", "日時", 130), ("theme", "テーマ", 180), ("model", "モデル", 200),
+                   ("chars", "文字数", 70), ("elapsed", "合計", 60), ("snippet", "抜粋", 300)]
+        tree = ttk.Treeview(paned, columns=[key for key, _, _ in columns], show="headings", selectmode="browse", bootstyle="primary")
+        for key, heading, width in columns:
+            tree.heading(key, text=heading)
+            tree.column(key, width=width, anchor=E if key in ("chars", "elapsed") else W, stretch=key == "snippet")
+        preview = ScrolledText(paned, wrap=tk.WORD, autohide=True, height=10)
+        paned.add(tree, weight=1)
+        paned.add(preview, weight=1)
+        button_frame = ttk.Frame(window, padding=5)
+        button_frame.pack(fill=X)
+        search_job = [None] # 入力中の連続した検索をまとめるための after ID
+
+        def _refresh():
+            search_job[0] = None
+            try:
+                reports = archive.search(search_var.get())
+            except sqlite3.Error as e:
+                count_label.config(text=f"検索エラー: {e}", bootstyle=DANGER)
+                return
+            tree.delete(*tree.get_children())
+            for report in reports:
+                tree.insert("", END, iid=str(report["id"]), values=(
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(report["created_at"])), report["theme"] or "(テーマなし)",
+                    report["model"] or "", f"{report['chars'] or 0:,}",
+                    f"{report['elapsed']:.1f}秒" if report["elapsed"] is not None else "-",
+                    " ".join((report["snippet"] or "").split())))
+            count_label.config(text=f"{len(reports)}件", bootstyle="secondary")
+            preview.delete("1.0", END)
+
+        def _on_search_changed(*args):
+            if search_job[0] is not None:
+                window.after_cancel(search_job[0])
+            search_job[0] = window.after(200, _refresh)
+
+        def _selected_report():
+            selection = tree.selection()
+            return archive.get(int(selection[0])) if selection else None
+
+        def _on_select(event=None):
+            report = _selected_report()
+            preview.delete("1.0", END)
+            if report:
+                preview.insert("1.0", report["content"])
+
+        def _show_result():
+            report = _selected_report()
+            if not report:
+                return
+            self._set_result_text(report["content"])
+            self.output_notebook.select(1)
+            self.status_label.config(text=f"履歴のレポートを表示しました ({report['model']})", bootstyle="info")
+            self.root.after(3000, lambda: self.status_label.config(text="", bootstyle="default"))
+
+        def _apply_conditions():
+            report = _selected_report()
+            if report:
+                self._apply_settings(dict(report["settings"], model=report["model"]))
+                self.status_label.config(text="履歴のレポートの条件を入力欄に反映しました", bootstyle="info")
+                self.root.after(3000, lambda: self.status_label.config(text="", bootstyle="default"))
+
+        def _delete():
+            selection = tree.selection()
+            if selection and messagebox.askyesno("確認", "選択したレポートを履歴から削除しますか？", parent=window):
+                archive.delete(int(selection[0]))
+                _refresh()
+
+        ttk.Button(button_frame, text="実行結果に表示", command=_show_result, bootstyle=PRIMARY).pack(side=LEFT, padx=(0, 5))
+        ttk.Button(button_frame, text="条件を入力欄に反映", command=_apply_conditions, bootstyle="outline-primary").pack(side=LEFT, padx=(0, 5))
+        ttk.Button(button_frame, text="削除", command=_delete, bootstyle="outline-danger").pack(side=RIGHT)
+        tree.bind("<<TreeviewSelect>>", _on_select)
+        tree.bind("<Double-1>", lambda event: _show_result())
+        search_var.trace_add("write", _on_search_changed)
+        _refresh()
+        search_entry.focus_set()
+
+    def _dispatch_message(self, message_type, data):
+        """キューのメッセージ1件をGUIに反映する"""
         try:
-            message_type, data = self.result_queue.get_nowait() # ノンブロッキングで取得
+            if message_type == "fanout":
+                self._handle_fanout_message(*data)
+                return # 単一モデル実行のボタン状態には影響しない
+
+            if message_type == "catalog":
+                self._update_model_choices()
+                return # 実行中のリクエストには影響しない
+
+            if message_type == "request":
+                cancel_token, message_type, data = data
+                if cancel_token is not self.request_token:
+                    return # キャンセル済みの実行からのメッセージは破棄
+
+            if message_type == "status":
+                self.status_label.config(text=data, bootstyle=WARNING)
+                return # 処理継続中のためボタンは無効のまま
+
+            if message_type == "attachment":
+                self._update_attachment_state(*data)
+                return # 準備の進捗のため処理は継続中
+
+            if message_type == "first_token":
+                self.status_label.config(text=f"受信中 (最初の応答まで {data:.2f}秒)...", bootstyle=WARNING)
+                return # 生成継続中のためボタンは無効のまま
 
-            if message_type == "success":
-                # イベントハンドラが呼ばれるように、insert前にフラグをセットしておく
-                # (deleteですでにフラグは立っているはずだが念のため)
-                self.result_text.text.edit_modified(True)
-                self.result_text.delete("1.0", END)
-                self.result_text.insert(END, data)
-                # insert 後に Modified イベントが発生し、update_char_count_realtime が呼ばれる
+            if message_type == "delta":
+                # ストリーミングの差分を末尾に追記 (文字数も差分だけ加算する)
+                self._append_result_text(data)
+                return # 生成継続中のためボタンは無効のまま
+
+            if message_type == "stream_end":
+                self.status_label.config(text=f"生成完了 ({format_result_stats(data)})", bootstyle=SUCCESS)
+
+            elif message_type == "success":
+                self._set_result_text(data["content"])
 
                 # ステータスラベルのみ更新
-                self.status_label.config(text="生成完了", bootstyle=SUCCESS)
+                self.status_label.config(text=f"生成完了 ({format_result_stats(data)})", bootstyle=SUCCESS)
 
             elif message_type == "error":
                 # エラーメッセージを表示
-                self.result_text.text.edit_modified(True)
-                self.result_text.delete("1.0", END)
-                self.result_text.insert(END, f"エラーが発生しました:\n\n{data}")
-                # insert 後に Modified イベントが発生するが、エラー時は "--" にしたいので上書き
-                self.char_count_label.config(text="文字数: --") # 文字数ラベルをリセット
+                self._set_result_text(f"エラーが発生しました:\n\n{data}", show_count=False)
 
                 # ステータスラベル更新
                 if "HTTP" in data: status_msg = data.split(":")[0]
@@ -591,23 +1559,25 @@ class PromptGeneratorGUI:
 
 
             # API処理完了後、実行ボタンを再度有効化
+            self.request_token = None
+            self.request_metrics = None
             self.api_execute_button.config(state=NORMAL)
+            self._update_cancel_button()
 
             # 一定時間後にステータスメッセージのみクリア (文字数ラベルはそのまま)
             self.root.after(3000, lambda: self.status_label.config(text="", bootstyle="default"))
 
-        except queue.Empty:
-            pass
         except Exception as e:
              print(f"キュー処理中にエラー発生: {e}")
              try:
                  self.status_label.config(text="内部エラー", bootstyle=DANGER)
                  self.char_count_label.config(text="文字数: --") # エラー時はリセット
+                 self.request_token = None
+                 self.request_metrics = None
                  self.api_execute_button.config(state=NORMAL)
+                 self._update_cancel_button()
              except tk.TclError:
                  pass
-        finally:
-            self.root.after(100, self.process_queue)
 
     def save_result_to_file(self):
         """実行結果テキストをファイルに保存する"""
@@ -641,7 +1611,84 @@ class PromptGeneratorGUI:
             self.root.after(3000, lambda: self.status_label.config(text="", bootstyle="default"))
 
 # --- メイン処理 ---
-if __name__ == "__main__":
+def parse_args(argv=None):
+    """コマンドライン引数を解析する"""
+    parser = argparse.ArgumentParser(description="LLM Report Tool (引数なしで起動するとGUIを表示します)")
+    parser.add_argument("--batch", metavar="JOBS", help="ジョブファイル (JSONL または CSV) を読み込み、GUIなしで一括生成する")
+    parser.add_argument("--output-dir", default="batch_output", help="バッチ実行結果の出力先ディレクトリ (既定: batch_output)")
+    parser.add_argument("--workers", type=int, default=4, help="バッチ実行の同時実行数 (既定: 4)")
+    parser.add_argument("--model", help="ジョブでモデルが指定されていない場合に使用するモデル")
+    parser.add_argument("--no-cache", action="store_true", help="応答キャッシュを使わずに全ジョブを再生成する")
+    parser.add_argument("--stream", action="store_true", help="バッチ実行でストリーミングで受信する (文字数指定のジョブは目標を超えた文末で生成を打ち切る)")
+    parser.add_argument("--session", action="store_true", help="同じ資料のジョブで資料を先頭に置き、プロバイダ側のプロンプトキャッシュを利用する")
+    parser.add_argument("--metrics-summary", action="store_true", help="メトリクスログからモデルごとの応答時間 (p50/p95) を表示して終了する")
+    parser.add_argument("--profile-startup", action="store_true", help="GUIの起動時間 (モジュール読み込み・画面構築・最初の描画) を計測して表示し、終了する")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """エントリポイント。--batch 指定時はヘッドレス実行、それ以外はGUIを起動する"""
+    args = parse_args(argv)
+    if args.metrics_summary:
+        configure_metrics(load_config(interactive=False))
+        summary = summarize_metrics(load_metrics_records())
+        print(format_metrics_summary(summary) if summary else f"メトリクスが記録されていません ('{METRICS_SETTINGS['log_path']}')")
+        return 0
+    if args.batch:
+        config = load_config(interactive=False)
+        configure_all(config)
+        catalog = get_model_catalog()
+        if catalog:
+            catalog.refresh_in_background() # 期限切れなら裏で取り直す (今回のジョブは保存済みのカタログで進める)
+        try:
+            jobs = load_batch_jobs(args.batch)
+        except (OSError, ValueError) as e:
+            print(f"エラー: ジョブファイルを読み込めませんでした: {e}")
+            return 1
+        default_model = args.model or config["models"][0]
+        api_key = os.environ.get("OPENROUTER_API_KEY") or config.get("openrouter_api_key")
+        if not api_key and any(provider_requires_app_key(job.get("model") or default_model) for job in jobs):
+            print(f"エラー: APIキーが設定されていません。'{CONFIG_FILE}' または環境変数 OPENROUTER_API_KEY を確認してください。")
+            return 1
+        succeeded = run_batch(jobs, api_key, args.output_dir, workers=args.workers, default_model=default_model, stream=args.stream,
+                              use_cache=not args.no_cache, fallback_models=config["models"], session_mode=args.session)
+        for snapshot in rate_limiter_snapshots():
+            if snapshot["throttled"] or snapshot["wait_seconds"] >= 1.0:
+                print(f"レート制限 {snapshot['model']}: 送信 {snapshot['requests']} 回 / 429 {snapshot['throttled']} 回 / "
+                      f"待機 {snapshot['wait_seconds']:.1f}秒 / 同時実行数の上限 {snapshot['concurrency_limit']:g}")
+        print(f"完了: {succeeded}/{len(jobs)} 件成功 (出力先: {args.output_dir})")
+        return 0 if succeeded == len(jobs) else 2
+
+    started = time.perf_counter()
     root = ttk.Window(themename="litera")
-    app = PromptGeneratorGUI(root)
-    root.mainloop()
\ No newline at end of file
+    window_created = time.perf_counter()
+    PromptGeneratorGUI(root) # ウィンドウのコールバックから参照されるため、変数に保持しなくてよい
+    gui_built = time.perf_counter()
+    if args.profile_startup:
+        root.update() # ウィンドウの表示と最初の描画を待つ
+        print_startup_profile([
+            ("モジュール読み込み", _MODULE_IMPORTED - _PROCESS_IMPORT_STARTED),
+            ("ウィンドウ作成 (ttkbootstrap・テーマ)", window_created - started),
+            ("画面構築", gui_built - window_created),
+            ("最初の描画", time.perf_counter() - gui_built),
+        ])
+        root.destroy()
+        return 0
+    # 最初の描画の後で通信ライブラリを読み込んでおき、最初の実行を待たせない
+    root.after(500, lambda: threading.Thread(target=get_http_session, daemon=True).start())
+    root.mainloop()
+    return 0
+
+def print_startup_profile(phases):
+    """--profile-startup の計測結果を表示する"""
+    print("起動時間:")
+    for name, seconds in phases:
+        print(f"  {name:<32} {seconds * 1000:8.1f} ms")
+    print(f"  {'合計 (モジュール読み込み開始から)':<32} {sum(seconds for _, seconds in phases) * 1000:8.1f} ms")
+    deferred = {"requests": requests.loaded, "PIL": "PIL" in sys.modules, "pypdf": "pypdf" in sys.modules}
+    print("最初の描画までに読み込まれたモジュール: " + ", ".join(f"{name}={'yes' if loaded else 'no'}" for name, loaded in deferred.items()))
+    print("(import ごとの内訳は python -X importtime llm_report_tool.py --profile-startup で確認できます)")
+
+_MODULE_IMPORTED = time.perf_counter()
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
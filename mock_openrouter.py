@@ -0,0 +1,252 @@
+"""OpenRouter の /api/v1/chat/completions (と /api/v1/models) を模したローカルサーバー (ベンチマーク・動作確認用)
+
+実際のAPIを呼ばずに、応答までの遅延・トークン生成速度・ストリーミング・エラー・429 を再現する。
+
+    python mock_openrouter.py --port 8000 --latency 0.5 --token-rate 50
+    OPENROUTER_API_URL=http://127.0.0.1:8000/api/v1/chat/completions python llm_report_tool.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETIONS_PATH = "/api/v1/chat/completions"
+MODELS_PATH = "/api/v1/models"
+READ_CHUNK = 1024 * 1024
+PARSE_LIMIT = 8 * 1024 * 1024 # これを超えるボディはJSONとして解析せず、先頭・末尾だけを見る
+SAMPLE_TOKENS = ("これは", "ベンチマーク", "用の", "模擬", "応答", "です。", "レポート", "の", "本文", "として", "表示", "されます。")
+
+DEFAULT_MOCK_SETTINGS = {
+    "latency": 0.0,          # 応答ヘッダーを返すまでの遅延 (秒)
+    "token_rate": 0.0,       # 1秒あたりの生成トークン数 (0 は待たずに返す)
+    "completion_tokens": 200,
+    "error_rate": 0.0,       # HTTP 500 を返す確率
+    "rate_limit_rate": 0.0,  # HTTP 429 を返す確率
+    "retry_after": 1,        # 429 に付ける Retry-After (秒)
+    "seed": None
+}
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return # 早期終了・中断でクライアントが接続を切った場合は正常な動作として扱う
+        super().handle_error(request, client_address)
+
+class MockOpenRouterServer:
+    """別スレッドで動く模擬 OpenRouter サーバー (port=0 の場合は空いているポートを使う)"""
+
+    def __init__(self, host="127.0.0.1", port=0, responder=None, models=None, **settings):
+        self.settings = dict(DEFAULT_MOCK_SETTINGS)
+        self.responder = responder # テスト用: リクエストのテキスト要素を連結した文字列を受け取り、応答本文を返す関数
+        self.models = models or [] # テスト用: /api/v1/models の "data" に返すモデルの一覧
+        self.settings.update({k: v for k, v in settings.items() if v is not None})
+        self.random = random.Random(self.settings["seed"])
+        self.random_lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes_received": 0, "errors": 0, "rate_limited": 0, "model_list_requests": 0, "not_modified": 0}
+        self.stats_lock = threading.Lock()
+        self.httpd = _QuietHTTPServer((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{COMPLETIONS_PATH}"
+
+    @property
+    def models_url(self):
+        return self.url.replace(COMPLETIONS_PATH, MODELS_PATH)
+
+    @property
+    def base_url(self):
+        """config.json の providers の base_url に指定するURL (末尾の /chat/completions を除いたもの)"""
+        return self.url.rsplit("/chat/completions", 1)[0]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def roll(self, probability):
+        """probability の確率で True を返す (seed 指定時は再現可能)"""
+        if probability <= 0:
+            return False
+        with self.random_lock:
+            return self.random.random() < probability
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+def _read_request(handler, server):
+    """リクエストボディを読み込み、(stream指定, テキスト要素のリスト) を返す (大きなボディではリストは空)"""
+    remaining = int(handler.headers.get("Content-Length") or 0)
+    head = b""
+    tail = b""
+    size = 0
+    chunks = []
+    while remaining > 0:
+        chunk = handler.rfile.read(min(READ_CHUNK, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        size += len(chunk)
+        if size <= PARSE_LIMIT:
+            chunks.append(chunk)
+            continue
+        if chunks: # 大きな添付ファイルはメモリに保持せず、先頭と末尾だけを残す
+            head = b"".join(chunks)[:64 * 1024]
+            chunks = []
+        elif not head:
+            head = chunk[:64 * 1024]
+        tail = (tail + chunk)[-64 * 1024:]
+    server.count("bytes_received", size)
+    if size <= PARSE_LIMIT:
+        try:
+            body = json.loads(b"".join(chunks))
+        except json.JSONDecodeError:
+            return False, []
+        texts = []
+        for message in body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                texts.append(content)
+            elif isinstance(content, list):
+                texts.extend(item.get("text", "") for item in content if item.get("type") == "text")
+        return bool(body.get("stream")), texts
+    stream = re.search(rb'"stream"\s*:\s*true', head + tail) is not None
+    return stream, []
+
+def _make_handler(server):
+    settings = server.settings
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass # ベンチマーク中の出力を抑える
+
+        def _send_json(self, status, data, extra_headers=None):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (extra_headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") != MODELS_PATH:
+                self._send_json(404, {"error": {"message": f"Not found: {self.path}"}})
+                return
+            server.count("model_list_requests")
+            data = {"data": server.models}
+            etag = '"' + hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag: # 一覧が変わっていなければ本文を返さない
+                server.count("not_modified")
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self._send_json(200, data, {"ETag": etag})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != COMPLETIONS_PATH and not self.path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Not found: {self.path}"}})
+                return
+            stream, texts = _read_request(self, server)
+            server.count("requests")
+            if settings["latency"]:
+                time.sleep(float(settings["latency"]))
+            if server.roll(float(settings["rate_limit_rate"])):
+                server.count("rate_limited")
+                self._send_json(429, {"error": {"message": "Rate limit exceeded (mock)"}},
+                                {"Retry-After": str(settings["retry_after"])})
+                return
+            if server.roll(float(settings["error_rate"])):
+                server.count("errors")
+                self._send_json(500, {"error": {"message": "Internal server error (mock)"}})
+                return
+            if server.responder:
+                content = server.responder("\n".join(texts))
+                tokens = [content[i:i + 8] for i in range(0, len(content), 8)]
+            else:
+                prompt_head = (texts[-1] if texts else "")[:40]
+                tokens = [f"[{prompt_head}] "] + [SAMPLE_TOKENS[i % len(SAMPLE_TOKENS)] for i in range(int(settings["completion_tokens"]))]
+            usage = {"prompt_tokens": 100, "completion_tokens": len(tokens), "total_tokens": 100 + len(tokens)}
+            if stream:
+                self._stream(tokens, usage)
+            else:
+                if settings["token_rate"]:
+                    time.sleep(len(tokens) / float(settings["token_rate"]))
+                self._send_json(200, {"choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}], "usage": usage})
+
+        def _stream(self, tokens, usage):
+            """Server-Sent Events で1トークンずつ送信する (chunked)"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            interval = 1.0 / float(settings["token_rate"]) if settings["token_rate"] else 0.0
+
+            def _write_chunk(payload):
+                self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+
+            def _event(data):
+                _write_chunk(f"data: {data}\n\n".encode("utf-8"))
+
+            try:
+                _write_chunk(b": OPENROUTER PROCESSING\n\n") # 本物と同様のコメント行 (クライアントは無視する)
+                for token in tokens:
+                    if interval:
+                        time.sleep(interval)
+                    _event(json.dumps({"choices": [{"delta": {"content": token}}]}, ensure_ascii=False))
+                _event(json.dumps({"choices": [], "usage": usage}))
+                _event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True # クライアント側で中断された
+
+    return Handler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenRouter chat/completions の模擬サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="待ち受けポート (0 は空いているポート)")
+    parser.add_argument("--latency", type=float, help="応答ヘッダーを返すまでの遅延 (秒)")
+    parser.add_argument("--token-rate", type=float, help="1秒あたりの生成トークン数 (0 は待たない)")
+    parser.add_argument("--completion-tokens", type=int, help="応答のトークン数")
+    parser.add_argument("--error-rate", type=float, help="HTTP 500 を返す確率 (0〜1)")
+    parser.add_argument("--rate-limit-rate", type=float, help="HTTP 429 を返す確率 (0〜1)")
+    parser.add_argument("--retry-after", type=int, help="429 に付ける Retry-After (秒)")
+    parser.add_argument("--seed", type=int, help="エラー発生の乱数シード")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = MockOpenRouterServer(args.host, args.port, latency=args.latency, token_rate=args.token_rate,
+                                  completion_tokens=args.completion_tokens, error_rate=args.error_rate,
+                                  rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, seed=args.seed)
+    print(f"listening on {server.url}", flush=True) # benchmark.py はこの行から URL を読み取る
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""OpenRouter のモデルカタログ (コンテキスト長・入力形式・価格)"""
+import json
+import os
+import threading
+import time
+
+from report_transport import HTTP_SETTINGS, get_http_session, requests
+from report_materials import MULTI_MATERIAL_TYPE, attachment_material_type
+
+# --- モデルカタログ (コンテキスト長・入力形式・価格) ---
+DEFAULT_CATALOG_SETTINGS = {
+    "enabled": True,
+    "url": "https://openrouter.ai/api/v1/models",
+    "cache_path": "model_catalog.json",
+    "ttl_seconds": 86400  # この秒数以内に取得したカタログは再検証しない
+}
+CATALOG_SETTINGS = dict(DEFAULT_CATALOG_SETTINGS)
+_model_catalog = None
+_model_catalog_lock = threading.Lock()
+# 資料の種類ごとにモデルが受け付ける必要のある入力形式 (PDF は native エンジンの場合のみファイル入力が必要)
+MATERIAL_INPUT_MODALITIES = {"画像": "image", "PDF": "file"}
+MODALITY_LABELS = {"text": "テキスト", "image": "画像", "file": "ファイル", "audio": "音声", "video": "動画"}
+
+def configure_model_catalog(config):
+    """設定ファイルの "model_catalog" セクションをモデルカタログに反映する"""
+    global _model_catalog
+    with _model_catalog_lock:
+        CATALOG_SETTINGS.update(DEFAULT_CATALOG_SETTINGS)
+        CATALOG_SETTINGS.update(config.get("model_catalog") or {})
+        _model_catalog = None # 次回利用時に新しい設定で読み込み直す
+
+def get_model_catalog():
+    """共有の ModelCatalog を返す (ディスクのキャッシュを読むだけで通信はしない)。無効な場合は None"""
+    global _model_catalog
+    with _model_catalog_lock:
+        if not CATALOG_SETTINGS.get("enabled"):
+            return None
+        if _model_catalog is None:
+            _model_catalog = ModelCatalog(CATALOG_SETTINGS["url"], CATALOG_SETTINGS["cache_path"], CATALOG_SETTINGS["ttl_seconds"])
+        return _model_catalog
+
+def _parse_catalog_entry(entry):
+    """/api/v1/models の1件を、このツールで使う項目だけの dict にする"""
+    architecture = entry.get("architecture") or {}
+    modalities = architecture.get("input_modalities")
+    if not modalities and architecture.get("modality"): # 例: "text+image->text"
+        modalities = architecture["modality"].split("->")[0].split("+")
+    pricing = entry.get("pricing") or {}
+
+    def _price(key):
+        try:
+            return float(pricing.get(key) or 0)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "name": entry.get("name") or entry.get("id"),
+        "context_length": entry.get("context_length"),
+        "input_modalities": list(modalities or []),
+        "prompt_price": _price("prompt"),         # 1トークンあたりの米ドル
+        "completion_price": _price("completion"),
+        "max_completion_tokens": (entry.get("top_provider") or {}).get("max_completion_tokens")
+    }
+
+class ModelCatalog:
+    """OpenRouter のモデル一覧をディスクにキャッシュし、ETag と TTL で再検証する"""
+
+    def __init__(self, url, cache_path, ttl_seconds):
+        self.url = url
+        self.cache_path = str(cache_path)
+        self.ttl_seconds = float(ttl_seconds or 0)
+        self.models = {}
+        self.etag = None
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return # 初回、または壊れたキャッシュ (次の refresh で取り直す)
+        self.models = data.get("models") or {}
+        self.etag = data.get("etag")
+        self.fetched_at = float(data.get("fetched_at") or 0)
+
+    def _save(self):
+        with self._lock:
+            data = {"fetched_at": self.fetched_at, "etag": self.etag, "models": self.models}
+        temp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_path) # 書き込み途中のファイルを読まないように置き換える
+        except OSError as e:
+            print(f"モデルカタログの保存に失敗しました: {e}")
+
+    @property
+    def is_fresh(self):
+        return bool(self.models) and time.time() - self.fetched_at < self.ttl_seconds
+
+    def get(self, model):
+        """モデルの情報 (dict) を返す。カタログに無い場合は None"""
+        with self._lock:
+            return self.models.get(model)
+
+    def refresh(self, force=False):
+        """期限切れの場合にカタログを取得し直す (ETag があれば条件付きリクエスト)。内容が更新されたら True"""
+        if not force and self.is_fresh:
+            return False
+        headers = {"If-None-Match": self.etag} if self.etag and self.models else {}
+        timeout = (float(HTTP_SETTINGS["connect_timeout"]), 30)
+        response = get_http_session().get(self.url, headers=headers, timeout=timeout)
+        try:
+            if response.status_code == 304: # 変更なし: 取得時刻だけ更新する
+                with self._lock:
+                    self.fetched_at = time.time()
+                self._save()
+                return False
+            response.raise_for_status()
+            entries = response.json().get("data") or []
+            models = {entry["id"]: _parse_catalog_entry(entry) for entry in entries if entry.get("id")}
+            etag = response.headers.get("ETag")
+        finally:
+            response.close()
+        with self._lock:
+            self.models = models
+            self.etag = etag
+            self.fetched_at = time.time()
+        self._save()
+        return True
+
+    def refresh_in_background(self, on_updated=None):
+        """別スレッドで refresh する (起動や画面操作を通信で待たせない)。更新されたら on_updated を呼ぶ"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                if self.refresh() and on_updated:
+                    on_updated()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"モデルカタログを取得できませんでした (保存済みのカタログを使用します): {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_run, daemon=True).start()
+
+def required_input_modality(material_type, pdf_engine):
+    """資料をそのまま送るためにモデルが対応している必要のある入力形式を返す (不要なら None)"""
+    if material_type == "PDF" and pdf_engine != "native":
+        return None # native 以外はOpenRouterまたは手元でテキスト化してから送る
+    return MATERIAL_INPUT_MODALITIES.get(material_type)
+
+def model_supports_material(model, material_type, pdf_engine, attachments=None):
+    """カタログ上、モデルが資料の入力形式に対応しているかを返す (カタログに無いモデルは対応とみなす)
+
+    「複数ファイル」の場合は attachments のすべてのファイルの形式に対応しているかを調べる。
+    """
+    if material_type == MULTI_MATERIAL_TYPE:
+        return all(model_supports_material(model, attachment_material_type(path), pdf_engine) for path in attachments or [])
+    modality = required_input_modality(material_type, pdf_engine)
+    if modality is None:
+        return True
+    catalog = get_model_catalog()
+    info = catalog.get(model) if catalog else None
+    if not info or not info.get("input_modalities"):
+        return True
+    return modality in info["input_modalities"]
+
+def filter_models_for_material(models, material_type, pdf_engine, attachments=None):
+    """資料の入力形式に対応しているモデルだけを返す"""
+    return [model for model in models if model_supports_material(model, material_type, pdf_engine, attachments)]
+
+def format_model_info(model):
+    """モデルのコンテキスト長・価格・入力形式を1行の文字列にまとめる (カタログに無い場合は空文字列)"""
+    catalog = get_model_catalog()
+    info = catalog.get(model) if catalog else None
+    if not info:
+        return ""
+    parts = []
+    if info.get("context_length"):
+        parts.append(f"コンテキスト {int(info['context_length']):,} トークン")
+    prompt_price, completion_price = info.get("prompt_price"), info.get("completion_price")
+    if prompt_price == 0 and completion_price == 0:
+        parts.append("無料")
+    elif prompt_price is not None and completion_price is not None:
+        parts.append(f"入力 ${prompt_price * 1e6:.2f} / 出力 ${completion_price * 1e6:.2f} (100万トークンあたり)")
+    if info.get("input_modalities"):
+        parts.append("入力: " + "・".join(MODALITY_LABELS.get(m, m) for m in info["input_modalities"]))
+    return " / ".join(parts)
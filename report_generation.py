@@ -0,0 +1,1065 @@
+"""レポートの生成 (トークン予算・出力の長さの制御・API呼び出し・フォールバック・分割生成)"""
+import copy
+import fnmatch
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from report_metrics import get_cached_tokens, metrics_span
+from report_transport import (APIRequestError, CancelToken, DEFAULT_PROVIDER, FileDataURL, RequestCancelled, acquire_provider_slot,
+                              get_rate_limiter, post_with_retry, provider_chat_url, provider_headers, requests, resolve_provider)
+from report_materials import (MATERIAL_HEADING, PDF_LOCAL_SETTINGS, PDFTextReference, TONE_OPTIONS, build_instruction_text, chunk_pages,
+                              extract_pdf_text, prepare_payload_attachments)
+from report_catalog import get_model_catalog
+from report_stores import get_response_cache, make_cache_key
+
+# --- 設定ファイルの "token_budget"・"length_control"・"sectioned"・"fallback" セクションの既定値 ---
+DEFAULT_TOKEN_BUDGET_SETTINGS = {
+    "policy": "truncate",            # 上限超過時の処理 (TOKEN_BUDGET_POLICIES のキー)
+    "default_context_tokens": 32768, # context_limits に無いモデルのコンテキスト長
+    "reserve_output_tokens": 4096,   # 出力用に空けておくトークン数
+    "context_limits": {}             # モデルID → コンテキスト長 (トークン)
+}
+DEFAULT_LENGTH_SETTINGS = {
+    "enabled": True,
+    "ceiling_ratio": 1.5,          # max_tokens = 打ち切る文字数 × 1文字あたりのトークン数 × この値
+    "min_tokens": 512,             # max_tokens の下限
+    "early_stop": True,            # ストリーミング時、目標を stop_margin 超えた後の文末で生成を打ち切る
+    "stop_margin": 0.2,            # 目標文字数に対する超過の許容割合
+    "tokens_per_char": {"ja": 1.0, "en": 0.3}, # 記録が無いモデルの1文字あたりの出力トークン数
+    "calibration_samples": 20,     # モデルごとに直近この件数の記録から1文字あたりのトークン数を求める
+    "exclude_models": ["deepseek/deepseek-r1*", "*:thinking"], # 推論にも出力トークンを使うため max_tokens を付けないモデル
+    "log_path": "length_log.jsonl" # 目標と実際の長さの記録
+}
+DEFAULT_SECTIONED_SETTINGS = {
+    "enabled": True,
+    "min_chars": 5000,           # 構成「セクション分け」でこの文字数以上の場合に、構成案 → セクション並列で生成する
+    "min_sections": 3,
+    "max_sections": 8,
+    "workers": 4,                # 同時に生成するセクション数
+    "outline_max_tokens": 1024   # 構成案の出力トークン数の上限
+}
+DEFAULT_FALLBACK_SETTINGS = {
+    "enabled": False,
+    "chain": [],                   # 予備モデルの順番 (空の場合は "models" の並び順)
+    "first_token_deadline": 20.0,  # ストリーミング時、送信からこの秒数内に最初の応答が無ければ次のモデルにも送信する
+    "max_hedges": 2,               # 追加で送信するモデル数の上限
+    "log_path": "fallback_log.jsonl"
+}
+
+# cache_control によるキャッシュ指定に対応するモデル (それ以外のプロバイダは先頭一致で自動的にキャッシュする)
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+# トークン予算超過時の処理 (後ろのものほど強く、前の処理も含めて適用する)
+TOKEN_BUDGET_POLICIES = {
+    "none": "何もしない",
+    "compress": "空白を圧縮",
+    "drop": "空白圧縮＋後方の節を削除",
+    "truncate": "空白圧縮＋節削除＋切り詰め"
+}
+
+# --- トークン予算 ---
+TOKEN_BUDGET_SETTINGS = dict(DEFAULT_TOKEN_BUDGET_SETTINGS)
+IMAGE_TOKEN_ESTIMATE = 1500   # 画像1枚あたりの入力トークン概算
+MESSAGE_TOKEN_OVERHEAD = 8    # メッセージ・コンテンツ要素ごとの書式分
+TRUNCATION_NOTE = "\n…(トークン上限のため以下省略)"
+
+def configure_token_budget(config):
+    """設定ファイルの "token_budget" セクションをトークン予算に反映する"""
+    TOKEN_BUDGET_SETTINGS.update(DEFAULT_TOKEN_BUDGET_SETTINGS)
+    TOKEN_BUDGET_SETTINGS.update(config.get("token_budget") or {})
+
+def estimate_tokens(text):
+    """テキストのトークン数を概算する (日本語など非ASCIIは1文字≒1トークン、ASCIIは4文字≒1トークン)
+
+    UTF-8 のバイト長と文字数の差から非ASCII文字数を求めるため、長い資料でも高速に計算できる。
+    """
+    char_count = len(text)
+    non_ascii = min(char_count, (len(text.encode("utf-8", "surrogatepass")) - char_count) // 2)
+    return non_ascii + (char_count - non_ascii + 3) // 4
+
+def estimate_payload_tokens(payload):
+    """ペイロード全体の入力トークン数を概算する (添付PDFは送信時まで不明のため含まない)"""
+    total = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            total += MESSAGE_TOKEN_OVERHEAD + estimate_tokens(content)
+            continue
+        for item in content or []:
+            total += MESSAGE_TOKEN_OVERHEAD
+            if item.get("type") == "text" and isinstance(item.get("text"), str):
+                total += estimate_tokens(item["text"])
+            elif item.get("type") == "image_url":
+                total += IMAGE_TOKEN_ESTIMATE
+    return total
+
+def get_model_context_limit(model):
+    """モデルのコンテキスト長 (トークン) を返す (context_limits → モデルカタログ → default_context_tokens の順)"""
+    limits = TOKEN_BUDGET_SETTINGS.get("context_limits") or {}
+    if limits.get(model):
+        return int(limits[model])
+    catalog = get_model_catalog()
+    info = catalog.get(model) if catalog else None
+    if info and info.get("context_length"):
+        return int(info["context_length"])
+    return int(TOKEN_BUDGET_SETTINGS["default_context_tokens"])
+
+def get_input_token_budget(model):
+    """出力用の予約分を差し引いた、入力に使えるトークン数を返す"""
+    return max(0, get_model_context_limit(model) - int(TOKEN_BUDGET_SETTINGS["reserve_output_tokens"]))
+
+def _compress_whitespace(text):
+    """連続する空白・空行をまとめる"""
+    text = re.sub(r"[ \t\u3000]+", " ", text)
+    text = re.sub(r" ?\n[ \n]*\n", "\n\n", text)
+    return text.strip()
+
+def _split_sections(text):
+    """資料本文を見出し行・ページ番号行の位置で節に分割する"""
+    return re.split(r"(?m)^(?=#{1,6} |\[p\.\d+\])", text)
+
+def fit_payload_to_budget(payload, budget, policy=None):
+    """資料テキストを調整して推定入力トークン数を budget 以下に収めたペイロードを返す
+
+    調整対象は MATERIAL_HEADING で始まる資料テキストの本文のみで、指示文や見出しは変更しない。
+    戻り値は (ペイロード, {"before": 調整前, "after": 調整後, "applied": [適用した処理]})。
+    """
+    policy = policy or TOKEN_BUDGET_SETTINGS["policy"]
+    steps = list(TOKEN_BUDGET_POLICIES)
+    level = steps.index(policy) if policy in steps else 0
+    before = estimate_payload_tokens(payload)
+    info = {"before": before, "after": before, "applied": []}
+    if before <= budget or level == 0:
+        return payload, info
+
+    payload = copy.deepcopy(payload)
+    # 資料テキストを [要素, 見出し行, 本文] に分けて扱う
+    materials = []
+    for message in payload.get("messages", []):
+        for item in message.get("content") if isinstance(message.get("content"), list) else []:
+            if item.get("type") == "text" and isinstance(item.get("text"), str) and item["text"].startswith(MATERIAL_HEADING):
+                heading_suffix, _, body = item["text"][len(MATERIAL_HEADING):].partition("\n")
+                materials.append([item, MATERIAL_HEADING + heading_suffix, body])
+    if not materials:
+        return payload, info
+
+    def _apply(material, body, truncated=False):
+        material[2] = body
+        material[0]["text"] = f"{material[1]}\n{body}" + (TRUNCATION_NOTE if truncated else "")
+
+    def _excess():
+        return estimate_payload_tokens(payload) - budget
+
+    if level >= steps.index("compress"):
+        for material in materials:
+            _apply(material, _compress_whitespace(material[2]))
+        info["applied"].append("compress")
+    if _excess() > 0 and level >= steps.index("drop"):
+        can_truncate = level >= steps.index("truncate")
+        for material in reversed(materials): # 後ろの資料・後ろの節ほど優先度が低いとみなす
+            # 見出しで始まる資料の先頭の空の断片は節として数えない (最初の節は必ず残す)
+            sections = [section for section in _split_sections(material[2]) if section.strip()]
+            dropped = False
+            while len(sections) > 1 and _excess() > 0:
+                _apply(material, "".join(sections[:-1]).rstrip(), truncated=True)
+                if can_truncate and _excess() <= 0:
+                    # この節を丸ごと削らなくても収まるため、残りは truncate で末尾だけを削る
+                    _apply(material, "".join(sections).rstrip(), truncated=dropped)
+                    break
+                sections.pop()
+                dropped = True
+                if "drop" not in info["applied"]:
+                    info["applied"].append("drop")
+    if _excess() > 0 and level >= steps.index("truncate"):
+        for material in reversed(materials):
+            excess = _excess()
+            if excess <= 0:
+                break
+            body = material[2]
+            # 1文字あたりのトークン数から削る文字数を見積もり、収まるまで少しずつ縮める
+            ratio = max(estimate_tokens(body), 1) / max(len(body), 1)
+            keep = max(0, len(body) - int(excess / ratio) - len(TRUNCATION_NOTE))
+            while True:
+                _apply(material, body[:keep], truncated=True)
+                if keep == 0 or _excess() <= 0:
+                    break
+                keep = max(0, keep - max(64, keep // 20))
+        info["applied"].append("truncate")
+    info["after"] = estimate_payload_tokens(payload)
+    return payload, info
+
+# --- 出力の長さの制御 (max_tokens・早期終了) ---
+LENGTH_SETTINGS = dict(DEFAULT_LENGTH_SETTINGS)
+SENTENCE_END_PATTERN = re.compile(r"[。！？!?\n]|\.(?=\s)") # 早期終了で区切る文末
+ENGLISH_REPORT_PATTERN = re.compile(r"英語|英文|\bin English\b", re.IGNORECASE)
+_length_calibration = None # (モデル, 言語) → 直近の「出力トークン数 / 文字数」のリスト
+_length_log_lock = threading.Lock()
+
+def configure_length_control(config):
+    """設定ファイルの "length_control" セクションを出力の長さの制御に反映する"""
+    global _length_calibration
+    LENGTH_SETTINGS.update(DEFAULT_LENGTH_SETTINGS)
+    LENGTH_SETTINGS.update(config.get("length_control") or {})
+    _length_calibration = None # ログの場所が変わった場合に読み直す
+
+def parse_target_chars(word_count):
+    """文字数の指定 ("800"・"1,200字"・"800〜1000字" など) を目標文字数 (int) にする。数値が無い場合は None"""
+    numbers = [int(n) for n in re.findall(r"\d+", str(word_count or "").replace(",", "").replace("，", ""))]
+    numbers = [n for n in numbers if n > 0]
+    return max(numbers) if numbers else None # 範囲指定は上限を目標とする
+
+def detect_report_language(settings):
+    """レポートの出力言語を推定する (テーマ・意見で英語を指定した場合のみ "en"、それ以外は "ja")"""
+    text = f"{settings.get('theme') or ''}\n{settings.get('opinion') or ''}"
+    return "en" if ENGLISH_REPORT_PATTERN.search(text) else "ja"
+
+def length_target(settings):
+    """レポート設定から目標の長さ {"chars": 文字数, "language": 言語} を返す (文字数が未指定・無効時は None)"""
+    if not LENGTH_SETTINGS.get("enabled"):
+        return None
+    chars = parse_target_chars(settings.get("word_count"))
+    if not chars:
+        return None
+    return {"chars": chars, "language": detect_report_language(settings)}
+
+def _load_length_calibration():
+    """長さのログから、モデル・言語ごとの「出力トークン数 / 文字数」を読み込む (呼び出し側でロックを取る)"""
+    global _length_calibration
+    if _length_calibration is not None:
+        return _length_calibration
+    _length_calibration = {}
+    log_path = LENGTH_SETTINGS.get("log_path")
+    if log_path and os.path.exists(log_path):
+        try:
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        _add_length_sample(json.loads(line))
+                    except (json.JSONDecodeError, AttributeError):
+                        continue # 書きかけの行などは読み飛ばす
+        except OSError as e:
+            print(f"長さのログの読み込みに失敗しました: {e}")
+    return _length_calibration
+
+def _add_length_sample(record):
+    """ログの1件を較正用の値に加える (早期終了・max_tokens で切れた出力は文字数が本来より短いため使わない)"""
+    tokens, chars = record.get("completion_tokens"), record.get("actual_chars")
+    if not tokens or not chars or record.get("stopped_early") or record.get("finish_reason") == "length":
+        return
+    samples = _length_calibration.setdefault((record.get("model"), record.get("language")), [])
+    samples.append(tokens / chars)
+    del samples[:-max(1, int(LENGTH_SETTINGS["calibration_samples"]))]
+
+def get_tokens_per_char(model, language):
+    """モデルが1文字の出力に使うトークン数 (記録の中央値、記録が無い場合は tokens_per_char の既定値)"""
+    with _length_log_lock:
+        samples = sorted(_load_length_calibration().get((model, language)) or [])
+    if samples:
+        return samples[len(samples) // 2]
+    defaults = LENGTH_SETTINGS.get("tokens_per_char") or {}
+    return float(defaults.get(language) or defaults.get("ja") or 1.0)
+
+def length_token_ceiling(model, target):
+    """目標の長さから max_tokens の上限を求める (推論でトークンを使うモデルなど、付けない場合は None)"""
+    if not target or any(fnmatch.fnmatchcase(model or "", pattern) for pattern in LENGTH_SETTINGS.get("exclude_models") or []):
+        return None
+    limit_chars = target["chars"] * (1 + float(LENGTH_SETTINGS["stop_margin"]))
+    tokens = limit_chars * get_tokens_per_char(model, target["language"]) * float(LENGTH_SETTINGS["ceiling_ratio"])
+    return max(int(LENGTH_SETTINGS["min_tokens"]), int(tokens) + 1)
+
+def early_stop_chars(target):
+    """ストリーミング時に生成を打ち切る文字数 (この文字数を超えた後の最初の文末で止める)。無効時は None"""
+    if not target or not LENGTH_SETTINGS.get("early_stop"):
+        return None
+    return int(target["chars"] * (1 + float(LENGTH_SETTINGS["stop_margin"])))
+
+def record_length_result(model, target, result, max_tokens=None):
+    """目標と実際の長さを1行のJSONとしてログに追記し、以降の max_tokens の計算に反映する"""
+    usage = result.get("usage") or {}
+    record = {
+        "timestamp": time.time(),
+        "model": model,
+        "language": target["language"],
+        "target_chars": target["chars"],
+        "actual_chars": len(result.get("content") or ""),
+        "completion_tokens": usage.get("completion_tokens"),
+        "max_tokens": max_tokens,
+        "finish_reason": result.get("finish_reason"),
+        "stopped_early": bool(result.get("stopped_early"))
+    }
+    log_path = LENGTH_SETTINGS.get("log_path")
+    with _length_log_lock:
+        _load_length_calibration()
+        _add_length_sample(record)
+        if not log_path:
+            return
+        try:
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"長さのログの書き込みに失敗しました: {e}")
+
+# --- API呼び出し (添付ファイルの準備・キャッシュ・ストリーミング受信) ---
+def adapt_payload_for_provider(payload, provider):
+    """プロバイダが対応していない機能をペイロードから取り除く (元のペイロードは変更しない)
+
+    plugins (file-parser) に対応していないプロバイダでは、添付PDFを手元で抽出したテキスト
+    (PDFTextReference) に置き換え、送信直前に resolve_local_pdf_text で展開させる。
+    """
+    if provider.get("supports_plugins") or "plugins" not in payload:
+        return payload
+    adapted = {key: value for key, value in payload.items() if key != "plugins"}
+    messages = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                data_url = item.get("file", {}).get("file_data") if item.get("type") == "file" else None
+                if isinstance(data_url, FileDataURL) and data_url.mime_type == "application/pdf":
+                    item = dict(item, type="text", text=PDFTextReference(data_url.path))
+                    del item["file"]
+                items.append(item)
+            message = dict(message, content=items)
+        messages.append(message)
+    adapted["messages"] = messages
+    return adapted
+
+def request_completion(api_key, payload, stream=False, on_first_token=None, on_delta=None, on_retry=None, use_cache=True, on_status=None,
+                       max_retries=None, cancel_token=None, metrics=None, on_attachment=None, target=None):
+    """chat/completions を呼び出し、生成結果を dict で返す
+
+    添付ファイルは送信前に prepare_payload_attachments で並列に準備 (画像は縮小・再エンコード) され、
+    資料テキストは fit_payload_to_budget でモデルの入力上限に収まるよう調整される。
+    on_attachment(パス, 状態, 詳細) には添付ファイルごとの準備の進捗が渡される。
+    同一ペイロードの応答がキャッシュにあればAPIを呼ばずに返す ("cached": True)。
+    stream=True の場合は Server-Sent Events を読み取り、差分ごとに on_delta を呼び出す。
+    429/5xx は post_with_retry で再試行され、最終的な失敗時は APIRequestError を送出する。
+    metrics (RequestMetrics) を渡すと各段階の所要時間と通信量が記録される。
+    target (length_target の戻り値) を渡すと目標の長さから max_tokens を付け、ストリーミング時は
+    目標を超えた後の文末で生成を打ち切る ("stopped_early": True)。目標と実際の長さは記録される。
+    """
+    payload = prepare_request_payload(api_key, payload, on_status, on_retry, use_cache, cancel_token, metrics, on_attachment, target)
+    return _complete_prepared(api_key, payload, stream, on_first_token, on_delta, on_retry, use_cache, on_status, max_retries,
+                              cancel_token, metrics, target)
+
+def prepare_request_payload(api_key, payload, on_status=None, on_retry=None, use_cache=True, cancel_token=None, metrics=None,
+                            on_attachment=None, target=None):
+    """送信前の準備 (max_tokens・プロバイダ非対応の機能の除去・添付ファイル・PDFテキスト・トークン予算) を済ませたペイロードを返す
+
+    準備済みのペイロードを別のモデル向けに渡し直した場合、添付ファイルの前処理と抽出済みのPDFテキストは再利用される。
+    """
+    max_tokens = length_token_ceiling(payload.get("model"), target)
+    if max_tokens and "max_tokens" not in payload:
+        payload = dict(payload, max_tokens=max_tokens)
+    payload = adapt_payload_for_provider(payload, resolve_provider(payload.get("model"))[1])
+    with metrics_span(metrics, "image_preprocess"):
+        payload = prepare_payload_attachments(payload, on_status, on_attachment, compute_digests=use_cache)
+    with metrics_span(metrics, "pdf_local"):
+        payload = resolve_local_pdf_text(api_key, payload, on_status, on_retry, use_cache, cancel_token, metrics, on_attachment)
+    budget = get_input_token_budget(payload.get("model"))
+    with metrics_span(metrics, "token_budget"):
+        payload, budget_info = fit_payload_to_budget(payload, budget)
+    if budget_info["applied"] and on_status:
+        on_status(f"資料を調整しました (推定入力 {budget_info['before']:,} → {budget_info['after']:,} / 上限 {budget:,} トークン)")
+    if budget_info["after"] > budget and TOKEN_BUDGET_SETTINGS["policy"] != "none":
+        raise APIRequestError(f"推定入力トークン数 ({budget_info['after']:,}) がモデルの上限 ({budget:,}) を超えています。資料を減らすか、別のモデルを選択してください。")
+    return payload
+
+def _complete_prepared(api_key, payload, stream=False, on_first_token=None, on_delta=None, on_retry=None, use_cache=True, on_status=None,
+                       max_retries=None, cancel_token=None, metrics=None, target=None, on_send=None):
+    """prepare_request_payload で準備済みのペイロードを、応答キャッシュを介して送信する"""
+    cache = get_response_cache() if use_cache else None
+    if cache:
+        try:
+            with metrics_span(metrics, "cache_lookup"):
+                cache_key = make_cache_key(payload)
+                cached_content = cache.get(cache_key)
+        except sqlite3.Error as e:
+            print(f"キャッシュ読み込みエラー: {e}")
+            cached_content = None
+        if cached_content is not None:
+            return {"content": cached_content, "ttft": None, "elapsed": 0.0, "usage": None, "cached": True}
+
+    result = _request_completion_uncached(api_key, payload, stream, on_first_token, on_delta, on_retry, max_retries, cancel_token, metrics,
+                                          early_stop_chars(target) if stream else None, on_status, on_send)
+    if target:
+        record_length_result(payload.get("model"), target, result, payload.get("max_tokens"))
+    if cache and not result.get("stopped_early"): # 打ち切った出力は、キャッシュから返すと完全な結果と区別できない
+        try:
+            cache.put(cache_key, payload.get("model"), result["content"])
+        except sqlite3.Error as e:
+            print(f"キャッシュ書き込みエラー: {e}")
+    return result
+
+PDF_MAP_PROMPT = (
+    "以下は資料「{filename}」の一部 ({index}/{total}) です。\n"
+    "後でこの資料全体を基にレポートを作成するため、この部分に含まれる重要な事実・主張・数値・用語を、"
+    "原文の意味を変えずに箇条書きで簡潔にまとめてください。要約以外の文章は出力しないでください。\n\n"
+    "## 資料 ({index}/{total})\n{chunk}"
+)
+
+def resolve_local_pdf_text(api_key, payload, on_status=None, on_retry=None, use_cache=True, cancel_token=None, metrics=None,
+                           on_attachment=None):
+    """ペイロード内の PDFTextReference を抽出テキストに置き換えたコピーを返す
+
+    抽出テキストが max_direct_chars を超える場合は、チャンクごとの要約を並列に生成し (map)、
+    その要約を資料としてレポートを生成する (reduce は呼び出し元の通常のリクエスト)。
+    """
+    prepared = None
+    for message_index, message in enumerate(payload.get("messages", [])):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for item_index, item in enumerate(content):
+            reference = item.get("text")
+            if not isinstance(reference, PDFTextReference):
+                continue
+            if on_attachment:
+                on_attachment(reference.path, "テキスト抽出中", "")
+            pages = extract_pdf_text(reference.path, on_status)
+            full_text = "\n".join(text.strip() for text in pages if text.strip())
+            if not full_text:
+                if on_attachment:
+                    on_attachment(reference.path, "エラー", "テキストなし")
+                raise APIRequestError(f"PDF「{reference.filename}」からテキストを抽出できませんでした (画像のみのPDFの可能性があります)。")
+            if on_attachment:
+                on_attachment(reference.path, "完了", f"{len(full_text):,}字")
+            if len(full_text) <= int(PDF_LOCAL_SETTINGS["max_direct_chars"]):
+                material_text = f"{MATERIAL_HEADING}\n{full_text}"
+            else:
+                summaries = _summarize_pdf_chunks(api_key, payload.get("model"), reference.filename, pages, on_status, on_retry, use_cache,
+                                                  cancel_token, metrics)
+                material_text = f"{MATERIAL_HEADING} (分割要約)\n" + "\n\n".join(summaries)
+            if prepared is None:
+                prepared = copy.deepcopy(payload)
+            prepared["messages"][message_index]["content"][item_index] = dict(item, text=material_text)
+    return prepared if prepared is not None else payload
+
+def _summarize_pdf_chunks(api_key, model, filename, pages, on_status=None, on_retry=None, use_cache=True, cancel_token=None, metrics=None):
+    """PDFテキストをチャンクに分割し、各チャンクの要約を並列に生成して順番通りに返す"""
+    chunks = chunk_pages(pages, int(PDF_LOCAL_SETTINGS["chunk_chars"]))
+    total = len(chunks)
+    summaries = [None] * total
+    done = 0
+    if on_status:
+        on_status(f"資料を{total}個に分割して要約中 (0/{total})...")
+    with ThreadPoolExecutor(max_workers=max(1, int(PDF_LOCAL_SETTINGS["map_workers"]))) as executor:
+        futures = {}
+        for index, chunk in enumerate(chunks):
+            map_payload = {
+                "model": model,
+                "messages": [{"role": "user", "content": [{"type": "text", "text": PDF_MAP_PROMPT.format(
+                    filename=filename, index=index + 1, total=total, chunk=chunk)}]}]
+            }
+            futures[executor.submit(request_completion, api_key, map_payload, on_retry=on_retry, use_cache=use_cache,
+                                    cancel_token=cancel_token, metrics=metrics)] = index
+        for future in as_completed(futures):
+            summaries[futures[future]] = future.result()["content"].strip()
+            done += 1
+            if on_status:
+                on_status(f"資料を{total}個に分割して要約中 ({done}/{total})...")
+    return [f"### 部分 {index + 1}/{total}\n{summary}" for index, summary in enumerate(summaries)]
+
+def supports_cache_control(model):
+    """モデルが cache_control によるプロンプトキャッシュの指定に対応しているかを返す"""
+    return bool(model) and model.startswith(PROMPT_CACHE_MODEL_PREFIXES)
+
+def strip_cache_control(payload):
+    """cache_control を取り除いたペイロードを返す (該当がなければ元のペイロード)
+
+    添付ファイル (FileDataURL) を複製しないよう、変更するメッセージと要素だけをコピーする。
+    """
+    messages = payload.get("messages") or []
+    if not any(isinstance(m.get("content"), list) and any("cache_control" in item for item in m["content"]) for m in messages):
+        return payload
+    stripped = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            message = dict(message, content=[{k: v for k, v in item.items() if k != "cache_control"} for item in content])
+        stripped.append(message)
+    return dict(payload, messages=stripped)
+
+def _request_completion_uncached(api_key, payload, stream=False, on_first_token=None, on_delta=None, on_retry=None,
+                                 max_retries=None, cancel_token=None, metrics=None, stop_after_chars=None, on_status=None, on_send=None):
+    """キャッシュを介さずに、モデルに対応するプロバイダの chat/completions を呼び出す
+
+    モデルごとのレート制限 (get_rate_limiter) の枠が空くまでは送信せずに待つ。
+    on_send() は枠を得て送信を始める直前に呼ばれる。
+    """
+    model = payload.get("model")
+    provider_name, provider = resolve_provider(model)
+    if not (provider.get("supports_cache_control") and (provider_name != DEFAULT_PROVIDER or supports_cache_control(model))):
+        payload = strip_cache_control(payload) # 非対応のプロバイダには送らない
+    payload = dict(payload)
+    if provider.get("strip_prefix") and model and model.startswith(provider["strip_prefix"]):
+        payload["model"] = model[len(provider["strip_prefix"]):]
+    if stream:
+        payload["stream"] = True
+    # 応答にトークン使用量を含めてもらう
+    if provider.get("usage") == "openrouter":
+        payload["usage"] = {"include": True}
+    elif provider.get("usage") == "stream_options" and stream:
+        payload["stream_options"] = {"include_usage": True}
+    headers = provider_headers(provider_name, provider, api_key)
+    slot = acquire_provider_slot(provider_name, cancel_token)
+    rate_limiter = get_rate_limiter(model)
+    if rate_limiter:
+        try:
+            with metrics_span(metrics, "rate_limit_wait"):
+                rate_limiter.acquire(cancel_token, on_status)
+        except RequestCancelled:
+            if slot is not None:
+                slot.release()
+            raise
+    succeeded = False
+    response = None
+    try:
+        start_time = time.perf_counter()
+        if on_send:
+            on_send()
+        # 受信中に中断できるよう、非ストリーミングでも本文は逐次読み込む
+        response = post_with_retry(provider_chat_url(provider), headers, payload, stream=True, on_retry=on_retry,
+                                   max_retries=max_retries, cancel_token=cancel_token, metrics=metrics,
+                                   rate_limiter=rate_limiter, on_status=on_status)
+        del payload # 以降は送信内容を保持しない
+        if not response.ok:
+            try:
+                error_data = response.json()
+                error_message = error_data.get("error", {}).get("message", response.text)
+            except json.JSONDecodeError:
+                error_message = response.text
+            raise APIRequestError(f"APIエラー (HTTP {response.status_code}): {error_message}")
+
+        if stream:
+            with metrics_span(metrics, "stream"):
+                result = _consume_sse_stream(response, start_time, on_first_token, on_delta, cancel_token, stop_after_chars)
+            succeeded = True
+            return result
+
+        with metrics_span(metrics, "download"):
+            body = _read_response_body(response, cancel_token)
+        with metrics_span(metrics, "parse"):
+            response_data = json.loads(body)
+        if response_data.get("choices") and len(response_data["choices"]) > 0:
+            content = response_data["choices"][0].get("message", {}).get("content")
+            if not content:
+                raise APIRequestError("APIレスポンスに有効な 'content' が見つかりませんでした。")
+            succeeded = True
+            return {"content": content, "ttft": None, "elapsed": time.perf_counter() - start_time,
+                    "usage": response_data.get("usage"), "finish_reason": response_data["choices"][0].get("finish_reason")}
+        error_details = response_data.get("error", {}).get("message", f"予期しない応答形式:\n{response_data}")
+        raise APIRequestError(f"APIエラー: {error_details}")
+    except requests.exceptions.Timeout:
+        if cancel_token and cancel_token.cancelled:
+            raise RequestCancelled()
+        raise APIRequestError("APIリクエストがタイムアウトしました。")
+    except requests.exceptions.RequestException as e:
+        if cancel_token and cancel_token.cancelled: # 中断で接続を閉じたことによる例外
+            raise RequestCancelled()
+        raise APIRequestError(f"ネットワーク通信エラーが発生しました: {e}")
+    except json.JSONDecodeError:
+        raise APIRequestError("APIからの応答をJSONとして解析できませんでした。")
+    finally:
+        if rate_limiter:
+            rate_limiter.release(succeeded)
+        if slot is not None:
+            slot.release()
+        if metrics is not None and response is not None:
+            metrics.add_bytes(received=response.raw.tell()) # 受信した本文のバイト数 (圧縮時は圧縮後)
+
+def _read_response_body(response, cancel_token=None):
+    """レスポンス本文をチャンクごとに読み込む (中断された場合は RequestCancelled)"""
+    if cancel_token:
+        cancel_token.attach(response)
+    try:
+        chunks = []
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if cancel_token and cancel_token.cancelled:
+                raise RequestCancelled()
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8")
+    except APIRequestError:
+        raise
+    except Exception:
+        if cancel_token and cancel_token.cancelled:
+            raise RequestCancelled()
+        raise
+    finally:
+        if cancel_token:
+            cancel_token.detach(response)
+        response.close()
+
+def _consume_sse_stream(response, start_time, on_first_token=None, on_delta=None, cancel_token=None, stop_after_chars=None):
+    """Server-Sent Events 形式のレスポンスを読み取り、差分をコールバックに渡す
+
+    stop_after_chars を渡すと、出力がその文字数を超えた後の最初の文末で受信を打ち切る
+    (接続を閉じるとプロバイダ側の生成も止まる)。
+    """
+    response.encoding = "utf-8" # text/event-stream は charset 指定がない場合がある
+    ttft = None
+    usage = None
+    finish_reason = None
+    stopped_early = False
+    received_chars = 0
+    parts = []
+    if cancel_token:
+        cancel_token.attach(response)
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if cancel_token and cancel_token.cancelled:
+                raise RequestCancelled()
+            # 空行 (イベント区切り) や ": OPENROUTER PROCESSING" 等のコメント行は無視
+            if not line or line.startswith(":") or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                error_message = chunk["error"].get("message", str(chunk["error"]))
+                raise APIRequestError(f"APIエラー: {error_message}")
+            if chunk.get("usage"): # 使用量は最後のチャンクに含まれる
+                usage = chunk["usage"]
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            finish_reason = choices[0].get("finish_reason") or finish_reason
+            delta = choices[0].get("delta", {}).get("content")
+            if not delta:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - start_time
+                if on_first_token:
+                    on_first_token(ttft)
+            if stop_after_chars is not None and received_chars + len(delta) > stop_after_chars:
+                # 打ち切る文字数を超えた部分に文末があれば、その直後で止める
+                boundary = SENTENCE_END_PATTERN.search(delta, max(0, stop_after_chars - received_chars))
+                if boundary:
+                    delta = delta[:boundary.end()]
+                    stopped_early = True
+            received_chars += len(delta)
+            parts.append(delta)
+            if on_delta:
+                on_delta(delta)
+            if stopped_early:
+                break
+    except APIRequestError:
+        raise
+    except Exception:
+        if cancel_token and cancel_token.cancelled: # 別スレッドから接続を閉じられた
+            raise RequestCancelled()
+        raise
+    finally:
+        if cancel_token:
+            cancel_token.detach(response)
+        response.close()
+
+    if not parts:
+        raise APIRequestError("APIレスポンスに有効な 'content' が見つかりませんでした。")
+    result = {"content": "".join(parts), "ttft": ttft, "elapsed": time.perf_counter() - start_time, "usage": usage,
+              "finish_reason": finish_reason}
+    if stopped_early:
+        result["stopped_early"] = True
+    return result
+
+# --- フォールバック・ヘッジリクエスト ---
+FALLBACK_SETTINGS = dict(DEFAULT_FALLBACK_SETTINGS)
+_fallback_log_lock = threading.Lock()
+
+def configure_fallback(config):
+    """設定ファイルの "fallback" セクションをフォールバック処理に反映する"""
+    FALLBACK_SETTINGS.update(DEFAULT_FALLBACK_SETTINGS)
+    FALLBACK_SETTINGS.update(config.get("fallback") or {})
+
+def get_fallback_chain(primary_model, available_models):
+    """主モデルを先頭に、フォールバック先を順に並べたモデルのリストを返す (無効時は主モデルのみ)"""
+    if not FALLBACK_SETTINGS.get("enabled"):
+        return [primary_model]
+    candidates = FALLBACK_SETTINGS.get("chain") or available_models
+    chain = [primary_model] + [m for m in candidates if m != primary_model and m != "(モデルなし)"]
+    return chain[:1 + max(0, int(FALLBACK_SETTINGS["max_hedges"]))]
+
+def _record_fallback_run(record):
+    """フォールバック実行の結果を1行のJSONとしてログに追記する"""
+    log_path = FALLBACK_SETTINGS.get("log_path")
+    if not log_path:
+        return
+    try:
+        with _fallback_log_lock, open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"フォールバックログの書き込みに失敗しました: {e}")
+
+def request_with_fallback(api_key, payload, models, stream=False, on_first_token=None, on_delta=None, on_retry=None,
+                          use_cache=True, on_status=None, cancel_token=None, metrics=None, on_attachment=None, target=None):
+    """フォールバックチェーンを使ってリクエストし、最初に成功したモデルの結果を返す
+
+    ストリーミング時に主モデルが送信から first_token_deadline 秒以内に最初の応答を返さない場合、
+    または失敗した場合は、次のモデルにも同じリクエストを送る (ヘッジ)。非ストリーミングでは最初の応答を
+    検知できないため、失敗した場合のみ切り替える。最初に応答を返したモデルを採用し、残りは中断する。
+    資料の準備 (添付ファイル・PDFテキスト・トークン予算) はチェーンの開始前に1回だけ行い、ヘッジは送信のみを繰り返す。
+    on_retry は準備中のリクエスト (PDFの分割要約) に渡される (各試行は再試行せずに次のモデルに切り替える)。
+    結果には採用モデル ("model") と各試行の記録 ("fallback") が含まれる。
+    """
+    if len(models) <= 1:
+        result = request_completion(api_key, dict(payload, model=models[0]), stream=stream, on_first_token=on_first_token,
+                                    on_delta=on_delta, on_retry=on_retry, use_cache=use_cache, on_status=on_status,
+                                    cancel_token=cancel_token, metrics=metrics, on_attachment=on_attachment, target=target)
+        result["model"] = models[0]
+        return result
+
+    deadline = float(FALLBACK_SETTINGS["first_token_deadline"]) if stream else None
+    prepared = prepare_request_payload(api_key, dict(payload, model=models[0]), on_status, on_retry, use_cache, cancel_token, metrics,
+                                       on_attachment, target)
+    events = queue.Queue()
+    attempts = []
+    start_time = time.perf_counter()
+
+    def _launch(model):
+        index = len(attempts)
+        token = CancelToken(parent=cancel_token) # 全体の中断で各試行も中断される
+        attempts.append({"model": model, "token": token, "status": "running", "ttft": None,
+                         "started_at": time.perf_counter() - start_time, "sent_at": None})
+
+        def _run():
+            try:
+                attempt_payload = prepared
+                if index > 0:
+                    attempt_payload = dict(prepared, model=model)
+                    if "max_tokens" not in payload:
+                        attempt_payload.pop("max_tokens", None) # 目標の長さから付けた上限はモデルごとに求め直す
+                    # 準備済みの添付ファイル・PDFテキストは再利用され、モデルごとの上限とプロバイダの違いだけが反映される
+                    attempt_payload = prepare_request_payload(api_key, attempt_payload, on_status, on_retry, use_cache, token, metrics,
+                                                              on_attachment, target)
+                # 試行ごとの再試行は行わず、失敗したら次のモデルに切り替える
+                result = _complete_prepared(api_key, attempt_payload, stream,
+                                            on_first_token=lambda ttft: events.put(("first_token", index, None)),
+                                            on_delta=lambda delta: events.put(("delta", index, delta)), on_retry=on_retry,
+                                            use_cache=use_cache, on_status=on_status, max_retries=0, cancel_token=token,
+                                            metrics=metrics, target=target, on_send=lambda: events.put(("sent", index, None)))
+                events.put(("done", index, result))
+            except APIRequestError as e:
+                events.put(("error", index, e))
+            except Exception as e:
+                events.put(("error", index, APIRequestError(f"予期せぬエラーが発生しました: {e}")))
+
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _choose(index):
+        for other_index, attempt in enumerate(attempts):
+            if other_index != index:
+                attempt["token"].cancel()
+                if attempt["status"] == "running":
+                    attempt["status"] = "cancelled"
+
+    def _finish(winner_index, outcome):
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "chain": models,
+            "winner": attempts[winner_index]["model"] if winner_index is not None else None,
+            "hedged": len(attempts) > 1,
+            "saved": winner_index is not None and winner_index > 0, # 主モデル以外が採用された
+            "outcome": outcome,
+            "elapsed": time.perf_counter() - start_time,
+            "attempts": [{k: v for k, v in attempt.items() if k != "token"} for attempt in attempts]
+        }
+        _record_fallback_run(record)
+        return record
+
+    winner = None
+    next_model = 1
+    last_sent = None # 最後に起動した試行の送信時刻 (締め切りはここから数える)
+    last_error = None
+    _launch(models[0])
+    while True:
+        if cancel_token and cancel_token.cancelled:
+            _choose(-1)
+            _finish(None, "cancelled")
+            raise RequestCancelled()
+        can_hedge = deadline is not None and last_sent is not None and winner is None and next_model < len(models)
+        timeout = min(0.5, max(0.0, last_sent + deadline - time.perf_counter())) if can_hedge else 0.5
+        try:
+            kind, index, data = events.get(timeout=timeout)
+        except queue.Empty:
+            if can_hedge and time.perf_counter() - last_sent >= deadline:
+                if on_status:
+                    on_status(f"{deadline:g}秒以内に応答が無いため {models[next_model]} にも送信します...")
+                _launch(models[next_model])
+                next_model += 1
+                last_sent = None
+            continue
+        attempt = attempts[index]
+        if winner is not None and index != winner:
+            continue # 中断済みの試行からのメッセージ
+        if kind == "sent":
+            attempt["sent_at"] = time.perf_counter() - start_time
+            if index == len(attempts) - 1:
+                last_sent = time.perf_counter()
+        elif kind == "first_token":
+            attempt["ttft"] = time.perf_counter() - start_time
+            winner = index
+            _choose(index)
+            if on_first_token:
+                on_first_token(attempt["ttft"])
+        elif kind == "delta":
+            if on_delta:
+                on_delta(data)
+        elif kind == "done":
+            if winner is None:
+                winner = index
+                _choose(index)
+            attempt["status"] = "ok"
+            data["model"] = attempt["model"]
+            data["fallback"] = _finish(winner, "ok")
+            if attempt["ttft"] is not None:
+                data["ttft"] = attempt["ttft"] # 利用者から見た最初の応答までの時間
+            data["elapsed"] = time.perf_counter() - start_time
+            return data
+        elif kind == "error":
+            attempt["status"] = "error"
+            attempt["error"] = str(data)
+            last_error = data
+            if winner == index: # 出力の途中で失敗した場合は切り替えられない
+                _finish(winner, "error")
+                raise data
+            if next_model < len(models):
+                if on_status:
+                    on_status(f"{attempt['model']} が失敗したため {models[next_model]} に切り替えます...")
+                _launch(models[next_model])
+                next_model += 1
+                last_sent = None
+            elif all(a["status"] != "running" for a in attempts):
+                _finish(None, "error")
+                raise last_error
+
+def format_result_stats(result):
+    """生成結果の所要時間・文字数・トークン使用量を1行の文字列にまとめる"""
+    parts = []
+    if result.get("fallback", {}).get("saved"):
+        parts.append(f"採用: {result['model']}")
+    if result.get("cached"):
+        parts.append("キャッシュ")
+    if result.get("sections"):
+        parts.append(f"{len(result['sections'])}セクション並列")
+    if result.get("ttft") is not None:
+        parts.append(f"TTFT {result['ttft']:.2f}秒")
+    parts.append(f"合計 {result.get('elapsed', 0.0):.2f}秒")
+    parts.append(f"{len(result.get('content') or ''):,}字")
+    if result.get("stopped_early"):
+        parts.append("目標の長さで打ち切り")
+    elif result.get("finish_reason") == "length":
+        parts.append("出力上限で終了")
+    usage = result.get("usage") or {}
+    if usage:
+        parts.append(f"入力 {usage.get('prompt_tokens', 0):,} / 出力 {usage.get('completion_tokens', 0):,} トークン")
+        cached_tokens = get_cached_tokens(usage)
+        if cached_tokens:
+            parts.append(f"キャッシュ済み入力 {cached_tokens:,} トークン")
+    return " / ".join(parts)
+
+# --- 長いレポートの分割生成 (構成案 → セクションの並列生成) ---
+SECTIONED_SETTINGS = dict(DEFAULT_SECTIONED_SETTINGS)
+SECTIONED_STRUCTURE = "セクション分け"
+
+OUTLINE_INSTRUCTION = (
+    "以下の条件のレポートを、複数の担当者が見出しごとに分担して執筆します。執筆の前に構成案を作成してください。\n\n"
+    "## 条件\n"
+    "* **テーマ:** 「{theme}」\n"
+    "* **全体の文字数:** 「{chars}字」程度\n"
+    "* **セクション数:** {min_sections}〜{max_sections}\n"
+    "{opinion}"
+    "\n## 出力形式\n"
+    "次の形式のJSONのみを出力してください (説明文やコードブロックの記号は不要です)。\n"
+    '{{"sections": [{{"heading": "見出し", "points": "このセクションで扱う内容の要点 (1〜2文)", "chars": 文字数}}]}}\n'
+    "* 各セクションの chars の合計が全体の文字数とほぼ等しくなるようにしてください。\n"
+    "* セクション間で内容が重複しないように要点を割り振ってください。"
+)
+SECTION_INSTRUCTION = (
+    "以下の構成のレポートのうち、{index}番目のセクション「{heading}」だけを執筆してください。\n\n"
+    "## レポート全体の条件\n"
+    "* **テーマ:** 「{theme}」\n"
+    "* **文体:**\n"
+    "    * 平易な言葉遣いを心がけ、専門用語や難解な語彙の多用は避けてください。\n"
+    "    * 口調は「{tone}」を使用してください。\n"
+    "{opinion}"
+    "\n## レポート全体の構成\n{outline}\n"
+    "\n## このセクションの条件\n"
+    "* **見出し:** 「{heading}」\n"
+    "* **扱う内容:** {points}\n"
+    "* **文字数:** 「{chars}字」程度\n"
+    "    * 指定文字数を大幅に超えたり、不足したりしないように注意してください。\n"
+    "\n## 出力に関する厳守事項\n"
+    "* 1行目に「## {heading}」と見出しを書き、続けてこのセクションの本文のみを書いてください。\n"
+    "* 他のセクションの内容や、レポート全体の前置き・まとめ・結びの挨拶は書かないでください。\n"
+    "* 「承知しました」といった応答や、本文以外の説明は一切含めないでください。\n"
+    "\n## セクション執筆開始"
+)
+
+def configure_sectioned(config):
+    """設定ファイルの "sectioned" セクションを分割生成に反映する"""
+    SECTIONED_SETTINGS.update(DEFAULT_SECTIONED_SETTINGS)
+    SECTIONED_SETTINGS.update(config.get("sectioned") or {})
+
+def should_generate_sectioned(settings):
+    """構成が「セクション分け」で、目標文字数が min_chars 以上の場合に分割生成するかを返す"""
+    if not SECTIONED_SETTINGS.get("enabled") or settings.get("structure") != SECTIONED_STRUCTURE:
+        return False
+    chars = parse_target_chars(settings.get("word_count"))
+    return bool(chars) and chars >= int(SECTIONED_SETTINGS["min_chars"])
+
+def replace_instruction(payload, settings, text):
+    """build_api_payload で作ったペイロードの指示文を text に差し替えたコピーを返す (資料はそのまま共有する)"""
+    instruction = build_instruction_text(settings)
+    messages = []
+    replaced = False
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if item.get("type") == "text" and item.get("text") == instruction:
+                    item = dict(item, text=text)
+                    replaced = True
+                items.append(item)
+            message = dict(message, content=items)
+        messages.append(message)
+    if not replaced:
+        raise ValueError("ペイロードに指示文が見つかりません。")
+    return dict(payload, messages=messages)
+
+def _opinion_lines(settings):
+    opinion = (settings.get("opinion") or "").strip()
+    return f"* **指示者の意見・視点:**\n{opinion}\n" if opinion else ""
+
+def parse_outline(text, total_chars):
+    """構成案のJSONを [{"heading", "points", "chars"}] にする (文字数は合計が total_chars になるよう配分し直す)
+
+    JSONとして読めない場合や、セクションが min_sections 未満の場合は ValueError を送出する。
+    """
+    match = re.search(r"\{.*\}", text or "", re.DOTALL) # コードブロックや前置きが付いていても本体だけを読む
+    if not match:
+        raise ValueError("構成案にJSONが含まれていません。")
+    data = json.loads(match.group(0))
+    sections = []
+    for section in (data.get("sections") or [])[:int(SECTIONED_SETTINGS["max_sections"])]:
+        heading = str(section.get("heading") or "").strip().lstrip("#").strip()
+        if not heading:
+            continue
+        try:
+            chars = max(0.0, float(section.get("chars") or 0))
+        except (TypeError, ValueError):
+            chars = 0.0
+        sections.append({"heading": heading, "points": str(section.get("points") or "").strip(), "chars": chars})
+    if len(sections) < int(SECTIONED_SETTINGS["min_sections"]):
+        raise ValueError(f"構成案のセクションが少なすぎます ({len(sections)}件)。")
+    weights = [section["chars"] for section in sections]
+    if not all(weights):
+        weights = [1.0] * len(sections) # 文字数が無い・0 のものがあれば均等に割り振る
+    for section, weight in zip(sections, weights):
+        section["chars"] = max(100, int(round(total_chars * weight / sum(weights), -1)))
+    return sections
+
+def _add_usage(total, usage):
+    for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        if usage and usage.get(key) is not None:
+            total[key] = total.get(key, 0) + usage[key]
+
+def generate_sectioned_report(api_key, payload, models, settings, stream=False, on_first_token=None, on_delta=None, on_retry=None,
+                              use_cache=True, on_status=None, cancel_token=None, metrics=None, on_attachment=None):
+    """長いレポートを、構成案の生成 → セクションごとの並列生成 → 連結 の順に作る
+
+    セクションは共通の資料・口調と、それぞれの文字数の目安で同時に生成されるため、所要時間は
+    レポート全体ではなく最も長いセクションの長さで決まる。完成したセクションは先頭から順に
+    on_delta に渡される。戻り値は request_with_fallback と同じ形式で、"sections" に各見出しが入る。
+    添付ファイルの準備とPDFのテキスト抽出は最初に1回だけ行い、構成案・各セクションで共有する。
+    各セクションは構成案を作ったモデルを主モデルとしてフォールバックチェーン (models) で送るため、
+    フォールバックが有効なら遅い・失敗したセクションだけが予備モデルに切り替わる。
+    構成案を読み取れない場合は、通常どおり1回のリクエストで生成する。
+    """
+    start_time = time.perf_counter()
+    target = length_target(settings) # 無効時は max_tokens・早期終了を使わない
+    total_chars = parse_target_chars(settings.get("word_count"))
+    options = dict(on_retry=on_retry, use_cache=use_cache, on_status=on_status, metrics=metrics)
+    # 添付ファイルの準備とPDFのテキスト抽出 (長い資料は分割要約) は、構成案・全セクションで共通のため1回だけ行う
+    payload = adapt_payload_for_provider(dict(payload, model=models[0]), resolve_provider(models[0])[1])
+    with metrics_span(metrics, "image_preprocess"):
+        payload = prepare_payload_attachments(payload, on_status, on_attachment, compute_digests=use_cache)
+    with metrics_span(metrics, "pdf_local"):
+        payload = resolve_local_pdf_text(api_key, payload, on_status, on_retry, use_cache, cancel_token, metrics, on_attachment)
+    if on_status:
+        on_status("構成案を作成中...")
+    outline_payload = replace_instruction(payload, settings, OUTLINE_INSTRUCTION.format(
+        theme=settings.get("theme") or "(テーマ未設定)", chars=total_chars, opinion=_opinion_lines(settings),
+        min_sections=SECTIONED_SETTINGS["min_sections"], max_sections=SECTIONED_SETTINGS["max_sections"]))
+    outline_payload["max_tokens"] = int(SECTIONED_SETTINGS["outline_max_tokens"])
+    outline_result = request_with_fallback(api_key, outline_payload, models, cancel_token=cancel_token, **options)
+    try:
+        sections = parse_outline(outline_result["content"], total_chars)
+    except (ValueError, json.JSONDecodeError) as e:
+        print(f"構成案を読み取れなかったため、一括で生成します: {e}")
+        if on_status:
+            on_status("構成案を読み取れなかったため、一括で生成します...")
+        return request_with_fallback(api_key, payload, models, stream=stream, on_first_token=on_first_token, on_delta=on_delta,
+                                     cancel_token=cancel_token, target=target, **options)
+
+    model = outline_result["model"]
+    # 各セクションも構成案を作ったモデルを主モデルとし (文体をそろえるため)、残りのフォールバックチェーンで補う
+    section_models = [model] + [m for m in models if m != model]
+    outline_text = "\n".join(f"{index}. {section['heading']}: {section['points']} ({section['chars']}字)"
+                             for index, section in enumerate(sections, 1))
+    results = [None] * len(sections)
+    emitted = 0
+    ttft = None
+    sections_token = CancelToken(parent=cancel_token) # 1つでも失敗したら残りのセクションも中断する
+    if on_status:
+        on_status(f"{len(sections)}セクションを並列に生成中 (0/{len(sections)})...")
+    with ThreadPoolExecutor(max_workers=max(1, int(SECTIONED_SETTINGS["workers"]))) as executor:
+        futures = {}
+        for index, section in enumerate(sections):
+            section_payload = replace_instruction(payload, settings, SECTION_INSTRUCTION.format(
+                index=index + 1, heading=section["heading"], points=section["points"] or "(構成案を参照)", chars=section["chars"],
+                theme=settings.get("theme") or "(テーマ未設定)", tone=settings.get("tone") or TONE_OPTIONS[0],
+                opinion=_opinion_lines(settings), outline=outline_text))
+            section_target = dict(target, chars=section["chars"]) if target else None
+            futures[executor.submit(request_with_fallback, api_key, section_payload, section_models, stream=stream, cancel_token=sections_token,
+                                    target=section_target, **options)] = index
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                # 先頭から続けて完成した分だけを順に表示する
+                while emitted < len(results) and results[emitted] is not None:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start_time
+                        if on_first_token:
+                            on_first_token(ttft)
+                    if on_delta:
+                        on_delta(("\n\n" if emitted else "") + results[emitted]["content"].strip())
+                    emitted += 1
+                if on_status:
+                    on_status(f"{len(sections)}セクションを並列に生成中 ({sum(r is not None for r in results)}/{len(sections)})...")
+        except BaseException:
+            sections_token.cancel()
+            for future in futures:
+                future.cancel()
+            raise
+
+    usage = {}
+    for result in [outline_result, *results]:
+        _add_usage(usage, result.get("usage"))
+    return {
+        "content": "\n\n".join(result["content"].strip() for result in results),
+        "ttft": ttft,
+        "elapsed": time.perf_counter() - start_time,
+        "usage": usage or None,
+        "model": model,
+        "cached": all(result.get("cached") for result in [outline_result, *results]),
+        "sections": [section["heading"] for section in sections]
+    }
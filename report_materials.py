@@ -0,0 +1,457 @@
+"""資料 (PDF・画像・テキスト) の準備と、レポート設定からのプロンプト・ペイロードの構築"""
+import base64
+import copy
+import json
+import mimetypes
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+
+from report_transport import APIRequestError, FileDataURL, cached_file_digest
+
+# --- 定数 ---
+PDF_ENGINE_OPTIONS = ["pdf-text", "mistral-ocr", "native", "pdf-local"]
+LOCAL_PDF_ENGINE = "pdf-local" # OpenRouter の file-parser を使わず、手元でテキストを抽出する
+STRUCTURE_OPTIONS = {
+    "連続文章": "セクション（見出し）は設けず、一つの連続した文章としてください。",
+    "セクション分け": "適切なセクション（見出し）を設けて、構造化されたレポートを作成してください。",
+    "箇条書き": "主要なポイントを箇条書き形式で記述してください。"
+}
+TONE_OPTIONS = ["である/だ調", "です/ます調"]
+MATERIAL_TYPES = ["PDF", "画像", "複数ファイル", "テキスト資料", "資料なし"]
+MULTI_MATERIAL_TYPE = "複数ファイル" # PDFと画像を組み合わせた複数の添付ファイル
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
+MATERIAL_HEADING = "\n## 資料" # 資料テキストの先頭に付ける見出し (トークン予算の調整対象の目印)
+# 同じ資料で連続作成するモードで、資料の直後 (キャッシュされる先頭部分の末尾) に置く文
+SESSION_MATERIAL_END_TEXT = "資料は以上です。この後に示す条件に従ってレポートを作成してください。"
+
+# --- 設定ファイルの "image_preprocess"・"pdf_local"・"attachments" セクションの既定値 ---
+DEFAULT_IMAGE_SETTINGS = {
+    "enabled": True,
+    "max_edge": 2048,         # 長辺の最大ピクセル数 (これを超える画像は縮小)
+    "format": "JPEG",         # 再エンコード形式 ("JPEG" または "WEBP")
+    "quality": 85,
+    "cache_dir": "image_cache"
+}
+DEFAULT_PDF_LOCAL_SETTINGS = {
+    "max_direct_chars": 60000, # 抽出テキストがこれを超える場合は分割要約 (map-reduce) を行う
+    "chunk_chars": 12000,      # 分割要約する際の1チャンクの文字数
+    "map_workers": 4,          # 分割要約の同時実行数
+    "extract_processes": 0,    # テキスト抽出のプロセス数 (0 はCPU数に合わせる)
+    "cache_dir": "pdf_text_cache"
+}
+DEFAULT_ATTACHMENT_SETTINGS = {
+    "max_total_bytes": 200 * 1024 * 1024, # 前処理後の添付ファイルの合計サイズの上限 (0 は無制限)
+    "workers": 4                           # 添付ファイルを並列に準備するスレッド数
+}
+
+# --- ファイルエンコード関数 ---
+def encode_file_to_base64(file_path):
+    """ファイルを読み込み、Base64エンコードされた文字列を返す (失敗時は OSError を送出)"""
+    with open(file_path, "rb") as file:
+        return base64.b64encode(file.read()).decode('utf-8')
+
+def get_mime_type(file_path):
+    """ファイルパスからMIMEタイプを取得する"""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    return mime_type or 'application/octet-stream' # 不明な場合はデフォルト
+
+# --- 画像の前処理 (縮小・再エンコード) ---
+IMAGE_SETTINGS = dict(DEFAULT_IMAGE_SETTINGS)
+PREPROCESSABLE_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/bmp"} # GIFはアニメーションを保つため対象外
+IMAGE_FORMAT_MIME_TYPES = {"JPEG": ("image/jpeg", ".jpg"), "WEBP": ("image/webp", ".webp")}
+
+def configure_image_preprocess(config):
+    """設定ファイルの "image_preprocess" セクションを画像前処理に反映する"""
+    IMAGE_SETTINGS.update(DEFAULT_IMAGE_SETTINGS)
+    IMAGE_SETTINGS.update(config.get("image_preprocess") or {})
+
+def format_bytes(size):
+    """バイト数を読みやすい単位付きの文字列にする"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+def preprocess_image(file_path):
+    """画像をEXIFの向きに合わせて回転・縮小・再エンコードし、(パス, MIMEタイプ) を返す
+
+    結果は元画像のハッシュと設定値をキーに cache_dir へ保存し、次回以降は再利用する。
+    処理しても小さくならない場合や Pillow が無い場合は元画像をそのまま返す。
+    """
+    mime_type = get_mime_type(file_path)
+    output_format = str(IMAGE_SETTINGS["format"]).upper()
+    if not IMAGE_SETTINGS.get("enabled") or mime_type not in PREPROCESSABLE_IMAGE_TYPES or output_format not in IMAGE_FORMAT_MIME_TYPES:
+        return file_path, mime_type
+    output_mime, extension = IMAGE_FORMAT_MIME_TYPES[output_format]
+    max_edge = int(IMAGE_SETTINGS["max_edge"])
+    quality = int(IMAGE_SETTINGS["quality"])
+
+    cache_dir = Path(IMAGE_SETTINGS["cache_dir"])
+    cache_stem = f"{cached_file_digest(file_path)}_{max_edge}_{output_format.lower()}{quality}"
+    cached_path = cache_dir / f"{cache_stem}{extension}"
+    keep_original_marker = cache_dir / f"{cache_stem}.original" # 縮小効果が無かったことの記録
+    if cached_path.exists():
+        return str(cached_path), output_mime
+    if keep_original_marker.exists():
+        return file_path, mime_type
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("警告: Pillow がインストールされていないため、画像の前処理をスキップします。")
+        return file_path, mime_type
+
+    with Image.open(file_path) as image:
+        image = ImageOps.exif_transpose(image) # スマートフォン写真の回転情報を反映
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            if output_format == "JPEG": # JPEG は透過非対応のため白背景に合成
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_dir / f"{cache_stem}.{threading.get_ident()}.tmp"
+        image.save(temp_path, format=output_format, quality=quality)
+
+    if temp_path.stat().st_size >= os.path.getsize(file_path):
+        temp_path.unlink()
+        keep_original_marker.touch()
+        return file_path, mime_type
+    os.replace(temp_path, cached_path) # 並行実行時も書きかけのファイルを参照しないようにする
+    return str(cached_path), output_mime
+
+ATTACHMENT_SETTINGS = dict(DEFAULT_ATTACHMENT_SETTINGS)
+
+def configure_attachments(config):
+    """設定ファイルの "attachments" セクションを添付ファイルの準備に反映する"""
+    ATTACHMENT_SETTINGS.update(DEFAULT_ATTACHMENT_SETTINGS)
+    ATTACHMENT_SETTINGS.update(config.get("attachments") or {})
+
+def attachment_material_type(file_path):
+    """添付ファイルの資料の種類 ("PDF" または "画像") を拡張子から判定する (非対応の形式は None)"""
+    suffix = Path(file_path).suffix.lower()
+    if suffix == ".pdf":
+        return "PDF"
+    if suffix in IMAGE_EXTENSIONS:
+        return "画像"
+    return None
+
+def _payload_attachment_refs(payload):
+    """ペイロード内の FileDataURL を (メッセージ番号, 要素番号, キー, FileDataURL) のリストで返す"""
+    refs = []
+    for message_index, message in enumerate(payload.get("messages", [])):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for item_index, item in enumerate(content):
+            if item.get("type") == "image_url" and isinstance(item["image_url"].get("url"), FileDataURL):
+                refs.append((message_index, item_index, "image_url", item["image_url"]["url"]))
+            elif item.get("type") == "file" and isinstance(item["file"].get("file_data"), FileDataURL):
+                refs.append((message_index, item_index, "file", item["file"]["file_data"]))
+    return refs
+
+def prepare_payload_attachments(payload, on_status=None, on_attachment=None, compute_digests=False):
+    """送信直前に添付ファイルを準備したペイロードのコピーを返す (元のペイロードは変更しない)
+
+    画像の前処理 (縮小・再エンコード) と、compute_digests=True の場合は応答キャッシュ用のハッシュ計算を、
+    ファイルごとにワーカースレッドで並列に行う (Base64 エンコードは送信時にストリーミングで行われる)。
+    on_attachment(元のパス, 状態, 詳細) にはファイルごとの進捗 ("準備中"・"完了"・"エラー") が渡される。
+    前処理後の合計サイズが max_total_bytes を超える場合は APIRequestError を送出する。
+    """
+    refs = _payload_attachment_refs(payload)
+    if not refs:
+        return payload
+
+    def _prepare(data_url):
+        if data_url.prepared:
+            return data_url
+        if on_attachment:
+            on_attachment(data_url.path, "準備中", "")
+        try:
+            processed = data_url
+            if data_url.mime_type.startswith("image/"):
+                processed_path, processed_mime = preprocess_image(data_url.path)
+                if processed_path != data_url.path:
+                    processed = FileDataURL(processed_path, processed_mime)
+            if compute_digests:
+                processed.digest() # キャッシュキーの計算時に再利用される
+            processed.prepared = True # ハッシュは cached_file_digest に残るため、再送信時は前処理ごと省く
+        except Exception as e:
+            if on_attachment:
+                on_attachment(data_url.path, "エラー", str(e))
+            raise
+        if on_attachment:
+            detail = format_bytes(data_url.size) if processed is data_url else f"{format_bytes(data_url.size)} → {format_bytes(processed.size)}"
+            on_attachment(data_url.path, "完了", detail)
+        return processed
+
+    data_urls = [ref[3] for ref in refs]
+    if len(data_urls) == 1:
+        processed_urls = [_prepare(data_urls[0])]
+    else:
+        if on_status:
+            on_status(f"添付ファイル{len(data_urls)}件を準備中...")
+        with ThreadPoolExecutor(max_workers=max(1, min(len(data_urls), int(ATTACHMENT_SETTINGS["workers"])))) as executor:
+            processed_urls = list(executor.map(_prepare, data_urls))
+
+    total = sum(data_url.size for data_url in processed_urls)
+    limit = int(ATTACHMENT_SETTINGS.get("max_total_bytes") or 0)
+    if limit and total > limit:
+        raise APIRequestError(f"添付ファイルの合計サイズ ({format_bytes(total)}) が上限 ({format_bytes(limit)}) を超えています。"
+                              "ファイルを減らすか、画像を小さくしてください。")
+    prepared = None
+    for (message_index, item_index, key, data_url), processed in zip(refs, processed_urls):
+        if processed is data_url:
+            continue
+        if prepared is None:
+            prepared = copy.deepcopy(payload)
+        item = prepared["messages"][message_index]["content"][item_index]
+        item[key]["url" if key == "image_url" else "file_data"] = processed
+        if on_status and len(refs) == 1:
+            on_status(f"画像を最適化しました: {format_bytes(data_url.size)} → {format_bytes(processed.size)}")
+    if on_status and len(refs) > 1:
+        on_status(f"添付ファイル{len(refs)}件の準備が完了しました (合計 {format_bytes(total)})")
+    return prepared if prepared is not None else payload
+
+# --- PDFのローカルテキスト抽出 ---
+PDF_LOCAL_SETTINGS = dict(DEFAULT_PDF_LOCAL_SETTINGS)
+PDF_PAGES_PER_PROCESS_MIN = 8 # これ未満のページ数はプロセスを起動せずに抽出する
+
+def configure_pdf_local(config):
+    """設定ファイルの "pdf_local" セクションをローカルPDF抽出に反映する"""
+    PDF_LOCAL_SETTINGS.update(DEFAULT_PDF_LOCAL_SETTINGS)
+    PDF_LOCAL_SETTINGS.update(config.get("pdf_local") or {})
+
+class PDFTextReference:
+    """ペイロード内で、ローカル抽出するPDFテキストの代わりに置く参照
+
+    抽出は送信直前にバックグラウンドで行われる (resolve_local_pdf_text)。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        os.stat(self.path) # 存在しない場合はここで FileNotFoundError
+
+    @property
+    def filename(self):
+        return Path(self.path).name
+
+    def __str__(self):
+        return f"{MATERIAL_HEADING}\n[PDF「{self.filename}」からローカルで抽出したテキスト]"
+
+    def __repr__(self):
+        return f"PDFTextReference({self.path!r})"
+
+def _extract_pdf_pages(file_path, start, end):
+    """PDFの指定ページ範囲のテキストを抽出する (プロセスプールから呼ばれる)"""
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def extract_pdf_text(file_path, on_status=None):
+    """PDFのテキストをページごとに抽出してリストで返す
+
+    ページ範囲を分割してプロセスプールで並列に抽出し、結果はファイルのハッシュ単位で
+    cache_dir に保存する (次回以降は抽出を省略)。
+    """
+    cache_path = Path(PDF_LOCAL_SETTINGS["cache_dir"]) / f"{cached_file_digest(file_path)}.json"
+    if cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"PDFテキストキャッシュの読み込みに失敗しました: {e}")
+
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise APIRequestError("PDFのローカル抽出には pypdf が必要です (pip install pypdf)。")
+    try:
+        page_count = len(PdfReader(file_path).pages)
+    except OSError:
+        raise
+    except Exception as e: # pypdf の解析エラー
+        raise APIRequestError(f"PDF「{Path(file_path).name}」を読み込めませんでした: {e}")
+    if on_status:
+        on_status(f"PDFからテキストを抽出中 ({page_count}ページ)...")
+
+    process_count = int(PDF_LOCAL_SETTINGS["extract_processes"]) or (os.cpu_count() or 1)
+    process_count = max(1, min(process_count, page_count // PDF_PAGES_PER_PROCESS_MIN))
+    if process_count == 1:
+        pages = _extract_pdf_pages(file_path, 0, page_count)
+    else:
+        step = -(-page_count // process_count) # 切り上げ
+        ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+        # Tk のスレッドを持つプロセスから fork しないよう spawn を使う
+        with ProcessPoolExecutor(max_workers=process_count, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = executor.map(_extract_pdf_pages, [file_path] * len(ranges), *zip(*ranges))
+            pages = [text for page_texts in results for text in page_texts]
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(pages, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"PDFテキストキャッシュの保存に失敗しました: {e}")
+    return pages
+
+def chunk_pages(pages, chunk_chars):
+    """ページのテキストを、ページ境界を優先しつつ chunk_chars 文字以下のチャンクにまとめる"""
+    chunks = []
+    current = ""
+    for page_number, text in enumerate(pages, 1):
+        text = text.strip()
+        if not text:
+            continue
+        block = f"[p.{page_number}]\n{text}\n"
+        if current and len(current) + len(block) > chunk_chars:
+            chunks.append(current)
+            current = ""
+        while len(block) > chunk_chars: # 1ページが大きすぎる場合は文字数で分割
+            chunks.append(block[:chunk_chars])
+            block = block[chunk_chars:]
+        current += block
+    if current:
+        chunks.append(current)
+    return chunks
+
+# --- プロンプト構築 (GUI非依存) ---
+DEFAULT_REPORT_SETTINGS = {
+    "theme": "",
+    "word_count": "",
+    "structure": "連続文章",
+    "tone": TONE_OPTIONS[0],
+    "opinion": "",
+    "material_type": MATERIAL_TYPES[-1],
+    "material_path": "",
+    "attachments": [], # 資料の種類が「複数ファイル」の場合の添付ファイル (PDF・画像) のパス
+    "text_material": "",
+    "pdf_engine": PDF_ENGINE_OPTIONS[0],
+    "session_mode": False, # 資料を先頭・指示文を末尾に置き、同じ資料での連続作成でキャッシュを効かせる
+}
+
+def build_instruction_text(settings):
+    """レポート条件 (テーマ・文字数・構成・口調・意見) から指示文を組み立てる"""
+    theme = settings.get("theme") or "(テーマ未設定)"
+    word_count = settings.get("word_count") or "(文字数未設定)"
+    structure = STRUCTURE_OPTIONS.get(settings.get("structure"), "（構成未選択）")
+    selected_tone = settings.get("tone") or TONE_OPTIONS[0]
+    instructor_opinion_text = (settings.get("opinion") or "").strip()
+
+    instruction_text_parts = [
+        f"以下の条件に従いレポートを作成してください。\n",
+        "## 条件",
+        f"* **テーマ:** 「{theme}」",
+        f"* **文字数:** 「{word_count}字」程度\n    * 指定文字数を大幅に超えたり、不足したりしないように注意してください。",
+        f"* **構成:**\n    * {structure}",
+        f"* **文体:**",
+        f"    * 平易な言葉遣いを心がけ、専門用語や難解な語彙の多用は避けてください。",
+        f"    * 口調は「{selected_tone}」を使用してください。",
+    ]
+    if instructor_opinion_text:
+        instruction_text_parts.extend([
+            "\n## 指示者の意見・視点",
+            instructor_opinion_text
+        ])
+    instruction_text_parts.extend([
+        "\n## 出力に関する厳守事項",
+        "* **レポートの本文のみ**を生成してください。",
+        "* **「承知しました」「レポートを作成します」といった応答や、レポート本文以外の説明、前置き、結びの挨拶、タイトル、氏名、日付、参考文献リスト（別途指示がない限り）などは一切含めないでください。**",
+        "\n## レポート作成開始"
+    ])
+    return "\n".join(instruction_text_parts)
+
+def build_api_payload(settings):
+    """レポート設定 (dict) からAPIリクエストのペイロード(messages部分)を構築する
+
+    資料ファイルが未指定の場合は ValueError、読み込みに失敗した場合は OSError を送出する。
+    session_mode が有効な場合は [導入文, 資料, 区切り文 (cache_control 付き), 指示文] の順に並べ、
+    レポートごとに変わる指示文をプロバイダ側のプロンプトキャッシュの対象外 (末尾) に置く。
+    """
+    material_type = settings.get("material_type") or MATERIAL_TYPES[-1]
+    material_path = settings.get("material_path") or ""
+    selected_pdf_engine = settings.get("pdf_engine") or PDF_ENGINE_OPTIONS[0]
+    if selected_pdf_engine not in PDF_ENGINE_OPTIONS:
+        print(f"警告: 無効なPDFエンジン '{selected_pdf_engine}' が選択されました。デフォルトの '{PDF_ENGINE_OPTIONS[0]}' を使用します。")
+        selected_pdf_engine = PDF_ENGINE_OPTIONS[0]
+
+    messages = []
+    content_list = [{"type": "text", "text": build_instruction_text(settings)}]
+    plugins = None
+
+    if material_type == "PDF":
+        if not material_path:
+            raise ValueError("PDFファイルが選択されていません。")
+        filename = Path(material_path).name
+        if selected_pdf_engine == LOCAL_PDF_ENGINE:
+            # テキストは送信直前に手元で抽出する (file-parser プラグインは使わない)
+            content_list.insert(0, {"type": "text", "text": f"以下のPDFファイル「{filename}」から抽出したテキスト資料を精読し、その情報を基にしてレポートを作成してください。"})
+            content_list.append({"type": "text", "text": PDFTextReference(material_path)})
+        else:
+            data_url = FileDataURL(material_path, "application/pdf") # 送信時にストリーミングでエンコード
+            content_list.insert(0, {"type": "text", "text": f"添付されたPDFファイル「{filename}」の内容を精読し、その情報を基にしてレポートを作成してください。"})
+            content_list.append({
+                 "type": "file",
+                 "file": { "filename": filename, "file_data": data_url }
+            })
+            plugins = [{"id": "file-parser", "pdf": {"engine": selected_pdf_engine}}]
+    elif material_type == "画像":
+        if not material_path:
+            raise ValueError("画像ファイルが選択されていません。")
+        data_url = FileDataURL(material_path, get_mime_type(material_path))
+        filename = Path(material_path).name
+        content_list.insert(0, {"type": "text", "text": f"添付された画像ファイル「{filename}」の内容を理解し、その情報を基にしてレポートを作成してください。"})
+        content_list.append({
+            "type": "image_url",
+            "image_url": { "url": data_url }
+        })
+    elif material_type == MULTI_MATERIAL_TYPE:
+        attachments = list(settings.get("attachments") or [])
+        if not attachments:
+            raise ValueError("添付ファイルが選択されていません。")
+        descriptions = []
+        for attachment_path in attachments:
+            filename = Path(attachment_path).name
+            attachment_type = attachment_material_type(attachment_path)
+            if attachment_type == "PDF":
+                if selected_pdf_engine == LOCAL_PDF_ENGINE:
+                    content_list.append({"type": "text", "text": PDFTextReference(attachment_path)})
+                else:
+                    content_list.append({"type": "file", "file": {"filename": filename, "file_data": FileDataURL(attachment_path, "application/pdf")}})
+                    plugins = [{"id": "file-parser", "pdf": {"engine": selected_pdf_engine}}]
+            elif attachment_type == "画像":
+                content_list.append({"type": "image_url", "image_url": {"url": FileDataURL(attachment_path, get_mime_type(attachment_path))}})
+            else:
+                raise ValueError(f"対応していない形式のファイルです: {filename}\n(PDFまたは画像ファイルを指定してください)")
+            descriptions.append(f"{attachment_type}「{filename}」")
+        content_list.insert(0, {"type": "text", "text": f"添付された{len(attachments)}件の資料 ({'、'.join(descriptions)}) の内容をすべて精読し、その情報を基にしてレポートを作成してください。"})
+    elif material_type == "テキスト資料":
+        text_material = (settings.get("text_material") or "").strip()
+        if text_material:
+            content_list.insert(0, {"type": "text", "text": "以下のテキスト資料の内容を考慮してレポートを作成してください。"})
+            content_list.append({"type": "text", "text": f"{MATERIAL_HEADING}\n{text_material}"})
+        else:
+            content_list.insert(0, {"type": "text", "text": "あなた自身の知識ベースに基づいてレポートを作成してください。"})
+    elif material_type == "資料なし":
+        content_list.insert(0, {"type": "text", "text": "あなた自身の知識ベースに基づいてレポートを作成してください。"})
+
+    if settings.get("session_mode") and len(content_list) >= 3:
+        intro, instruction, *materials = content_list
+        content_list = [intro, *materials,
+                        {"type": "text", "text": SESSION_MATERIAL_END_TEXT, "cache_control": {"type": "ephemeral"}},
+                        instruction]
+
+    messages.append({"role": "user", "content": content_list})
+    payload = {"messages": messages}
+    if plugins:
+        payload["plugins"] = plugins
+    return payload
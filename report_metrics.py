@@ -0,0 +1,212 @@
+"""実行ごとの所要時間・通信量の計測 (メトリクス) と、メトリクスログの集計"""
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# --- 計測 (メトリクス) ---
+DEFAULT_METRICS_SETTINGS = {
+    "enabled": True,
+    "log_path": "metrics_log.jsonl",
+    "max_bytes": 5 * 1024 * 1024, # これを超えたら log_path.1, .2, ... にローテーションする
+    "backup_count": 3,
+    "trace_memory": False          # tracemalloc でピークメモリを計測する (実行が遅くなる)
+}
+METRICS_SETTINGS = dict(DEFAULT_METRICS_SETTINGS)
+_metrics_log_lock = threading.Lock()
+_memory_trace_lock = threading.Lock()
+_memory_trace_users = 0
+
+def configure_metrics(config):
+    """設定ファイルの "metrics" セクションを計測に反映する"""
+    METRICS_SETTINGS.update(DEFAULT_METRICS_SETTINGS)
+    METRICS_SETTINGS.update(config.get("metrics") or {})
+
+def _start_memory_trace():
+    """tracemalloc を開始する (trace_memory 無効時は何もせず False を返す)"""
+    global _memory_trace_users
+    if not METRICS_SETTINGS.get("trace_memory"):
+        return False
+    with _memory_trace_lock:
+        if _memory_trace_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _memory_trace_users += 1
+    return True
+
+def _stop_memory_trace():
+    """ピークメモリ (バイト) を返し、最後の利用者であれば tracemalloc を停止する"""
+    global _memory_trace_users
+    with _memory_trace_lock:
+        _, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, None)
+        _memory_trace_users -= 1
+        if _memory_trace_users == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return peak
+
+class RequestMetrics:
+    """1回の実行 (プロンプト生成から表示完了まで) の所要時間・通信量を集計する
+
+    区間 (span) ごとの秒数は同名で加算される。フォールバックの並列試行や PDF の分割要約では
+    複数のリクエストが同じ RequestMetrics に記録されるため、区間の合計は経過時間を超えることがある。
+    """
+
+    def __init__(self, source, model=None):
+        self.source = source
+        self.model = model
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.spans = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.finished = False
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._tracing_memory = _start_memory_trace()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """with ブロックの所要時間を区間 name に加算する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_bytes(self, sent=0, received=0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def finish(self, status, result=None, error=None):
+        """集計を確定してメトリクスログに追記し、記録したレコードを返す (2回目以降は None)"""
+        with self._lock:
+            if self.finished:
+                return None
+            self.finished = True
+        result = result or {}
+        elapsed = time.perf_counter() - self._start
+        ttft = result.get("ttft")
+        record = {
+            "timestamp": self.started_at,
+            "source": self.source,
+            "model": result.get("model") or self.model,
+            "status": status,
+            "cached": bool(result.get("cached")),
+            "ttft": ttft,
+            "generation": result["elapsed"] - ttft if ttft is not None and result.get("elapsed") is not None else None,
+            "elapsed": elapsed,
+            "spans": {name: round(seconds, 4) for name, seconds in self.spans.items()},
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "peak_memory": _stop_memory_trace() if self._tracing_memory else None,
+            "usage": result.get("usage"),
+            "cached_tokens": get_cached_tokens(result.get("usage")),
+            "chars": len(result.get("content") or "")
+        }
+        if error is not None:
+            record["error"] = str(error)
+        record_metrics(record)
+        return record
+
+def metrics_span(metrics, name):
+    """metrics が None でも使える span (計測しない場合は何もしない)"""
+    return metrics.span(name) if metrics is not None else contextlib.nullcontext()
+
+def _rotate_log_file(log_path, backup_count):
+    """log_path を log_path.1 に移し、既存のバックアップを1つずつずらす (古いものは削除)"""
+    for index in range(backup_count - 1, 0, -1):
+        source = f"{log_path}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{log_path}.{index + 1}")
+    if backup_count > 0:
+        os.replace(log_path, f"{log_path}.1")
+    else:
+        os.remove(log_path)
+
+def record_metrics(record):
+    """メトリクスを1行のJSONとしてログに追記する (サイズ上限でローテーション)"""
+    log_path = METRICS_SETTINGS.get("log_path")
+    if not METRICS_SETTINGS.get("enabled") or not log_path:
+        return
+    try:
+        with _metrics_log_lock:
+            if os.path.exists(log_path) and os.path.getsize(log_path) >= int(METRICS_SETTINGS["max_bytes"]):
+                _rotate_log_file(log_path, int(METRICS_SETTINGS["backup_count"]))
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"メトリクスログの書き込みに失敗しました: {e}")
+
+def load_metrics_records():
+    """メトリクスログ (ローテーション済みのものを含む) を古い順に読み込む"""
+    log_path = METRICS_SETTINGS.get("log_path")
+    if not log_path:
+        return []
+    paths = [f"{log_path}.{index}" for index in range(int(METRICS_SETTINGS["backup_count"]), 0, -1)] + [log_path]
+    records = []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue # 書き込み途中で終了した行など
+        except OSError:
+            continue
+    return records
+
+def _percentile(values, percent):
+    """最近傍順位法によるパーセンタイル (values が空なら None)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100)) # ceil(n * p / 100)
+    return ordered[int(rank) - 1]
+
+def summarize_metrics(records):
+    """モデルごとの実行回数・失敗数と、TTFT・合計時間・出力トークン数の p50/p95 を返す"""
+    by_model = {}
+    for record in records:
+        if record.get("cached") or record.get("status") == "cancelled":
+            continue # キャッシュ応答や中断した実行は応答時間の分布に含めない
+        by_model.setdefault(record.get("model") or "(不明)", []).append(record)
+    summary = []
+    for model, model_records in sorted(by_model.items()):
+        ok = [r for r in model_records if r.get("status") == "ok"]
+        ttfts = [r["ttft"] for r in ok if r.get("ttft") is not None]
+        elapsed = [r["elapsed"] for r in ok if r.get("elapsed") is not None]
+        tokens = [(r.get("usage") or {}).get("completion_tokens") for r in ok]
+        tokens = [t for t in tokens if t is not None]
+        summary.append({
+            "model": model,
+            "runs": len(model_records),
+            "errors": len(model_records) - len(ok),
+            "ttft_p50": _percentile(ttfts, 50), "ttft_p95": _percentile(ttfts, 95),
+            "elapsed_p50": _percentile(elapsed, 50), "elapsed_p95": _percentile(elapsed, 95),
+            "completion_tokens_p50": _percentile(tokens, 50)
+        })
+    return summary
+
+def format_metrics_summary(summary):
+    """summarize_metrics の結果を表形式の文字列にする (--metrics-summary 用)"""
+    def _seconds(value):
+        return f"{value:.2f}" if value is not None else "-"
+    lines = [f"{'モデル':<40} {'件数':>5} {'失敗':>5} {'TTFT p50':>9} {'p95':>7} {'合計 p50':>9} {'p95':>7} {'出力tok p50':>11}"]
+    for row in summary:
+        tokens = row["completion_tokens_p50"]
+        lines.append(f"{row['model']:<40} {row['runs']:>5} {row['errors']:>5} {_seconds(row['ttft_p50']):>9} {_seconds(row['ttft_p95']):>7}"
+                     f" {_seconds(row['elapsed_p50']):>9} {_seconds(row['elapsed_p95']):>7} {tokens if tokens is not None else '-':>11}")
+    return "\n".join(lines)
+
+def get_cached_tokens(usage):
+    """トークン使用量からプロバイダ側でキャッシュされた入力トークン数を返す (不明な場合は None)"""
+    details = (usage or {}).get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    return int(cached) if cached is not None else None
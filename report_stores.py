@@ -0,0 +1,426 @@
+"""SQLite に保存するデータ (応答キャッシュ・ジョブの記録・レポートのアーカイブ)"""
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from report_transport import FileDataURL, cached_file_digest
+from report_materials import MULTI_MATERIAL_TYPE, build_instruction_text
+
+# --- 設定ファイルの "cache"・"job_store"・"archive" セクションの既定値 ---
+DEFAULT_CACHE_SETTINGS = {
+    "enabled": True,
+    "path": "response_cache.sqlite3",
+    "max_bytes": 50 * 1024 * 1024, # 上限を超えると最終参照が古いものから削除
+    "ttl_seconds": 0               # 0 の場合は無期限
+}
+DEFAULT_JOB_STORE_SETTINGS = {
+    "enabled": True,
+    "path": "jobs.sqlite3",  # 実行の入力・状態・結果の記録 (中断後の再開用)
+    "keep_finished_gui_jobs": 20 # 終了したGUIの実行を新しい順にこの件数だけ残す (結果はアーカイブに保存される)
+}
+DEFAULT_ARCHIVE_SETTINGS = {
+    "enabled": True,
+    "path": "report_archive.sqlite3"  # 生成したレポートの保存先 (全文検索用の索引付き)
+}
+
+# --- 応答キャッシュ ---
+CACHE_SETTINGS = dict(DEFAULT_CACHE_SETTINGS)
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def configure_cache(config):
+    """設定ファイルの "cache" セクションを応答キャッシュに反映する"""
+    global _response_cache
+    with _response_cache_lock:
+        CACHE_SETTINGS.update(DEFAULT_CACHE_SETTINGS)
+        CACHE_SETTINGS.update(config.get("cache") or {})
+        _response_cache = None # 次回利用時に新しい設定で開き直す
+
+def get_response_cache():
+    """共有の ResponseCache を返す。キャッシュが無効な場合は None"""
+    global _response_cache
+    with _response_cache_lock:
+        if not CACHE_SETTINGS.get("enabled"):
+            return None
+        if _response_cache is None:
+            _response_cache = ResponseCache(CACHE_SETTINGS["path"], CACHE_SETTINGS["max_bytes"], CACHE_SETTINGS["ttl_seconds"])
+        return _response_cache
+
+def payload_has_attachments(payload):
+    """ペイロードに FileDataURL (添付ファイル参照) が含まれるかを返す"""
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            value = item.get("file", {}).get("file_data") or item.get("image_url", {}).get("url")
+            if isinstance(value, FileDataURL):
+                return True
+    return False
+
+def make_cache_key(payload):
+    """ペイロード (モデル・プロンプト・添付ファイルの内容を含む) を正規化してハッシュ化する"""
+    normalized = {k: v for k, v in payload.items() if k not in ("stream", "usage")} # 生成内容に影響しない項目は除外
+
+    def _attachment_digest(obj):
+        if isinstance(obj, FileDataURL):
+            return {"mime_type": obj.mime_type, "file_sha256": obj.digest()} # Base64 文字列を作らずに内容で識別する
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    serialized = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=_attachment_digest)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+@contextlib.contextmanager
+def sqlite_connection(path):
+    """SQLite に接続し、ブロックを抜けるときにコミット (例外時はロールバック) して接続を閉じる
+
+    sqlite3.Connection の with はコミット・ロールバックのみで接続を閉じないため、
+    長時間のGUIセッションやバッチ実行でファイルハンドルが残らないよう明示的に閉じる。
+    """
+    with contextlib.closing(sqlite3.connect(path, timeout=10)) as conn, conn:
+        yield conn
+
+class ResponseCache:
+    """SQLite に保存する応答キャッシュ (サイズ上限付きLRU、任意でTTL)"""
+
+    def __init__(self, path, max_bytes, ttl_seconds=0):
+        self.path = str(path)
+        self.max_bytes = int(max_bytes)
+        self.ttl_seconds = float(ttl_seconds or 0)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    def get(self, key):
+        """キーに対応する応答本文を返す。無い場合・期限切れの場合は None"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            content, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            return content
+
+    def put(self, key, model, content):
+        """応答を保存し、サイズ上限を超えた分を最終参照の古い順に削除する"""
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, size, now, now)
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for old_key, old_size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                total -= old_size
+
+# --- ジョブの記録 (中断からの再開) ---
+JOB_STORE_SETTINGS = dict(DEFAULT_JOB_STORE_SETTINGS)
+JOB_UNFINISHED_STATUSES = ("pending", "running") # 前回の終了・異常終了で結果を受け取れなかったジョブ
+_job_store = None
+_job_store_lock = threading.Lock()
+
+def configure_job_store(config):
+    """設定ファイルの "job_store" セクションをジョブの記録に反映する"""
+    global _job_store
+    with _job_store_lock:
+        JOB_STORE_SETTINGS.update(DEFAULT_JOB_STORE_SETTINGS)
+        JOB_STORE_SETTINGS.update(config.get("job_store") or {})
+        _job_store = None
+
+def get_job_store():
+    """共有の JobStore を返す。無効な場合・開けない場合は None"""
+    global _job_store
+    with _job_store_lock:
+        if not JOB_STORE_SETTINGS.get("enabled"):
+            return None
+        if _job_store is None:
+            try:
+                _job_store = JobStore(JOB_STORE_SETTINGS["path"])
+            except sqlite3.Error as e:
+                print(f"ジョブ記録を開けませんでした: {e}")
+                return None
+        return _job_store
+
+def make_job_key(settings):
+    """ジョブの入力 (レポート設定・モデル・資料ファイルのサイズと更新日時) からジョブのキーを作る
+
+    同じ入力のジョブは同じキーになるため、完了済みの結果を再送信せずに取り出せる。
+    """
+    signature = dict(settings)
+    material_paths = [settings.get("material_path")] + list(settings.get("attachments") or [])
+    # 同じパスでも内容が変われば別のジョブ
+    signature["material_stat"] = [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in material_paths if path and os.path.exists(path)]
+    serialized = json.dumps(signature, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+class JobStore:
+    """SQLite に保存するジョブの記録 (入力・状態・試行回数・結果)
+
+    状態は pending (未実行) → running (実行中) → done / error / cancelled と変わる。
+    アプリの終了や異常終了で pending・running のまま残ったジョブは、次回起動時に再開できる。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " key TEXT PRIMARY KEY, source TEXT NOT NULL, settings TEXT NOT NULL, status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_source_status ON jobs(source, status)")
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    @staticmethod
+    def _row_to_job(row):
+        key, source, settings, status, attempts, result, error, created_at, updated_at = row
+        return {"key": key, "source": source, "settings": json.loads(settings), "status": status, "attempts": attempts,
+                "result": json.loads(result) if result else None, "error": error, "created_at": created_at, "updated_at": updated_at}
+
+    def submit(self, key, source, settings):
+        """ジョブを登録して記録 (dict) を返す。同じキーのジョブが既にあれば、その記録をそのまま返す"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO jobs (key, source, settings, status, created_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?)",
+                (key, source, json.dumps(settings, ensure_ascii=False), now, now)
+            )
+            return self._row_to_job(conn.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone())
+
+    def get(self, key):
+        """キーに対応するジョブの記録を返す (無い場合は None)"""
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def start(self, key):
+        """ジョブを実行中にし、試行回数を1増やす"""
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, error = NULL, updated_at = ? WHERE key = ?",
+                         (time.time(), key))
+
+    def complete(self, key, result):
+        """ジョブを完了にして結果 (JSONに変換できる dict) を保存する"""
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, updated_at = ? WHERE key = ?",
+                         (json.dumps(result, ensure_ascii=False), time.time(), key))
+
+    def fail(self, key, error, status="error"):
+        """ジョブを失敗 (またはキャンセル) にする"""
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE key = ?",
+                         (status, str(error) if error is not None else None, time.time(), key))
+
+    def unfinished(self, source):
+        """結果を受け取れずに残っているジョブを新しい順に返す"""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE source = ? AND status IN ({','.join('?' * len(JOB_UNFINISHED_STATUSES))}) ORDER BY created_at DESC",
+                (source, *JOB_UNFINISHED_STATUSES)
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def prune(self, source, keep):
+        """終了した (pending・running 以外の) ジョブを、新しい順に keep 件を残して削除し、削除した件数を返す"""
+        placeholders = ",".join("?" * len(JOB_UNFINISHED_STATUSES))
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM jobs WHERE source = ? AND status NOT IN ({placeholders}) AND key NOT IN ("
+                f" SELECT key FROM jobs WHERE source = ? AND status NOT IN ({placeholders}) ORDER BY updated_at DESC LIMIT ?)",
+                (source, *JOB_UNFINISHED_STATUSES, source, *JOB_UNFINISHED_STATUSES, max(0, int(keep)))
+            )
+            return cursor.rowcount
+
+# --- レポートのアーカイブ (全文検索) ---
+ARCHIVE_SETTINGS = dict(DEFAULT_ARCHIVE_SETTINGS)
+ARCHIVE_TRIGRAM_MIN_CHARS = 3 # trigram トークナイザで検索できる最短の語 (これより短い語は LIKE で探す)
+_report_archive = None
+_report_archive_lock = threading.Lock()
+
+def configure_archive(config):
+    """設定ファイルの "archive" セクションをレポートのアーカイブに反映する"""
+    global _report_archive
+    with _report_archive_lock:
+        ARCHIVE_SETTINGS.update(DEFAULT_ARCHIVE_SETTINGS)
+        ARCHIVE_SETTINGS.update(config.get("archive") or {})
+        _report_archive = None
+
+def get_report_archive():
+    """共有の ReportArchive を返す。無効な場合・開けない場合は None"""
+    global _report_archive
+    with _report_archive_lock:
+        if not ARCHIVE_SETTINGS.get("enabled"):
+            return None
+        if _report_archive is None:
+            try:
+                _report_archive = ReportArchive(ARCHIVE_SETTINGS["path"])
+            except sqlite3.Error as e:
+                print(f"アーカイブを開けませんでした: {e}")
+                return None
+        return _report_archive
+
+def material_digest(settings):
+    """資料 (ファイルの内容またはテキスト資料) の SHA-256。資料が無い場合は空文字列"""
+    material_type = settings.get("material_type")
+    if material_type in ("PDF", "画像") and settings.get("material_path"):
+        return cached_file_digest(settings["material_path"])
+    if material_type == MULTI_MATERIAL_TYPE and settings.get("attachments"):
+        digests = "".join(cached_file_digest(path) for path in settings["attachments"])
+        return hashlib.sha256(digests.encode("ascii")).hexdigest()
+    if material_type == "テキスト資料" and settings.get("text_material"):
+        return hashlib.sha256(settings["text_material"].encode("utf-8")).hexdigest()
+    return ""
+
+class ReportArchive:
+    """生成したレポートを条件・資料・所要時間とともに保存する SQLite (FTS5 による全文検索付き)
+
+    日本語は単語の区切りが無いため trigram トークナイザで索引を作る (非対応の SQLite では unicode61)。
+    """
+    COLUMNS = ("id", "created_at", "source", "model", "theme", "word_count", "structure", "tone", "material_type",
+               "material_name", "material_hash", "settings", "prompt", "content", "chars", "ttft", "elapsed",
+               "prompt_tokens", "completion_tokens")
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reports ("
+                " id INTEGER PRIMARY KEY, created_at REAL NOT NULL, source TEXT, model TEXT, theme TEXT, word_count TEXT,"
+                " structure TEXT, tone TEXT, material_type TEXT, material_name TEXT, material_hash TEXT, settings TEXT,"
+                " prompt TEXT, content TEXT NOT NULL, chars INTEGER, ttft REAL, elapsed REAL,"
+                " prompt_tokens INTEGER, completion_tokens INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_material_hash ON reports(material_hash)")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'reports_fts'").fetchone() is None:
+                self._create_index(conn)
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    @staticmethod
+    def _create_index(conn):
+        """全文検索用の索引 (外部コンテンツ型の FTS5 テーブル) と同期用のトリガーを作る"""
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                conn.execute("CREATE VIRTUAL TABLE reports_fts USING fts5(theme, prompt, content, content='reports', content_rowid='id',"
+                             f" tokenize='{tokenizer}')")
+                break
+            except sqlite3.OperationalError:
+                if tokenizer == "unicode61":
+                    raise
+        conn.execute("CREATE TRIGGER IF NOT EXISTS reports_ai AFTER INSERT ON reports BEGIN"
+                     " INSERT INTO reports_fts(rowid, theme, prompt, content) VALUES (new.id, new.theme, new.prompt, new.content); END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS reports_ad AFTER DELETE ON reports BEGIN"
+                     " INSERT INTO reports_fts(reports_fts, rowid, theme, prompt, content) VALUES ('delete', old.id, old.theme, old.prompt, old.content); END")
+        conn.execute("INSERT INTO reports_fts(reports_fts) VALUES ('rebuild')") # 既存の行を索引に入れる
+
+    def add(self, source, settings, result):
+        """生成結果を保存し、レポートのIDを返す"""
+        usage = result.get("usage") or {}
+        content = result.get("content") or ""
+        material_paths = [settings.get("material_path")] + list(settings.get("attachments") or [])
+        row = {
+            "created_at": time.time(),
+            "source": source,
+            "model": result.get("model") or settings.get("model"),
+            "theme": settings.get("theme") or "",
+            "word_count": settings.get("word_count") or "",
+            "structure": settings.get("structure"),
+            "tone": settings.get("tone"),
+            "material_type": settings.get("material_type"),
+            "material_name": ", ".join(Path(path).name for path in material_paths if path),
+            "material_hash": material_digest(settings),
+            "settings": json.dumps(settings, ensure_ascii=False),
+            "prompt": build_instruction_text(settings),
+            "content": content,
+            "chars": len(content),
+            "ttft": result.get("ttft"),
+            "elapsed": result.get("elapsed"),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens")
+        }
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(f"INSERT INTO reports ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", tuple(row.values()))
+            return cursor.lastrowid
+
+    def search(self, query="", limit=200):
+        """テーマ・指示文・本文を検索し、新しい順に一覧用の dict (本文は含まず、抜粋付き) を返す
+
+        空白で区切った語はすべてを含むもの (AND) を探す。空の場合は最近のレポートを返す。
+        """
+        terms = query.split()
+        columns = "r.id, r.created_at, r.model, r.theme, r.material_name, r.chars, r.elapsed"
+        long_terms = [t for t in terms if len(t) >= ARCHIVE_TRIGRAM_MIN_CHARS]
+        short_terms = [t for t in terms if len(t) < ARCHIVE_TRIGRAM_MIN_CHARS]
+        params = []
+        if long_terms:
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms)
+            sql = (f"SELECT {columns}, snippet(reports_fts, 2, '【', '】', '…', 24) FROM reports_fts"
+                   " JOIN reports r ON r.id = reports_fts.rowid WHERE reports_fts MATCH ?")
+            params.append(match)
+        else:
+            sql = f"SELECT {columns}, substr(r.content, 1, 60) FROM reports r WHERE 1"
+        for term in short_terms: # 短い語は索引を使えないため部分一致で絞り込む
+            sql += " AND (r.theme LIKE ? ESCAPE '\\' OR r.content LIKE ? ESCAPE '\\')"
+            pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params.extend([pattern, pattern])
+        sql += " ORDER BY r.created_at DESC LIMIT ?"
+        params.append(int(limit))
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        keys = ("id", "created_at", "model", "theme", "material_name", "chars", "elapsed", "snippet")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get(self, report_id):
+        """IDに対応するレポートを dict で返す (無い場合は None)"""
+        with self._lock, self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM reports WHERE id = ?", (report_id,)).fetchone()
+        if row is None:
+            return None
+        report = dict(zip(self.COLUMNS, row))
+        report["settings"] = json.loads(report["settings"]) if report["settings"] else {}
+        return report
+
+    def delete(self, report_id):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM reports WHERE id = ?", (report_id,))
+
+def archive_report(source, settings, result):
+    """生成結果をアーカイブに保存する (応答キャッシュから返した結果は保存済みのため除く)"""
+    archive = get_report_archive()
+    if archive is None or result.get("cached") or not result.get("content"):
+        return None
+    try:
+        return archive.add(source, settings, result)
+    except (sqlite3.Error, OSError) as e: # 保存の失敗で生成結果の表示を止めない
+        print(f"アーカイブへの保存エラー: {e}")
+        return None
@@ -0,0 +1,649 @@
+"""chat/completions への HTTP 通信 (添付ファイルのストリーミング送信・再試行・レート制限・プロバイダの振り分け)"""
+import base64
+import fnmatch
+import hashlib
+import importlib
+import json
+import mmap
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from report_metrics import metrics_span
+
+# --- 遅延 import (起動時間短縮のため、重いモジュールは最初に使うときに読み込む) ---
+class LazyModule:
+    """最初に属性へアクセスしたときにモジュールを import するプロキシ"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+requests = LazyModule("requests")  # HTTP 通信を始めるまで読み込まない (バッチ・GUIともに起動が速くなる)
+
+# --- 設定ファイルの "http"・"rate_limit" セクションの既定値 ---
+DEFAULT_HTTP_SETTINGS = {
+    "connect_timeout": 10,   # 接続確立までのタイムアウト (秒)
+    "read_timeout": 300,     # 応答待ちのタイムアウト (秒)
+    "max_retries": 3,        # 429/5xx・通信エラー時の再試行回数
+    "backoff_base": 1.0,     # 指数バックオフの初期待ち時間 (秒)
+    "backoff_max": 60.0      # 待ち時間の上限 (Retry-After にも適用)
+}
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    "enabled": True,
+    "models": {"*:free": {"requests_per_minute": 20}}, # モデルIDのパターン → 1分あたりの送信数・バースト (省略時は同数)
+    "default": {"requests_per_minute": 0},              # 0 は応答の X-RateLimit-* ヘッダーから決める
+    "initial_concurrency": 4,  # モデルごとの同時実行数の初期値
+    "min_concurrency": 1,
+    "max_concurrency": 16,
+    "increase_step": 1.0,      # 成功ごとに上限を increase_step / 上限 だけ増やす (加算的増加)
+    "decrease_factor": 0.5     # 429 を受けたら上限にこの値を掛ける (乗算的減少)
+}
+
+# --- 添付ファイルのストリーミング送信 ---
+BASE64_READ_CHUNK = 3 * 64 * 1024 # 3の倍数にしてチャンク境界でパディングが入らないようにする
+
+def iter_file_base64(file_path, chunk_size=BASE64_READ_CHUNK):
+    """ファイルをメモリマップし、Base64エンコード済みのバイト列をチャンクごとに返す"""
+    with open(file_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return # 空ファイルは mmap できない
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, len(mapped), chunk_size):
+                yield base64.b64encode(mapped[offset:offset + chunk_size])
+
+# 添付ファイルのハッシュ値キャッシュ ((パス, サイズ, 更新時刻) → SHA-256)
+FILE_DIGEST_CACHE_SIZE = 64
+_file_digest_cache = OrderedDict()
+_file_digest_cache_lock = threading.Lock()
+
+def file_fingerprint(file_path):
+    """ファイルの同一性判定に使う (絶対パス, サイズ, 更新時刻) を返す"""
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+def cached_file_digest(file_path):
+    """ファイル内容の SHA-256 を返す。同じファイルが変更されていなければ再計算しない"""
+    fingerprint = file_fingerprint(file_path)
+    with _file_digest_cache_lock:
+        digest = _file_digest_cache.get(fingerprint)
+        if digest is not None:
+            _file_digest_cache.move_to_end(fingerprint)
+            return digest
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _file_digest_cache_lock:
+        _file_digest_cache[fingerprint] = digest
+        while len(_file_digest_cache) > FILE_DIGEST_CACHE_SIZE:
+            _file_digest_cache.popitem(last=False)
+    return digest
+
+class FileDataURL:
+    """ペイロード内で data URL (data:<mime>;base64,...) の代わりに置く添付ファイル参照
+
+    文字列化せずにファイルパスのまま保持し、送信時に StreamingJSONBody がチャンク単位で
+    Base64 エンコードして書き出す。プロンプトのプレビューではファイル内容を読まない。
+    """
+
+    def __init__(self, path, mime_type):
+        self.path = str(path)
+        self.mime_type = mime_type
+        self.size = os.stat(self.path).st_size # 存在しない場合はここで FileNotFoundError
+        self.prepared = False # prepare_payload_attachments で準備済み (同じペイロードの再送信では処理しない)
+
+    @property
+    def prefix(self):
+        return f"data:{self.mime_type};base64,".encode("ascii")
+
+    @property
+    def encoded_length(self):
+        """Base64 エンコード後の data URL のバイト数"""
+        return len(self.prefix) + 4 * ((self.size + 2) // 3)
+
+    def iter_bytes(self):
+        """data URL をバイト列のチャンクとして返す"""
+        yield self.prefix
+        yield from iter_file_base64(self.path)
+
+    def digest(self):
+        """ファイル内容の SHA-256 (キャッシュキー用、(パス, サイズ, 更新時刻) 単位でキャッシュ)"""
+        return cached_file_digest(self.path)
+
+    def __repr__(self):
+        return f"FileDataURL({self.path!r}, {self.mime_type!r}, size={self.size})"
+
+class StreamingJSONBody:
+    """添付ファイル参照を含むペイロードを、全体を文字列化せずにJSONとして送信するリクエストボディ
+
+    JSONの骨格部分だけを先に直列化し、FileDataURL の位置でファイルの Base64 を
+    チャンクごとに差し込む。長さは事前に計算できるため Content-Length も付与される。
+    """
+    _MARKER = "__llm_report_tool_attachment_{}__"
+
+    def __init__(self, payload, cancel_token=None, metrics=None):
+        self._cancel_token = cancel_token
+        self._metrics = metrics
+        attachments = []
+
+        def _placeholder(obj):
+            if isinstance(obj, FileDataURL):
+                attachments.append(obj)
+                return self._MARKER.format(len(attachments) - 1)
+            raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+        with metrics_span(metrics, "serialize"):
+            envelope = json.dumps(payload, ensure_ascii=False, default=_placeholder)
+        self._parts = []
+        for index, attachment in enumerate(attachments):
+            before, envelope = envelope.split(f'"{self._MARKER.format(index)}"', 1)
+            self._parts.extend([before.encode("utf-8") + b'"', attachment, b'"'])
+        self._parts.append(envelope.encode("utf-8"))
+        self._length = sum(part.encoded_length if isinstance(part, FileDataURL) else len(part) for part in self._parts)
+        self._chunks = self._iter_chunks()
+        self._buffer = b""
+
+    def _iter_chunks(self):
+        for part in self._parts:
+            if isinstance(part, FileDataURL):
+                chunks = part.iter_bytes()
+                while True:
+                    # ファイル読み込み・Base64 エンコードの時間だけを計測する (送信時間は含めない)
+                    with metrics_span(self._metrics, "encode"):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+            elif part:
+                yield part
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self._chunks
+
+    def read(self, size=-1):
+        """ファイルライクな読み出し (http.client が blocksize 単位で呼び出す)"""
+        if self._cancel_token:
+            self._cancel_token.raise_if_cancelled() # 送信途中でも中断できるようにする
+        if size is None or size < 0:
+            data = self._buffer + b"".join(self._chunks)
+            self._buffer = b""
+        else:
+            while len(self._buffer) < size:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer += chunk
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if self._metrics is not None:
+            self._metrics.add_bytes(sent=len(data))
+        return data
+
+# --- API呼び出し (GUI非依存) ---
+OPENROUTER_API_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions") # 模擬サーバー等に向ける場合は環境変数で上書き
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class APIRequestError(Exception):
+    """API呼び出しの失敗 (メッセージはそのまま利用者に表示できる形式)"""
+
+class RequestCancelled(APIRequestError):
+    """CancelToken によって中断されたリクエスト"""
+
+    def __init__(self, message="リクエストはキャンセルされました。"):
+        super().__init__(message)
+
+def _abort_response(response):
+    """受信中のレスポンスの接続を切断する (別スレッドでブロック中の読み込みも終了させる)"""
+    raw = getattr(response, "raw", None)
+    # Keep-Alive の場合は接続オブジェクトが、Connection: close の場合は http.client の応答がソケットを持つ
+    sockets = [
+        getattr(getattr(raw, "_connection", None), "sock", None),
+        getattr(getattr(getattr(getattr(raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    ]
+    for sock in sockets:
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR) # close() だけでは recv 中のスレッドが起きない
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+class CancelToken:
+    """実行中のリクエストを別スレッドから中断するためのトークン
+
+    cancel() されると、登録中のレスポンスの接続を切断して受信待ちを打ち切り、
+    子トークン (parent を指定して作成したもの) もまとめて中断する。
+    """
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._responses = set()
+        self._children = []
+        if parent is not None:
+            parent._add_child(self)
+
+    def _add_child(self, child):
+        with self._lock:
+            self._children.append(child)
+        if self.cancelled:
+            child.cancel()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """中断を要求し、受信中の接続を閉じる"""
+        self._event.set()
+        with self._lock:
+            responses, self._responses = list(self._responses), set()
+            children = list(self._children)
+        for response in responses:
+            _abort_response(response)
+        for child in children:
+            child.cancel()
+
+    def wait(self, timeout):
+        """最大 timeout 秒待機する。途中で中断された場合は True を返す"""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelled()
+
+    def attach(self, response):
+        """中断時に閉じるレスポンスを登録する"""
+        with self._lock:
+            self._responses.add(response)
+        if self.cancelled:
+            _abort_response(response)
+
+    def detach(self, response):
+        with self._lock:
+            self._responses.discard(response)
+
+# --- HTTP通信層 (接続プール・再試行) ---
+HTTP_SETTINGS = dict(DEFAULT_HTTP_SETTINGS)
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def configure_http(config):
+    """設定ファイルの "http" セクションを通信層に反映する"""
+    HTTP_SETTINGS.update(DEFAULT_HTTP_SETTINGS)
+    HTTP_SETTINGS.update(config.get("http") or {})
+
+def get_http_session():
+    """プロセス全体で共有する requests.Session を返す (Keep-Alive で接続を再利用)"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            # 再試行は post_with_retry で制御するため、アダプタ側の再試行は無効にする
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def _retry_after_seconds(response):
+    """Retry-After ヘッダ (秒数またはHTTP日付) を秒数に変換する。無い場合は None"""
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _backoff_delay(attempt, response=None):
+    """再試行までの待ち時間を返す (Retry-After 優先、無ければジッター付き指数バックオフ)"""
+    backoff_max = float(HTTP_SETTINGS["backoff_max"])
+    retry_after = _retry_after_seconds(response)
+    if retry_after is not None:
+        return min(retry_after, backoff_max)
+    delay = min(backoff_max, float(HTTP_SETTINGS["backoff_base"]) * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+def post_with_retry(url, headers, payload, stream=False, on_retry=None, max_retries=None, cancel_token=None, metrics=None,
+                    rate_limiter=None, on_status=None):
+    """共有セッションでPOSTし、429/5xx・通信エラー時はバックオフして再試行する
+
+    最終的に得られたレスポンス (エラー応答を含む) を返す。通信エラーが再試行回数を
+    超えた場合は requests の例外をそのまま送出する。max_retries を指定すると設定値より優先する。
+    rate_limiter (ModelRateLimiter) を渡すと、再試行を含む各送信の前にトークンを取り出し、応答を反映する。
+    """
+    session = get_http_session()
+    timeout = (float(HTTP_SETTINGS["connect_timeout"]), float(HTTP_SETTINGS["read_timeout"]))
+    max_retries = max(0, int(HTTP_SETTINGS["max_retries"] if max_retries is None else max_retries))
+    attempt = 0
+    while True:
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if rate_limiter:
+            with metrics_span(metrics, "rate_limit_wait"):
+                rate_limiter.take_token(cancel_token, on_status)
+        try:
+            # 再試行のたびにボディを作り直す (添付ファイルは先頭から読み直される)
+            # "upload" は送信開始から応答ヘッダー受信まで (サーバー側の待ち時間を含む)
+            with metrics_span(metrics, "upload"):
+                response = session.post(url, headers=headers, data=StreamingJSONBody(payload, cancel_token, metrics),
+                                        timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if cancel_token and cancel_token.cancelled:
+                raise RequestCancelled()
+            if attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt)
+            reason = "タイムアウト" if isinstance(e, requests.exceptions.Timeout) else "接続エラー"
+        else:
+            if rate_limiter:
+                rate_limiter.observe(response)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+                return response
+            delay = _backoff_delay(attempt, response)
+            reason = f"HTTP {response.status_code}"
+            response.close() # 接続をプールへ返却
+        attempt += 1
+        if on_retry:
+            on_retry(attempt, delay, reason)
+        print(f"APIリクエスト再試行 {attempt}/{max_retries} ({reason}, {delay:.1f}秒後)")
+        if cancel_token:
+            if cancel_token.wait(delay):
+                raise RequestCancelled()
+        else:
+            time.sleep(delay)
+
+# --- レート制限 (モデルごとのトークンバケット・適応的な同時実行数) ---
+RATE_LIMIT_SETTINGS = dict(DEFAULT_RATE_LIMIT_SETTINGS)
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def configure_rate_limit(config):
+    """設定ファイルの "rate_limit" セクションをレート制限に反映する (既存のモデルごとの状態は作り直す)"""
+    RATE_LIMIT_SETTINGS.update(DEFAULT_RATE_LIMIT_SETTINGS)
+    RATE_LIMIT_SETTINGS.update(config.get("rate_limit") or {})
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
+
+def _model_rate_settings(model):
+    """モデルに適用する {"requests_per_minute", "burst"} (models のパターンに一致しない場合は default)"""
+    for pattern, settings in (RATE_LIMIT_SETTINGS.get("models") or {}).items():
+        if fnmatch.fnmatchcase(model or "", pattern):
+            return settings
+    return RATE_LIMIT_SETTINGS.get("default") or {}
+
+def get_rate_limiter(model):
+    """プロセス全体で共有する、モデルごとの ModelRateLimiter を返す (無効時は None)"""
+    if not RATE_LIMIT_SETTINGS.get("enabled"):
+        return None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(model)
+        if limiter is None:
+            settings = _model_rate_settings(model)
+            limiter = ModelRateLimiter(model, settings.get("requests_per_minute") or 0, settings.get("burst") or 0)
+            _rate_limiters[model] = limiter
+        return limiter
+
+def rate_limiter_snapshots():
+    """これまでに使ったモデルごとのレート制限の状態のリスト"""
+    with _rate_limiters_lock:
+        limiters = list(_rate_limiters.values())
+    return [limiter.snapshot() for limiter in limiters]
+
+def _rate_limit_reset_seconds(value):
+    """X-RateLimit-Reset (エポックミリ秒・エポック秒・残り秒数のいずれか) を残り秒数に変換する"""
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    if reset > 1e11:
+        reset /= 1000.0
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+class ModelRateLimiter:
+    """モデル1つ分のレート制限
+
+    送信 (再試行を含む) ごとにトークンバケットから1つ取り出し、同時に実行中のリクエスト数を
+    AIMD (成功で加算的に増やし、429 で乗算的に減らす) で調整した上限以下に保つ。
+    上限に達した分はリモートで拒否される前に、手元で順番に待たせる。
+    バケットの容量と補充速度は設定値、無い場合は応答の X-RateLimit-* ヘッダーから決める。
+    """
+
+    def __init__(self, model, requests_per_minute=0, burst=0):
+        self.model = model
+        self.configured = requests_per_minute > 0
+        self._set_rate(requests_per_minute, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.limit = float(RATE_LIMIT_SETTINGS["initial_concurrency"])
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.stats = {"requests": 0, "throttled": 0, "wait_seconds": 0.0}
+        self._waiters = []
+        self._condition = threading.Condition()
+
+    def _set_rate(self, requests_per_minute, burst=0):
+        self.rate = requests_per_minute / 60.0 # 1秒あたりの補充数 (0 は無制限)
+        self.capacity = max(1, int(burst or requests_per_minute or 1))
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(float(self.capacity), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait(self, ready, cancel_token=None, on_wait=None):
+        """ready() が 0 以下を返すまで待つ (正の値は次に確認するまでの秒数)。待った秒数を返す"""
+        started = time.monotonic()
+        notify = on_wait is not None
+        while True:
+            with self._condition:
+                while True:
+                    if cancel_token and cancel_token.cancelled:
+                        raise RequestCancelled()
+                    delay = ready()
+                    if delay <= 0:
+                        waited = time.monotonic() - started
+                        self.stats["wait_seconds"] += waited
+                        return waited
+                    if notify:
+                        break
+                    self._condition.wait(min(delay, 0.2)) # 中断・状態の変化を確認できるよう短く区切る
+            # 通知先 (GUIなど) を呼ぶ間は、同じモデルの他のスレッドを止めないようロックを放す
+            on_wait(f"レート制限のため送信待ち ({self.model})...")
+            notify = False
+
+    def acquire(self, cancel_token=None, on_wait=None):
+        """同時実行数の枠を1つ取得する (枠が空くまで先着順に待つ)。終わったら release を呼ぶこと"""
+        ticket = object()
+        with self._condition:
+            self._waiters.append(ticket)
+
+        def _ready():
+            if self._waiters[0] is ticket and self.in_flight < max(1, int(self.limit)):
+                self._waiters.pop(0)
+                self.in_flight += 1
+                return 0
+            return 1.0 # release・notify_all で起こされる
+
+        try:
+            return self._wait(_ready, cancel_token, on_wait)
+        except RequestCancelled:
+            with self._condition:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                self._condition.notify_all()
+            raise
+
+    def release(self, succeeded=True):
+        """acquire で取得した枠を返す
+
+        2xx の応答を最後まで受け取れた場合だけ同時実行数の上限を少し増やす。
+        5xx・通信エラー・タイムアウトでは上限を変えない (429 は observe で減らす)。
+        """
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            if succeeded:
+                self.limit = min(float(RATE_LIMIT_SETTINGS["max_concurrency"]),
+                                 self.limit + float(RATE_LIMIT_SETTINGS["increase_step"]) / max(1.0, self.limit))
+            self._condition.notify_all()
+
+    def take_token(self, cancel_token=None, on_wait=None):
+        """1回の送信の前に呼び、バケットのトークンが補充されるまで待つ"""
+        def _ready():
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate <= 0:
+                self.stats["requests"] += 1 # 制限が分からない間は止めない
+                return 0
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.stats["requests"] += 1
+                return 0
+            return (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+        return self._wait(_ready, cancel_token, on_wait)
+
+    def observe(self, response):
+        """応答のステータスと X-RateLimit-* ヘッダーをバケットと同時実行数に反映する"""
+        headers = response.headers
+        now = time.monotonic()
+        with self._condition:
+            limit = headers.get("X-RateLimit-Limit")
+            if limit and not self.configured:
+                try:
+                    self._set_rate(int(float(limit))) # OpenRouter の上限は1分あたりとみなす
+                except ValueError:
+                    pass
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_seconds = _rate_limit_reset_seconds(headers.get("X-RateLimit-Reset"))
+            if remaining is not None:
+                try:
+                    self._refill(now)
+                    self.tokens = min(self.tokens, float(remaining))
+                except ValueError:
+                    pass
+                if self.tokens < 1 and reset_seconds:
+                    self.paused_until = max(self.paused_until, now + reset_seconds)
+            if response.status_code == 429:
+                self.stats["throttled"] += 1
+                self._refill(now)
+                self.tokens = 0.0
+                pause = _retry_after_seconds(response) or reset_seconds or float(HTTP_SETTINGS["backoff_base"])
+                self.paused_until = max(self.paused_until, now + pause)
+                if now - self.last_decrease >= 1.0: # 同時に返った 429 で何度も減らさない
+                    self.limit = max(float(RATE_LIMIT_SETTINGS["min_concurrency"]),
+                                     self.limit * float(RATE_LIMIT_SETTINGS["decrease_factor"]))
+                    self.last_decrease = now
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """現在の状態 (表示・ログ用)"""
+        with self._condition:
+            return {"model": self.model, "concurrency_limit": round(self.limit, 2), "in_flight": self.in_flight,
+                    "queued": len(self._waiters), "requests_per_minute": round(self.rate * 60, 2), **self.stats}
+
+# --- プロバイダ (OpenRouter・OpenAI互換サーバー) ---
+DEFAULT_PROVIDER = "openrouter"
+PROVIDER_DEFAULTS = {
+    "base_url": "",                 # chat/completions の手前まで (例: "http://192.168.1.10:8000/v1")
+    "api_key": "",                  # 空の場合は api_key_env の環境変数 → どちらも無ければ認証ヘッダーを付けない
+    "api_key_env": "",
+    "headers": {},                  # 追加で送るHTTPヘッダー
+    "models": [],                   # このプロバイダに送るモデルIDのパターン (fnmatch 形式、例: "lan/*")
+    "strip_prefix": "",             # 送信時にモデルIDから取り除く接頭辞 (例: "lan/")
+    "supports_plugins": False,      # OpenRouter の plugins (file-parser によるPDF読み取り) に対応しているか
+    "supports_cache_control": False,
+    "usage": "stream_options",      # トークン使用量の要求方法 ("openrouter"・"stream_options" (OpenAI互換)・"none")
+    "max_concurrency": 0            # 同時に送るリクエスト数の上限 (0 は無制限)
+}
+OPENROUTER_PROVIDER = dict(PROVIDER_DEFAULTS, headers={"HTTP-Referer": "http://localhost", "X-Title": "LLM Report Tool"},
+                           supports_plugins=True, supports_cache_control=True, usage="openrouter")
+PROVIDERS = {DEFAULT_PROVIDER: dict(OPENROUTER_PROVIDER)}
+_provider_semaphores = {}
+
+def configure_providers(config):
+    """設定ファイルの "providers" をプロバイダの一覧に反映する ("openrouter" は既定値を上書きできる)"""
+    global _provider_semaphores
+    PROVIDERS.clear()
+    PROVIDERS[DEFAULT_PROVIDER] = dict(OPENROUTER_PROVIDER)
+    for name, settings in (config.get("providers") or {}).items():
+        PROVIDERS[name] = dict(PROVIDERS.get(name) or PROVIDER_DEFAULTS, **settings)
+    _provider_semaphores = {name: threading.BoundedSemaphore(int(provider["max_concurrency"]))
+                            for name, provider in PROVIDERS.items() if int(provider.get("max_concurrency") or 0) > 0}
+
+def resolve_provider(model):
+    """モデルIDの送信先プロバイダを (名前, 設定) で返す (どのパターンにも一致しなければ OpenRouter)"""
+    for name, provider in PROVIDERS.items():
+        if name != DEFAULT_PROVIDER and any(fnmatch.fnmatchcase(model or "", pattern) for pattern in provider.get("models") or []):
+            return name, provider
+    return DEFAULT_PROVIDER, PROVIDERS[DEFAULT_PROVIDER]
+
+def _provider_api_key(name, provider):
+    """プロバイダ固有のAPIキー (設定値 → 環境変数)。無い場合は None"""
+    return provider.get("api_key") or (os.environ.get(provider["api_key_env"]) if provider.get("api_key_env") else None) or None
+
+def provider_requires_app_key(model):
+    """モデルの送信に、アプリに設定した OpenRouter のAPIキーが必要かを返す"""
+    name, provider = resolve_provider(model)
+    return name == DEFAULT_PROVIDER and _provider_api_key(name, provider) is None
+
+def provider_chat_url(provider):
+    """プロバイダの chat/completions のURL (OpenRouter で base_url が空の場合は OPENROUTER_API_URL)"""
+    if provider.get("base_url"):
+        return provider["base_url"].rstrip("/") + "/chat/completions"
+    return OPENROUTER_API_URL
+
+def provider_headers(name, provider, api_key):
+    """プロバイダに送るHTTPヘッダー (OpenRouter で固有のキーが無い場合はアプリのAPIキーを使う)"""
+    headers = {"Content-Type": "application/json", **(provider.get("headers") or {})}
+    key = _provider_api_key(name, provider) or (api_key if name == DEFAULT_PROVIDER else None)
+    if key:
+        headers["Authorization"] = f"Bearer {key}"
+    return headers
+
+def acquire_provider_slot(name, cancel_token=None):
+    """プロバイダの同時実行数の枠を取得する (上限が無い場合は None、取得した場合は release が必要な Semaphore)"""
+    semaphore = _provider_semaphores.get(name)
+    if semaphore is None:
+        return None
+    while not semaphore.acquire(timeout=0.1): # 待機中もキャンセルできるよう短い間隔で確認する
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+    return semaphore
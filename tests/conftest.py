@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のモジュール (llm_report_tool.py・mock_openrouter.py) を import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import report_catalog  # noqa: E402
+import report_generation  # noqa: E402
+import report_metrics  # noqa: E402
+import report_stores  # noqa: E402
+import report_transport  # noqa: E402
+from mock_openrouter import MockOpenRouterServer  # noqa: E402
+
+_CONFIGURES = (report_transport.configure_http, report_stores.configure_cache, report_generation.configure_length_control,
+               report_transport.configure_rate_limit, report_transport.configure_providers, report_generation.configure_fallback,
+               report_stores.configure_job_store, report_stores.configure_archive, report_metrics.configure_metrics,
+               report_catalog.configure_model_catalog)
+
+
+@pytest.fixture
+def start_mock():
+    """模擬サーバーを起動する関数 (起動したサーバーはテストの終了時に止める)"""
+    servers = []
+
+    def _start(**settings):
+        server = MockOpenRouterServer(**settings)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield _start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server(start_mock, monkeypatch, tmp_path):
+    """OpenRouter の代わりに送信先となる模擬サーバー (記録・ログはすべて tmp_path に書く)"""
+    server = start_mock(completion_tokens=60)
+    monkeypatch.setattr(report_transport, "OPENROUTER_API_URL", server.url)
+    config = {
+        "http": {"max_retries": 0, "backoff_base": 0.01},
+        "cache": {"path": str(tmp_path / "cache.sqlite3")},
+        "length_control": {"log_path": ""},
+        "fallback": {"enabled": True, "first_token_deadline": 5.0, "log_path": ""},
+        "job_store": {"path": str(tmp_path / "jobs.sqlite3")},
+        "archive": {"path": str(tmp_path / "archive.sqlite3")},
+        "metrics": {"enabled": False},
+        "model_catalog": {"enabled": False}
+    }
+    for configure in _CONFIGURES:
+        configure(config)
+    yield server
+    for configure in _CONFIGURES:
+        configure({"length_control": {"log_path": ""}, "fallback": {"log_path": ""}})
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+import llm_report_tool as tool
+import report_generation
+import report_materials
+import report_transport
+
+
+@pytest.fixture(autouse=True)
+def attachment_settings(tmp_path):
+    report_materials.configure_attachments({})
+    report_materials.configure_image_preprocess({"image_preprocess": {"enabled": False}}) # 画像は前処理せずにそのまま送る
+    yield
+    report_materials.configure_attachments({})
+    report_materials.configure_image_preprocess({})
+
+
+def _files(tmp_path, names, size=1024):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(b"\0" * size)
+        paths.append(str(path))
+    return paths
+
+
+def _settings(attachments, **overrides):
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="複数資料", material_type=report_materials.MULTI_MATERIAL_TYPE,
+                    attachments=attachments)
+    settings.update(overrides)
+    return settings
+
+
+def test_attachments_are_sent_in_order_with_a_description(tmp_path):
+    paths = _files(tmp_path, ["report.pdf", "chart.png", "photo.jpg"])
+    payload = report_materials.build_api_payload(_settings(paths))
+    content = payload["messages"][0]["content"]
+    assert content[0]["text"].startswith("添付された3件の資料 (PDF「report.pdf」、画像「chart.png」、画像「photo.jpg」)")
+    assert [item["type"] for item in content[2:]] == ["file", "image_url", "image_url"]
+    assert content[3]["image_url"]["url"].mime_type == "image/png" and content[4]["image_url"]["url"].mime_type == "image/jpeg"
+    assert payload["plugins"] == [{"id": "file-parser", "pdf": {"engine": report_materials.PDF_ENGINE_OPTIONS[0]}}]
+
+
+def test_local_pdf_engine_extracts_attached_pdfs_without_plugins(tmp_path):
+    paths = _files(tmp_path, ["a.pdf", "b.png"])
+    payload = report_materials.build_api_payload(_settings(paths, pdf_engine=report_materials.LOCAL_PDF_ENGINE))
+    content = payload["messages"][0]["content"]
+    assert isinstance(content[2]["text"], report_materials.PDFTextReference) and content[3]["type"] == "image_url"
+    assert "plugins" not in payload
+
+
+@pytest.mark.parametrize("attachments, message", [
+    ([], "添付ファイルが選択されていません"),
+    (["notes.docx"], "対応していない形式のファイルです: notes.docx"),
+])
+def test_invalid_attachments_are_rejected(tmp_path, attachments, message):
+    with pytest.raises(ValueError, match=message):
+        report_materials.build_api_payload(_settings(_files(tmp_path, attachments)))
+
+
+def test_attachments_are_prepared_in_parallel_with_progress(tmp_path, monkeypatch):
+    paths = _files(tmp_path, ["a.png", "b.png", "c.png", "d.pdf"])
+    payload = report_materials.build_api_payload(_settings(paths))
+    original = report_materials.preprocess_image
+    threads = set()
+
+    def slow_preprocess(path):
+        threads.add(threading.get_ident())
+        time.sleep(0.2)
+        return original(path)
+
+    monkeypatch.setattr(report_materials, "preprocess_image", slow_preprocess)
+    statuses, progress = [], []
+    started = time.perf_counter()
+    prepared = report_materials.prepare_payload_attachments(payload, on_status=statuses.append, compute_digests=True,
+                                                            on_attachment=lambda *args: progress.append(args))
+    assert time.perf_counter() - started < 0.5 # 直列なら 0.6秒以上かかる
+    assert len(threads) == 3
+    assert prepared is payload # 前処理で変わったファイルが無ければコピーしない
+    assert statuses == ["添付ファイル4件を準備中...", "添付ファイル4件の準備が完了しました (合計 4.0KB)"]
+    assert sorted(path for path, state, _ in progress if state == "完了") == sorted(paths)
+    assert all(state in ("準備中", "完了") for _, state, _ in progress)
+
+    progress.clear()
+    report_materials.prepare_payload_attachments(payload, on_attachment=lambda *args: progress.append(args))
+    assert progress == [] # 準備済みのファイルは再送信時に処理し直さない
+
+
+def test_total_size_over_the_limit_is_rejected(tmp_path):
+    report_materials.configure_attachments({"attachments": {"max_total_bytes": 3000}})
+    payload = report_materials.build_api_payload(_settings(_files(tmp_path, ["a.pdf", "b.png", "c.png"])))
+    with pytest.raises(report_transport.APIRequestError, match="合計サイズ"):
+        report_materials.prepare_payload_attachments(payload)
+
+
+def test_failed_attachment_is_reported_and_raised(tmp_path):
+    paths = _files(tmp_path, ["a.png", "missing.png"])
+    payload = report_materials.build_api_payload(_settings(paths))
+    (tmp_path / "missing.png").unlink()
+    progress = []
+    with pytest.raises(OSError):
+        report_materials.prepare_payload_attachments(payload, compute_digests=True, on_attachment=lambda *args: progress.append(args))
+    assert (paths[1], "エラー") in [(path, state) for path, state, _ in progress]
+
+
+def test_request_with_multiple_attachments_reaches_the_server(server, tmp_path):
+    paths = _files(tmp_path, ["a.pdf", "b.png"], size=4096)
+    payload = dict(report_materials.build_api_payload(_settings(paths)), model="vendor/model")
+    result = report_generation.request_completion("test-key", payload, use_cache=False)
+    assert result["content"]
+    assert server.stats["requests"] == 1 and server.stats["bytes_received"] > 2 * 4096 * 4 // 3 # Base64 で約4/3倍
+
+
+def test_batch_csv_attachments_are_split_on_semicolons(tmp_path):
+    jobs_path = tmp_path / "jobs.csv"
+    jobs_path.write_text("id,theme,attachments\nj1,複数資料, a.pdf ; b.png ;\n", encoding="utf-8")
+    job = tool.load_batch_jobs(jobs_path)[0]
+    assert job["attachments"] == ["a.pdf", "b.png"]
+    assert job["material_type"] == report_materials.MULTI_MATERIAL_TYPE
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import llm_report_tool as tool
+
+
+@pytest.fixture
+def workdir(server, monkeypatch, tmp_path):
+    """config.json・記録・出力をすべて tmp_path に置いてバッチ実行する"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    config = {
+        "models": ["vendor/model"],
+        "http": {"max_retries": 0, "backoff_base": 0.01},
+        "model_catalog": {"enabled": False},
+        "length_control": {"log_path": ""},
+        "fallback": {"enabled": False, "log_path": ""}
+    }
+    (tmp_path / tool.CONFIG_FILE).write_text(json.dumps(config), encoding="utf-8")
+    return tmp_path
+
+
+def _write_jobs(path, jobs):
+    path.write_text("".join(json.dumps(job, ensure_ascii=False) + "\n" for job in jobs), encoding="utf-8")
+    return str(path)
+
+
+def _results(output_dir):
+    with open(output_dir / tool.BATCH_RESULTS_FILE, encoding="utf-8") as f:
+        return {record["id"]: record for record in map(json.loads, f)}
+
+
+def test_batch_run_writes_outputs_and_exits_zero(server, workdir, capsys):
+    jobs = _write_jobs(workdir / "jobs.jsonl", [
+        {"id": "env01", "theme": "地球温暖化", "text_material": "気温の上昇について。"},
+        {"id": "ai 02", "theme": "AIと教育", "word_count": "800", "tone": "である調"}
+    ])
+    assert tool.main(["--batch", jobs, "--output-dir", "out", "--workers", "2"]) == 0
+    assert "完了: 2/2 件成功" in capsys.readouterr().out
+    results = _results(workdir / "out")
+    assert {record["status"] for record in results.values()} == {"ok"}
+    assert results["ai 02"]["output"] == "ai_02.txt" # ファイル名に使えない文字は置き換える
+    assert (workdir / "out" / "env01.txt").read_text(encoding="utf-8").startswith("[")
+    assert server.stats["requests"] == 2
+
+
+def test_batch_run_exits_two_when_a_job_fails(server, start_mock, workdir):
+    broken = start_mock(error_rate=1.0)
+    config = json.loads((workdir / tool.CONFIG_FILE).read_text(encoding="utf-8"))
+    config["providers"] = {"broken": {"base_url": broken.base_url, "models": ["broken/*"]}}
+    (workdir / tool.CONFIG_FILE).write_text(json.dumps(config), encoding="utf-8")
+    jobs = _write_jobs(workdir / "jobs.jsonl", [{"id": "ok", "theme": "成功"}, {"id": "ng", "theme": "失敗", "model": "broken/model"}])
+    assert tool.main(["--batch", jobs, "--output-dir", "out"]) == 2
+    results = _results(workdir / "out")
+    assert results["ok"]["status"] == "ok" and results["ng"]["status"] == "error"
+    assert sorted(path.name for path in (workdir / "out").iterdir()) == ["ok.txt", tool.BATCH_RESULTS_FILE]
+
+
+def test_batch_run_exits_one_on_unreadable_job_file(workdir):
+    (workdir / "jobs.jsonl").write_text('{"id": "a"}\n{壊れた行\n', encoding="utf-8")
+    assert tool.main(["--batch", str(workdir / "jobs.jsonl"), "--output-dir", "out"]) == 1
+    assert not (workdir / "out").exists()
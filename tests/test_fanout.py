@@ -0,0 +1,74 @@
+import threading
+import time
+import types
+
+import llm_report_tool as tool
+import report_generation
+import report_materials
+import report_stores
+import report_transport
+
+
+def _run_fanout(payload, models, settings=None, stream=True):
+    """start_fanout_request と同じく1モデル1スレッドで実行し、モデルごとのメッセージを返す"""
+    messages = []
+    gui = types.SimpleNamespace(_post_message=messages.append) # 画面を作らずにワーカースレッドの処理だけを動かす
+    token = report_transport.CancelToken()
+    threads = [threading.Thread(target=tool.PromptGeneratorGUI._fanout_request_thread,
+                                args=(gui, model, "test-key", dict(payload, model=model), stream, False, token, None,
+                                      dict(settings or {}, model=model)))
+               for model in models]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    elapsed = time.perf_counter() - started
+    by_model = {model: [] for model in models}
+    for message_type, (cancel_token, model, kind, data) in messages:
+        assert message_type == "fanout" and cancel_token is token
+        by_model[model].append((kind, data))
+    return by_model, elapsed
+
+
+def _route(providers):
+    report_transport.configure_providers({"providers": {name: {"base_url": mock.base_url, "models": [f"{name}/*"]}
+                                                        for name, mock in providers.items()}})
+
+
+def _payload():
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="複数モデルの比較", material_type="テキスト資料",
+                    text_material="資料の本文です。")
+    return report_materials.build_api_payload(settings)
+
+
+def test_models_run_concurrently_and_report_per_model(server, start_mock):
+    first, second = start_mock(latency=0.5, completion_tokens=20), start_mock(latency=0.5, completion_tokens=20)
+    _route({"first": first, "second": second})
+    by_model, elapsed = _run_fanout(_payload(), ["first/model", "second/model"])
+    assert elapsed < 0.9 # 直列なら 1秒以上かかる
+    for model, mock in [("first/model", first), ("second/model", second)]:
+        kinds = [kind for kind, _ in by_model[model]]
+        assert kinds[-1] == "done" and "delta" in kinds
+        result = by_model[model][-1][1]
+        assert result["content"] == "".join(data for kind, data in by_model[model] if kind == "delta")
+        assert "合計" in report_generation.format_result_stats(result)
+        assert mock.stats["requests"] == 1
+    assert server.stats["requests"] == 0
+
+
+def test_failed_model_does_not_affect_the_others(server, start_mock):
+    _route({"ok": start_mock(completion_tokens=20), "broken": start_mock(error_rate=1.0)})
+    by_model, _ = _run_fanout(_payload(), ["ok/model", "broken/model"], stream=False)
+    assert by_model["ok/model"][-1][0] == "done"
+    assert [kind for kind, _ in by_model["broken/model"]] == ["error"] # エラーはそのモデルのタブにだけ表示する
+    assert "500" in by_model["broken/model"][0][1]
+
+
+def test_each_result_is_archived_with_its_model(server, start_mock):
+    _route({"first": start_mock(completion_tokens=20), "second": start_mock(completion_tokens=20)})
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="アーカイブの確認")
+    _run_fanout(_payload(), ["first/model", "second/model"], settings)
+    archive = report_stores.get_report_archive()
+    reports = [archive.get(report["id"]) for report in archive.search("アーカイブの確認")]
+    assert sorted((report["source"], report["model"]) for report in reports) == [("fanout", "first/model"), ("fanout", "second/model")]
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import report_transport
+
+
+class FakeResponse:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def http_settings():
+    report_transport.configure_http({"http": {"max_retries": 2, "backoff_base": 0.01, "backoff_max": 0.05}})
+    yield
+    report_transport.configure_http({})
+
+
+def _http_date(seconds):
+    return format_datetime(datetime.now(timezone.utc) + timedelta(seconds=seconds), usegmt=True)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({}, None),
+    ({"Retry-After": "2"}, 2.0),
+    ({"Retry-After": "0.5"}, 0.5),
+    ({"Retry-After": "-3"}, 0.0),
+    ({"Retry-After": _http_date(-60)}, 0.0), # 過去の日時
+    ({"Retry-After": "soon"}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert report_transport._retry_after_seconds(FakeResponse(headers)) == expected
+
+
+def test_retry_after_http_date_is_converted_to_seconds():
+    assert 25 <= report_transport._retry_after_seconds(FakeResponse({"Retry-After": _http_date(30)})) <= 30
+
+
+def test_backoff_delay_prefers_retry_after_and_caps_it():
+    report_transport.configure_http({"http": {"backoff_base": 1.0, "backoff_max": 10.0}})
+    assert report_transport._backoff_delay(0, FakeResponse({"Retry-After": "3"})) == 3.0
+    assert report_transport._backoff_delay(0, FakeResponse({"Retry-After": "120"})) == 10.0
+    for attempt, high in [(0, 1.0), (2, 4.0), (5, 10.0)]:
+        assert high / 2 <= report_transport._backoff_delay(attempt) <= high # ジッター付き指数バックオフ
+
+
+def _post(server, **kwargs):
+    retries = []
+    response = report_transport.post_with_retry(server.url, {"Content-Type": "application/json"},
+                                                {"model": "m", "messages": [{"role": "user", "content": "こんにちは"}]},
+                                                on_retry=lambda *args: retries.append(args), **kwargs)
+    return response, retries
+
+
+def test_429_is_retried_after_retry_after_and_returned_when_retries_run_out(start_mock):
+    server = start_mock(rate_limit_rate=1.0, retry_after=1)
+    response, retries = _post(server)
+    assert response.status_code == 429
+    assert retries == [(1, 0.05, "HTTP 429"), (2, 0.05, "HTTP 429")] # Retry-After (1秒) を backoff_max で切り詰める
+    assert server.stats["requests"] == 3
+
+
+def test_5xx_is_retried_and_max_retries_overrides_the_setting(start_mock):
+    server = start_mock(error_rate=1.0)
+    response, retries = _post(server, max_retries=1)
+    assert response.status_code == 500
+    assert [(attempt, reason) for attempt, _, reason in retries] == [(1, "HTTP 500")]
+    assert server.stats["requests"] == 2
+
+
+def test_success_is_returned_without_retry(start_mock):
+    server = start_mock(completion_tokens=3)
+    response, retries = _post(server)
+    assert response.ok and retries == []
+    assert response.json()["choices"][0]["message"]["content"]
+
+
+def test_connection_errors_are_retried_then_raised(start_mock):
+    closed = start_mock()
+    closed.stop() # 接続を拒否するポート
+    retries = []
+    with pytest.raises(report_transport.requests.exceptions.ConnectionError):
+        report_transport.post_with_retry(closed.url, {}, {"model": "m", "messages": []}, on_retry=lambda *args: retries.append(args))
+    assert [(attempt, reason) for attempt, _, reason in retries] == [(1, "接続エラー"), (2, "接続エラー")]
+
+
+def test_cancel_during_backoff_raises_request_cancelled(start_mock):
+    server = start_mock(rate_limit_rate=1.0, retry_after=30)
+    report_transport.configure_http({"http": {"backoff_max": 30.0}})
+    token = report_transport.CancelToken()
+    with pytest.raises(report_transport.RequestCancelled):
+        report_transport.post_with_retry(server.url, {"Content-Type": "application/json"}, {"model": "m", "messages": []},
+                                         on_retry=lambda *args: token.cancel(), cancel_token=token) # 30秒の待機をすぐに打ち切る
+    assert server.stats["requests"] == 1
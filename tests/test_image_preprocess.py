@@ -0,0 +1,91 @@
+import os
+import random
+
+import pytest
+
+import report_materials
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture(autouse=True)
+def image_settings(tmp_path):
+    report_materials.configure_image_preprocess({"image_preprocess": {"max_edge": 128, "cache_dir": str(tmp_path / "cache")}})
+    yield
+    report_materials.configure_image_preprocess({})
+
+
+def _noise(size, mode="RGB", seed=0):
+    """圧縮の効きにくい (縮小すると小さくなる) 画像"""
+    rng = random.Random(seed)
+    channels = len(mode)
+    return Image.frombytes(mode, size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * channels)))
+
+
+def test_large_image_is_downscaled_and_reencoded(tmp_path):
+    path = tmp_path / "photo.png"
+    _noise((400, 200)).save(path)
+    processed, mime_type = report_materials.preprocess_image(str(path))
+    assert mime_type == "image/jpeg" and processed.endswith(".jpg")
+    assert os.path.getsize(processed) < os.path.getsize(path)
+    with Image.open(processed) as image:
+        assert image.size == (128, 64) and image.format == "JPEG"
+
+
+def test_exif_orientation_is_applied(tmp_path):
+    path = tmp_path / "portrait.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6 # 右に90度回転して表示する
+    _noise((400, 200)).save(path, quality=95, exif=exif)
+    processed, _ = report_materials.preprocess_image(str(path))
+    with Image.open(processed) as image:
+        assert image.size == (64, 128)
+
+
+def test_transparency_becomes_white_in_jpeg(tmp_path):
+    path = tmp_path / "logo.png"
+    image = _noise((400, 400), "RGBA")
+    image.paste((0, 0, 0, 0), (0, 0, 200, 400)) # 左半分を透明にする
+    image.save(path)
+    processed, _ = report_materials.preprocess_image(str(path))
+    with Image.open(processed) as result:
+        assert result.mode == "RGB"
+        assert all(channel >= 245 for channel in result.getpixel((10, 64)))
+
+
+def test_result_is_reused_from_the_cache(tmp_path, monkeypatch):
+    path = tmp_path / "photo.png"
+    _noise((400, 200)).save(path)
+    first = report_materials.preprocess_image(str(path))
+    monkeypatch.setattr(Image, "open", lambda *args, **kwargs: pytest.fail("キャッシュ済みの画像を再変換した"))
+    assert report_materials.preprocess_image(str(path)) == first
+
+
+def test_image_that_does_not_shrink_is_sent_as_is(tmp_path, monkeypatch):
+    path = tmp_path / "icon.png"
+    Image.new("RGB", (32, 32), (10, 20, 30)).save(path) # 単色の小さなPNGは JPEG にしても小さくならない
+    assert report_materials.preprocess_image(str(path)) == (str(path), "image/png")
+    assert [p.suffix for p in (tmp_path / "cache").iterdir()] == [".original"]
+    monkeypatch.setattr(Image, "open", lambda *args, **kwargs: pytest.fail("効果が無かった画像を再変換した"))
+    assert report_materials.preprocess_image(str(path)) == (str(path), "image/png")
+
+
+@pytest.mark.parametrize("filename, settings", [
+    ("anim.gif", {}),                     # アニメーションを保つため対象外
+    ("photo.png", {"enabled": False}),
+    ("photo.png", {"format": "TIFF"}),    # 非対応の出力形式
+])
+def test_skipped_images_are_returned_unchanged(tmp_path, filename, settings):
+    report_materials.configure_image_preprocess({"image_preprocess": dict(settings, max_edge=128, cache_dir=str(tmp_path / "cache"))})
+    path = tmp_path / filename
+    _noise((400, 200)).save(path)
+    assert report_materials.preprocess_image(str(path)) == (str(path), report_materials.get_mime_type(str(path)))
+    assert not (tmp_path / "cache").exists()
+
+
+def test_webp_output(tmp_path):
+    report_materials.configure_image_preprocess({"image_preprocess": {"max_edge": 128, "format": "webp", "cache_dir": str(tmp_path / "cache")}})
+    path = tmp_path / "photo.png"
+    _noise((400, 200)).save(path)
+    processed, mime_type = report_materials.preprocess_image(str(path))
+    assert mime_type == "image/webp" and processed.endswith(".webp")
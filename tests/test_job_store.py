@@ -0,0 +1,70 @@
+import json
+
+import llm_report_tool as tool
+import report_materials
+import report_stores
+import report_transport
+
+
+def _job(job_id, model):
+    return dict(report_materials.DEFAULT_REPORT_SETTINGS, id=job_id, theme=f"テーマ {job_id}", material_type="テキスト資料",
+                text_material="資料の本文です。", model=model, fallback_models=[])
+
+
+def _read_results(output_dir):
+    with open(output_dir / tool.BATCH_RESULTS_FILE, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_interrupted_and_failed_jobs_resume_and_done_jobs_are_not_resent(server, start_mock, tmp_path):
+    report_stores.configure_cache({"cache": {"enabled": False}}) # 再送信の有無をジョブの記録だけで判定する
+    broken = start_mock(error_rate=1.0)
+    report_transport.configure_providers({"providers": {"broken": {"base_url": broken.base_url, "models": ["broken/*"]}}})
+    interrupted, failing = _job("a", "vendor/model"), _job("b", "broken/model")
+    store = report_stores.get_job_store()
+    interrupted_key, failing_key = report_stores.make_job_key(interrupted), report_stores.make_job_key(failing)
+    store.submit(interrupted_key, "batch", interrupted)
+    store.start(interrupted_key) # 前回の実行が異常終了して running のまま残った
+
+    output_dir = tmp_path / "out"
+    assert tool.run_batch([interrupted, failing], "test-key", output_dir) == 1
+    assert store.get(interrupted_key)["status"] == "done" and store.get(interrupted_key)["attempts"] == 2
+    assert store.get(failing_key)["status"] == "error"
+    assert server.stats["requests"] == 1 and broken.stats["requests"] == 1
+
+    # 失敗したモデルが復旧した後に同じジョブで再実行する
+    report_transport.configure_providers({"providers": {"broken": {"base_url": server.base_url, "models": ["broken/*"]}}})
+    assert tool.run_batch([_job("a", "vendor/model"), _job("b", "broken/model")], "test-key", output_dir) == 2
+    assert server.stats["requests"] == 2 and broken.stats["requests"] == 1 # 完了済みの a は送信されない
+    assert store.get(failing_key)["status"] == "done" and store.get(failing_key)["attempts"] == 2
+    assert store.unfinished("batch") == []
+
+    second_run = {record["id"]: record for record in _read_results(output_dir)[2:]}
+    assert second_run["a"]["resumed"] and not second_run["b"].get("resumed")
+    assert (output_dir / "a.txt").read_text(encoding="utf-8") == store.get(interrupted_key)["result"]["content"]
+
+
+def test_done_job_result_is_returned_without_an_api_call(server, tmp_path):
+    job = _job("c", "vendor/model")
+    store = report_stores.get_job_store()
+    key = report_stores.make_job_key(job)
+    store.submit(key, "batch", job)
+    store.complete(key, {"id": "c", "status": "ok", "model": "vendor/model", "content": "保存済みのレポート"})
+
+    assert tool.run_batch([job], "test-key", tmp_path / "out") == 1
+    assert server.stats["requests"] == 0
+    assert (tmp_path / "out" / "c.txt").read_text(encoding="utf-8") == "保存済みのレポート"
+    assert _read_results(tmp_path / "out") == [{"id": "c", "status": "ok", "model": "vendor/model", "resumed": True, "output": "c.txt"}]
+
+
+def test_unfinished_lists_pending_and_running_jobs_only(tmp_path):
+    store = report_stores.JobStore(tmp_path / "jobs.sqlite3")
+    for key in ("pending", "running", "done", "error", "cancelled"):
+        store.submit(key, "gui", {"theme": key})
+    store.start("running")
+    store.complete("done", {"content": "完了"})
+    store.fail("error", "失敗")
+    store.fail("cancelled", None, "cancelled")
+    store.submit("other", "batch", {})
+    assert {job["key"] for job in store.unfinished("gui")} == {"pending", "running"}
+    assert store.submit("done", "gui", {"theme": "再登録"})["settings"] == {"theme": "done"} # 既存の記録は上書きしない
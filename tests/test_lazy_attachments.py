@@ -0,0 +1,73 @@
+import builtins
+import hashlib
+import os
+
+import pytest
+
+import report_generation
+import report_materials
+import report_stores
+import report_transport
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """open() に渡されたパスの記録"""
+    paths = []
+    original = builtins.open
+
+    def _open(file, *args, **kwargs):
+        paths.append(os.path.abspath(file) if isinstance(file, (str, os.PathLike)) else file)
+        return original(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", _open)
+    return paths
+
+
+@pytest.mark.parametrize("material_type, filename, engine, reference", [
+    ("画像", "photo.png", None, {"type": "image_url"}),
+    ("PDF", "slides.pdf", "pdf-text", {"type": "file"}),
+    ("PDF", "slides.pdf", report_materials.LOCAL_PDF_ENGINE, {"type": "text"}),
+])
+def test_building_and_estimating_the_payload_does_not_read_the_material(tmp_path, opened, material_type, filename, engine, reference):
+    path = tmp_path / filename
+    path.write_bytes(b"\0" * 4096)
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="遅延読み込み", material_type=material_type, material_path=str(path))
+    if engine:
+        settings["pdf_engine"] = engine
+    payload = report_materials.build_api_payload(settings)
+    report_generation.estimate_payload_tokens(payload) # プロンプト生成時の推定トークン数の表示
+    report_materials.build_instruction_text(settings)
+    assert str(path) not in opened # 読み込み・ハッシュ計算・エンコードは送信するスレッドで行う
+    item = payload["messages"][0]["content"][-1]
+    assert item["type"] == reference["type"]
+    attachment = item.get("image_url", {}).get("url") or item.get("file", {}).get("file_data") or item.get("text")
+    assert isinstance(attachment, (report_transport.FileDataURL, report_materials.PDFTextReference)) # ファイルの参照だけを持つ
+    assert attachment.path == str(path)
+
+
+def test_file_digest_is_cached_until_the_file_changes(tmp_path, opened):
+    path = tmp_path / "material.bin"
+    path.write_bytes(b"first")
+    first = report_transport.cached_file_digest(str(path))
+    assert first == hashlib.sha256(b"first").hexdigest()
+    assert report_transport.cached_file_digest(str(path)) == first
+    assert opened.count(str(path)) == 1 # 2回目は (パス, サイズ, 更新時刻) が同じため読み込まない
+
+    path.write_bytes(b"second version")
+    assert report_transport.cached_file_digest(str(path)) == hashlib.sha256(b"second version").hexdigest()
+    assert opened.count(str(path)) == 2
+
+
+def test_cache_key_identifies_attachments_by_content(tmp_path):
+    paths = [tmp_path / "a.png", tmp_path / "b.png"]
+    for path in paths:
+        path.write_bytes(b"same image")
+
+    def _key(path):
+        return report_stores.make_cache_key({"model": "m", "stream": True, "messages": [{"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": report_transport.FileDataURL(path, "image/png")}}]}]})
+
+    assert _key(paths[0]) == _key(paths[1]) # 同じ内容なら別のファイルでも同じ応答を使える
+    paths[1].write_bytes(b"other image")
+    assert _key(paths[0]) != _key(paths[1])
@@ -0,0 +1,51 @@
+import pytest
+
+import report_generation
+
+
+@pytest.fixture(autouse=True)
+def length_settings(tmp_path):
+    report_generation.configure_length_control({"length_control": {"log_path": str(tmp_path / "length_log.jsonl")}})
+    yield
+    report_generation.configure_length_control({"length_control": {"log_path": ""}})
+
+
+@pytest.mark.parametrize("word_count, expected", [
+    ("800", 800), ("1,200字", 1200), ("800〜1000字", 1000), ("約２０００字", 2000), ("", None), ("指定なし", None), (None, None),
+])
+def test_parse_target_chars(word_count, expected):
+    assert report_generation.parse_target_chars(word_count) == expected
+
+
+def test_length_target_detects_language_and_respects_enabled():
+    assert report_generation.length_target({"word_count": "1000字", "theme": "環境問題"}) == {"chars": 1000, "language": "ja"}
+    assert report_generation.length_target({"word_count": "300", "opinion": "Write it in English."}) == {"chars": 300, "language": "en"}
+    assert report_generation.length_target({"word_count": ""}) is None
+    report_generation.configure_length_control({"length_control": {"enabled": False, "log_path": ""}})
+    assert report_generation.length_target({"word_count": "1000"}) is None
+
+
+def test_token_ceiling_and_early_stop_use_margin():
+    ja = {"chars": 1000, "language": "ja"}
+    assert report_generation.early_stop_chars(ja) == 1200
+    assert report_generation.length_token_ceiling("vendor/model", ja) == 1801 # 1200字 × 1.0 × 1.5
+    assert report_generation.length_token_ceiling("vendor/model", {"chars": 1000, "language": "en"}) == 541
+    assert report_generation.length_token_ceiling("vendor/model", {"chars": 100, "language": "ja"}) == 512 # min_tokens
+    assert report_generation.length_token_ceiling("deepseek/deepseek-r1", ja) is None
+    assert report_generation.length_token_ceiling("vendor/model", None) is None
+
+
+def test_recorded_results_calibrate_tokens_per_char(tmp_path):
+    target = {"chars": 1000, "language": "ja"}
+    report_generation.record_length_result("vendor/model", target, {"content": "あ" * 500, "usage": {"completion_tokens": 1000}})
+    # 打ち切られた出力は文字数が本来より短いため較正に使わない
+    report_generation.record_length_result("vendor/model", target,
+                                           {"content": "あ" * 100, "usage": {"completion_tokens": 1000}, "stopped_early": True})
+    report_generation.record_length_result("vendor/model", target,
+                                           {"content": "あ" * 100, "usage": {"completion_tokens": 1000}, "finish_reason": "length"})
+    assert report_generation.get_tokens_per_char("vendor/model", "ja") == 2.0
+    assert report_generation.get_tokens_per_char("other/model", "ja") == 1.0
+    # ログから読み直しても同じ値になる
+    report_generation.configure_length_control({"length_control": {"log_path": str(tmp_path / "length_log.jsonl")}})
+    assert report_generation.get_tokens_per_char("vendor/model", "ja") == 2.0
+    assert report_generation.length_token_ceiling("vendor/model", target) == 3601
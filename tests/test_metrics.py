@@ -0,0 +1,28 @@
+import report_metrics
+
+
+def test_percentile_uses_nearest_rank():
+    assert report_metrics._percentile([], 50) is None
+    assert report_metrics._percentile([3, 1, 2], 50) == 2
+    assert report_metrics._percentile(list(range(1, 21)), 95) == 19
+    assert report_metrics._percentile([5], 95) == 5
+
+
+def test_summarize_metrics_groups_by_model_and_skips_cached_and_cancelled():
+    records = [{"model": "a", "status": "ok", "ttft": t / 10, "elapsed": t, "usage": {"completion_tokens": 100 * t}} for t in range(1, 11)]
+    records += [
+        {"model": "a", "status": "error", "ttft": None, "elapsed": 99},
+        {"model": "a", "status": "ok", "cached": True, "ttft": 0, "elapsed": 0},
+        {"model": "a", "status": "cancelled", "elapsed": 99},
+        {"status": "ok", "ttft": None, "elapsed": 2.0},
+    ]
+    summary = {row["model"]: row for row in report_metrics.summarize_metrics(records)}
+    assert list(summary) == ["(不明)", "a"]
+    a = summary["a"]
+    assert (a["runs"], a["errors"]) == (11, 1)
+    assert (a["ttft_p50"], a["ttft_p95"]) == (0.5, 1.0)
+    assert (a["elapsed_p50"], a["elapsed_p95"]) == (5, 10)
+    assert a["completion_tokens_p50"] == 500
+    unknown = summary["(不明)"]
+    assert unknown["ttft_p50"] is None and unknown["completion_tokens_p50"] is None
+    assert "(不明)" in report_metrics.format_metrics_summary(report_metrics.summarize_metrics(records))
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+import report_generation
+import report_transport
+
+
+def _payload(text="レポートを作成してください。"):
+    return {"model": "vendor/model", "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}]}
+
+
+def test_streaming_delivers_deltas_and_caches_the_result(server):
+    deltas, first_tokens = [], []
+    result = report_generation.request_completion("test-key", _payload(), stream=True,
+                                                 on_delta=deltas.append, on_first_token=first_tokens.append)
+    assert result["content"] == "".join(deltas)
+    assert result["content"].startswith("[レポートを作成してください。] これは")
+    assert len(first_tokens) == 1 and result["usage"]["completion_tokens"] == 61
+    assert not result.get("stopped_early")
+
+    cached = report_generation.request_completion("test-key", _payload(), stream=True)
+    assert cached["cached"] and cached["content"] == result["content"]
+    assert server.stats["requests"] == 1
+
+
+def test_early_stop_cuts_at_sentence_end_and_is_not_cached(server):
+    target = {"chars": 20, "language": "ja"}
+    full = report_generation.request_completion("test-key", _payload("全文"), stream=True, use_cache=False)
+    result = report_generation.request_completion("test-key", _payload(), stream=True, target=target)
+    assert result["stopped_early"]
+    assert report_generation.early_stop_chars(target) <= len(result["content"]) < len(full["content"])
+    assert result["content"].endswith("。")
+
+    again = report_generation.request_completion("test-key", _payload(), stream=True, target=target)
+    assert not again.get("cached")
+    assert server.stats["requests"] == 3
+
+
+@pytest.mark.parametrize("broken_settings", [{"error_rate": 1.0}, {"latency": 2.0}])
+def test_fallback_switches_to_next_model_on_error_or_deadline(server, start_mock, broken_settings):
+    broken = start_mock(**broken_settings)
+    report_transport.configure_providers({"providers": {"broken": {"base_url": broken.base_url, "models": ["broken/*"]}}})
+    report_generation.configure_fallback({"fallback": {"enabled": True, "first_token_deadline": 0.3, "log_path": ""}})
+    chain = report_generation.get_fallback_chain("broken/model", ["broken/model", "vendor/model"])
+    deltas = []
+    result = report_generation.request_with_fallback("test-key", _payload(), chain, stream=True,
+                                                      on_delta=deltas.append, use_cache=False)
+    assert chain == ["broken/model", "vendor/model"]
+    assert result["model"] == "vendor/model"
+    assert result["fallback"]["saved"] and result["fallback"]["outcome"] == "ok"
+    assert result["content"] == "".join(deltas)
+    assert broken.stats["requests"] == 1 and server.stats["requests"] == 1
+
+
+def _fallback_to_vendor(broken, stream):
+    report_transport.configure_providers({"providers": {"broken": {"base_url": broken.base_url, "models": ["broken/*"]}}})
+    report_generation.configure_fallback({"fallback": {"enabled": True, "first_token_deadline": 0.3, "log_path": ""}})
+    chain = report_generation.get_fallback_chain("broken/model", ["broken/model", "vendor/model"])
+    return report_generation.request_with_fallback("test-key", _payload(), chain, stream=stream, use_cache=False)
+
+
+def test_non_stream_slow_primary_is_not_hedged(server, start_mock):
+    slow = start_mock(latency=1.0)
+    result = _fallback_to_vendor(slow, stream=False)
+    assert result["model"] == "broken/model"
+    assert not result["fallback"]["hedged"]
+    assert slow.stats["requests"] == 1 and server.stats["requests"] == 0
+
+
+def test_non_stream_failed_primary_is_taken_over_by_next_model(server, start_mock):
+    broken = start_mock(error_rate=1.0)
+    result = _fallback_to_vendor(broken, stream=False)
+    assert result["model"] == "vendor/model"
+    assert result["fallback"]["saved"]
+    assert [attempt["status"] for attempt in result["fallback"]["attempts"]] == ["error", "ok"]
+    assert broken.stats["requests"] == 1 and server.stats["requests"] == 1
+
+
+def test_fallback_deadline_starts_when_the_request_is_sent(server, start_mock, monkeypatch):
+    original = report_generation.fit_payload_to_budget
+
+    def slow_fit(payload, budget, policy=None):
+        time.sleep(0.5) # 締め切り (0.3秒) より長い資料の準備
+        return original(payload, budget, policy)
+
+    monkeypatch.setattr(report_generation, "fit_payload_to_budget", slow_fit)
+    spare = start_mock()
+    report_transport.configure_providers({"providers": {"spare": {"base_url": spare.base_url, "models": ["spare/*"]}}})
+    report_generation.configure_fallback({"fallback": {"enabled": True, "first_token_deadline": 0.3, "log_path": ""}})
+    result = report_generation.request_with_fallback("test-key", _payload(), ["vendor/model", "spare/model"], stream=True,
+                                                      use_cache=False)
+    assert result["model"] == "vendor/model"
+    assert not result["fallback"]["hedged"]
+    assert result["fallback"]["attempts"][0]["sent_at"] is not None
+    assert spare.stats["requests"] == 0
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+import report_catalog
+import report_generation
+
+MODELS = [
+    {"id": "vision/model", "name": "Vision", "context_length": 200000,
+     "architecture": {"input_modalities": ["text", "image", "file"]},
+     "pricing": {"prompt": "0.000003", "completion": "0.000015"}, "top_provider": {"max_completion_tokens": 8192}},
+    {"id": "text/model:free", "name": "Text", "context_length": 32768,
+     "architecture": {"modality": "text->text"}, "pricing": {"prompt": "0", "completion": "0"}},
+]
+
+
+@pytest.fixture
+def catalog_server(start_mock, tmp_path):
+    """モデル一覧を返す模擬サーバーを参照するモデルカタログ"""
+    server = start_mock(models=MODELS)
+    report_catalog.configure_model_catalog({"model_catalog": {"url": server.models_url, "cache_path": str(tmp_path / "catalog.json"),
+                                                              "ttl_seconds": 3600}})
+    yield server
+    report_catalog.configure_model_catalog({})
+
+
+def test_refresh_parses_the_model_list_and_saves_it(catalog_server, tmp_path):
+    catalog = report_catalog.get_model_catalog()
+    assert catalog.models == {} and not catalog.is_fresh # 取得は refresh まで行わない
+    assert catalog.refresh() is True
+    assert catalog.get("vision/model") == {"name": "Vision", "context_length": 200000, "input_modalities": ["text", "image", "file"],
+                                           "prompt_price": 0.000003, "completion_price": 0.000015, "max_completion_tokens": 8192}
+    assert catalog.get("text/model:free")["input_modalities"] == ["text"] # "modality" から入力形式を読み取る
+    saved = json.loads((tmp_path / "catalog.json").read_text(encoding="utf-8"))
+    assert saved["models"] == catalog.models and saved["etag"] == catalog.etag
+
+
+def test_fresh_cache_is_used_without_a_request(catalog_server, tmp_path):
+    report_catalog.get_model_catalog().refresh()
+    reloaded = report_catalog.ModelCatalog(catalog_server.models_url, tmp_path / "catalog.json", 3600)
+    assert reloaded.is_fresh and reloaded.get("vision/model")["context_length"] == 200000
+    assert reloaded.refresh() is False
+    assert catalog_server.stats["model_list_requests"] == 1
+
+
+def test_expired_cache_is_revalidated_with_the_etag(catalog_server, tmp_path):
+    report_catalog.get_model_catalog().refresh()
+    stale = report_catalog.ModelCatalog(catalog_server.models_url, tmp_path / "catalog.json", 0)
+    assert not stale.is_fresh
+    assert stale.refresh() is False # 304: 一覧はそのままで取得時刻だけ更新する
+    assert catalog_server.stats["not_modified"] == 1
+    assert stale.get("vision/model") is not None
+    catalog_server.models = MODELS[:1]
+    assert stale.refresh() is True
+    assert stale.get("text/model:free") is None
+
+
+def test_broken_cache_file_is_ignored(tmp_path):
+    (tmp_path / "catalog.json").write_text("{壊れた", encoding="utf-8")
+    catalog = report_catalog.ModelCatalog("http://127.0.0.1:9/api/v1/models", tmp_path / "catalog.json", 3600)
+    assert catalog.models == {} and not catalog.is_fresh
+
+
+@pytest.mark.parametrize("material_type, pdf_engine, attachments, expected", [
+    ("テキスト資料", "pdf-text", None, ["vision/model", "text/model:free", "unknown/model"]),
+    ("画像", "pdf-text", None, ["vision/model", "unknown/model"]),                 # カタログに無いモデルは対応とみなす
+    ("PDF", "native", None, ["vision/model", "unknown/model"]),
+    ("PDF", "pdf-text", None, ["vision/model", "text/model:free", "unknown/model"]), # テキスト化して送るため形式は問わない
+    ("複数ファイル", "pdf-text", ["a.pdf", "b.png"], ["vision/model", "unknown/model"]),
+    ("複数ファイル", "pdf-text", ["a.pdf"], ["vision/model", "text/model:free", "unknown/model"]),
+])
+def test_filter_models_for_material(catalog_server, material_type, pdf_engine, attachments, expected):
+    report_catalog.get_model_catalog().refresh()
+    models = ["vision/model", "text/model:free", "unknown/model"]
+    assert report_catalog.filter_models_for_material(models, material_type, pdf_engine, attachments) == expected
+
+
+def test_format_model_info(catalog_server):
+    report_catalog.get_model_catalog().refresh()
+    assert report_catalog.format_model_info("vision/model") == (
+        "コンテキスト 200,000 トークン / 入力 $3.00 / 出力 $15.00 (100万トークンあたり) / 入力: テキスト・画像・ファイル")
+    assert report_catalog.format_model_info("text/model:free") == "コンテキスト 32,768 トークン / 無料 / 入力: テキスト"
+    assert report_catalog.format_model_info("unknown/model") == ""
+
+
+def test_context_limit_comes_from_the_catalog_unless_configured(catalog_server):
+    report_catalog.get_model_catalog().refresh()
+    report_generation.configure_token_budget({"token_budget": {"context_limits": {"text/model:free": 8000}}})
+    try:
+        assert report_generation.get_model_context_limit("vision/model") == 200000
+        assert report_generation.get_model_context_limit("text/model:free") == 8000 # config.json の指定を優先する
+        assert report_generation.get_model_context_limit("unknown/model") == report_generation.TOKEN_BUDGET_SETTINGS["default_context_tokens"]
+    finally:
+        report_generation.configure_token_budget({})
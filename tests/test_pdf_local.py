@@ -0,0 +1,117 @@
+import re
+import time
+
+import pytest
+
+import report_generation
+import report_materials
+import report_transport
+
+pytest.importorskip("pypdf")
+
+
+def _write_pdf(path, page_texts):
+    """1行のテキストを持つページからなる最小限のPDFを書き出す (空文字列のページはテキスト無し)"""
+    page_ids = [4 + 2 * i for i in range(len(page_texts))]
+    objects = {
+        1: "<< /Type /Catalog /Pages 2 0 R >>",
+        2: f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_texts)} >>",
+        3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    for page_id, text in zip(page_ids, page_texts):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET" if text else ""
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >>"
+                            f" /Contents {page_id + 1} 0 R >>")
+        objects[page_id + 1] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+    data = b"%PDF-1.4\n"
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(data)
+        data += f"{number} 0 obj\n{objects[number]}\nendobj\n".encode("latin-1")
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    data += "".join(f"{offsets[number]:010d} 00000 n \n" for number in sorted(objects)).encode("ascii")
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.fixture
+def pdf_settings(tmp_path):
+    report_materials.configure_pdf_local({"pdf_local": {"max_direct_chars": 200, "chunk_chars": 60, "extract_processes": 1,
+                                                        "cache_dir": str(tmp_path / "pdf_cache")}})
+    yield
+    report_materials.configure_pdf_local({})
+
+
+def _payload(pdf_path):
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="PDFの要約", material_type="PDF", material_path=pdf_path,
+                    pdf_engine=report_materials.LOCAL_PDF_ENGINE)
+    return dict(report_materials.build_api_payload(settings), model="vendor/model")
+
+
+def test_short_pdf_text_is_inlined_without_api_calls(server, pdf_settings, tmp_path):
+    pdf_path = _write_pdf(tmp_path / "short.pdf", ["First page text", "Second page text"])
+    payload = _payload(pdf_path)
+    resolved = report_generation.resolve_local_pdf_text("test-key", payload)
+    material = resolved["messages"][0]["content"][-1]["text"]
+    assert material == f"{report_materials.MATERIAL_HEADING}\nFirst page text\nSecond page text"
+    assert isinstance(payload["messages"][0]["content"][-1]["text"], report_materials.PDFTextReference) # 元のペイロードはそのまま
+    assert server.stats["requests"] == 0
+
+
+def test_extracted_text_is_cached_per_file(pdf_settings, tmp_path, monkeypatch):
+    pdf_path = _write_pdf(tmp_path / "cached.pdf", ["Cached page"])
+    assert report_materials.extract_pdf_text(pdf_path) == ["Cached page"]
+    monkeypatch.setattr(report_materials, "_extract_pdf_pages", lambda *args: pytest.fail("キャッシュ済みのPDFを再抽出した"))
+    assert report_materials.extract_pdf_text(pdf_path) == ["Cached page"]
+
+
+def test_long_pdf_is_summarized_per_chunk_in_page_order(server, start_mock, pdf_settings, tmp_path):
+    def responder(prompt):
+        index, total = map(int, re.search(r"の一部 \((\d+)/(\d+)\)", prompt).groups())
+        time.sleep(0.05 * (total - index)) # 後ろのチャンクほど先に要約が返る
+        return f"要約{index}"
+
+    summarizer = start_mock(responder=responder)
+    report_transport.configure_providers({"providers": {"local": {"base_url": summarizer.base_url, "models": ["vendor/*"]}}})
+    pages = [f"Page {number} " + "lorem ipsum " * 3 for number in range(1, 7)]
+    pdf_path = _write_pdf(tmp_path / "long.pdf", pages)
+    chunks = report_materials.chunk_pages(report_materials.extract_pdf_text(pdf_path), 60)
+
+    statuses = []
+    resolved = report_generation.resolve_local_pdf_text("test-key", _payload(pdf_path), on_status=statuses.append, use_cache=False)
+    material = resolved["messages"][0]["content"][-1]["text"]
+    total = len(chunks)
+    assert total > 1 and summarizer.stats["requests"] == total
+    assert material == f"{report_materials.MATERIAL_HEADING} (分割要約)\n" + "\n\n".join(
+        f"### 部分 {index}/{total}\n要約{index}" for index in range(1, total + 1))
+    assert statuses[-1] == f"資料を{total}個に分割して要約中 ({total}/{total})..."
+
+
+def test_pdf_without_text_is_rejected(pdf_settings, tmp_path):
+    pdf_path = _write_pdf(tmp_path / "scanned.pdf", ["", ""])
+    with pytest.raises(report_transport.APIRequestError, match="画像のみのPDF"):
+        report_generation.resolve_local_pdf_text("test-key", _payload(pdf_path))
+
+
+def test_request_to_a_provider_without_plugins_sends_the_extracted_text(server, start_mock, pdf_settings, tmp_path):
+    prompts = []
+    local = start_mock(responder=lambda prompt: prompts.append(prompt) or "レポート")
+    report_transport.configure_providers({"providers": {"local": {"base_url": local.base_url, "models": ["local/*"]}}})
+    pdf_path = _write_pdf(tmp_path / "plugin.pdf", ["Extracted on this machine"])
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="PDF", material_type="PDF", material_path=pdf_path,
+                    pdf_engine="pdf-text") # file-parser 用の設定のまま、plugins 非対応のプロバイダに送る
+    payload = dict(report_materials.build_api_payload(settings), model="local/model")
+    assert report_generation.request_completion("test-key", payload, use_cache=False)["content"] == "レポート"
+    assert "Extracted on this machine" in prompts[0]
+
+
+@pytest.mark.parametrize("pages, chunk_chars, expected", [
+    (["aaa", "bbb"], 100, ["[p.1]\naaa\n[p.2]\nbbb\n"]),
+    (["aaa", "", "bbb"], 12, ["[p.1]\naaa\n", "[p.3]\nbbb\n"]),     # 空のページは飛ばし、ページ番号は保つ
+    (["a" * 20], 10, ["[p.1]\naaaa", "aaaaaaaaaa", "aaaaaa\n"]),     # 大きすぎるページは文字数で分割
+    ([], 10, []),
+])
+def test_chunk_pages(pages, chunk_chars, expected):
+    assert report_materials.chunk_pages(pages, chunk_chars) == expected
@@ -0,0 +1,104 @@
+import pytest
+
+import report_generation
+import report_materials
+import report_transport
+
+PROVIDERS = {
+    "lan": {"base_url": "http://192.168.1.10:8000/v1/", "models": ["lan/*"], "strip_prefix": "lan/", "max_concurrency": 2},
+    "local": {"base_url": "http://127.0.0.1:11434/v1", "models": ["llama*", "qwen2.5-*"], "api_key_env": "LOCAL_LLM_KEY"},
+    "gateway": {"base_url": "https://gateway.example/v1", "models": ["gw/*"], "api_key": "gw-key", "supports_plugins": True},
+    "openrouter": {"headers": {"X-Title": "Test"}}
+}
+
+
+@pytest.fixture(autouse=True)
+def providers():
+    report_transport.configure_providers({"providers": PROVIDERS})
+    yield
+    report_transport.configure_providers({})
+
+
+@pytest.mark.parametrize("model, name", [
+    ("lan/qwen2.5-7b-instruct", "lan"),
+    ("llama3.1:8b", "local"),
+    ("qwen2.5-14b", "local"),
+    ("qwen/qwen3-235b-a22b:free", "openrouter"), # qwen2.5-* には一致しない
+    ("gw/claude", "gateway"),
+    ("LAN/qwen", "openrouter"),                  # パターンは大文字・小文字を区別する
+    ("openai/gpt-4o", "openrouter"),
+    ("", "openrouter"),
+    (None, "openrouter"),
+])
+def test_resolve_provider(model, name):
+    assert report_transport.resolve_provider(model)[0] == name
+
+
+@pytest.mark.parametrize("model, url, authorization, app_key_required", [
+    ("lan/qwen", "http://192.168.1.10:8000/v1/chat/completions", None, False),
+    ("llama3", "http://127.0.0.1:11434/v1/chat/completions", "Bearer env-key", False),
+    ("gw/claude", "https://gateway.example/v1/chat/completions", "Bearer gw-key", False),
+    ("openai/gpt-4o", "https://openrouter.test/api/v1/chat/completions", "Bearer app-key", True),
+])
+def test_provider_url_and_headers(monkeypatch, model, url, authorization, app_key_required):
+    monkeypatch.setattr(report_transport, "OPENROUTER_API_URL", "https://openrouter.test/api/v1/chat/completions")
+    monkeypatch.setenv("LOCAL_LLM_KEY", "env-key")
+    name, provider = report_transport.resolve_provider(model)
+    headers = report_transport.provider_headers(name, provider, "app-key")
+    assert report_transport.provider_chat_url(provider) == url
+    assert headers.get("Authorization") == authorization # アプリの OpenRouter のキーは他のプロバイダに送らない
+    assert report_transport.provider_requires_app_key(model) == app_key_required
+
+
+def test_openrouter_settings_override_the_defaults():
+    provider = report_transport.resolve_provider("openai/gpt-4o")[1]
+    assert provider["headers"] == {"X-Title": "Test"}
+    assert provider["supports_plugins"] and provider["usage"] == "openrouter"
+
+
+@pytest.fixture
+def attachments(tmp_path):
+    pdf = tmp_path / "slides.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n")
+    image = tmp_path / "chart.png"
+    image.write_bytes(b"\x89PNG\r\n\x1a\n")
+    note = tmp_path / "note.txt"
+    note.write_text("メモ", encoding="utf-8")
+    return {"pdf": report_transport.FileDataURL(pdf, "application/pdf"),
+            "image": report_transport.FileDataURL(image, "image/png"),
+            "text": report_transport.FileDataURL(note, "text/plain")}
+
+
+def _payload(attachments, kinds, plugins=True):
+    content = [{"type": "text", "text": "レポートを作成してください。"}]
+    for kind in kinds:
+        if kind == "image":
+            content.append({"type": "image_url", "image_url": {"url": attachments["image"]}})
+        else:
+            content.append({"type": "file", "file": {"filename": kind, "file_data": attachments[kind]}})
+    payload = {"model": "m", "messages": [{"role": "user", "content": content}]}
+    if plugins:
+        payload["plugins"] = [{"id": "file-parser", "pdf": {"engine": "pdf-text"}}]
+    return payload
+
+
+@pytest.mark.parametrize("provider, kinds, plugins, expected_types, keeps_plugins", [
+    ("openrouter", ["pdf", "image"], True, ["text", "file", "image_url"], True),  # plugins 対応: そのまま
+    ("gateway", ["pdf"], True, ["text", "file"], True),
+    ("lan", ["pdf", "image"], True, ["text", "text", "image_url"], False),     # PDF は手元で抽出したテキストに置き換える
+    ("lan", ["text"], True, ["text", "file"], False),                          # PDF 以外のファイルは残し、plugins だけ除く
+    ("lan", ["image"], False, ["text", "image_url"], False),                   # plugins が無ければ変更しない
+])
+def test_adapt_payload_for_provider(attachments, provider, kinds, plugins, expected_types, keeps_plugins):
+    payload = _payload(attachments, kinds, plugins)
+    adapted = report_generation.adapt_payload_for_provider(payload, report_transport.PROVIDERS[provider])
+    content = adapted["messages"][0]["content"]
+    assert [item["type"] for item in content] == expected_types
+    assert ("plugins" in adapted) == keeps_plugins
+    if provider == "openrouter" or not plugins:
+        assert adapted is payload
+    for item in content:
+        if isinstance(item.get("text"), report_materials.PDFTextReference):
+            assert item["text"].path == attachments["pdf"].path and "file" not in item
+    assert "plugins" in payload or not plugins # 元のペイロードは変更しない
+    assert [item["type"] for item in payload["messages"][0]["content"]] == ["text"] + ["image_url" if k == "image" else "file" for k in kinds]
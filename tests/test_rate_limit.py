@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+import report_transport
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def rate_limit_settings():
+    report_transport.configure_rate_limit({})
+    yield
+    report_transport.configure_rate_limit({})
+
+
+def test_concurrency_limit_grows_only_on_success_and_halves_on_429():
+    limiter = report_transport.ModelRateLimiter("m")
+    assert limiter.limit == 4.0
+    limiter.acquire()
+    limiter.release(succeeded=True)
+    assert limiter.limit == pytest.approx(4.25)
+    limiter.acquire()
+    limiter.release(succeeded=False) # 5xx・通信エラーでは変えない
+    assert limiter.limit == pytest.approx(4.25)
+    limiter.observe(FakeResponse(429, {"Retry-After": "0"}))
+    limiter.observe(FakeResponse(429, {"Retry-After": "0"})) # 同時に返った 429 では1回だけ減らす
+    assert limiter.limit == pytest.approx(2.125)
+    assert limiter.snapshot()["throttled"] == 2
+
+
+def test_concurrency_limit_is_clamped():
+    report_transport.configure_rate_limit({"rate_limit": {"initial_concurrency": 1, "max_concurrency": 2}})
+    limiter = report_transport.ModelRateLimiter("m")
+    limiter.observe(FakeResponse(429))
+    assert limiter.limit == 1.0
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(succeeded=True)
+    assert limiter.limit == 2.0
+
+
+def test_token_bucket_waits_for_refill():
+    limiter = report_transport.ModelRateLimiter("m", requests_per_minute=600, burst=2) # 0.1秒に1つ補充
+    assert limiter.take_token() == pytest.approx(0.0, abs=0.05)
+    assert limiter.take_token() == pytest.approx(0.0, abs=0.05)
+    assert limiter.take_token() >= 0.05
+    assert limiter.snapshot()["requests"] == 3
+
+
+def test_rate_is_learned_from_headers_unless_configured():
+    limiter = report_transport.ModelRateLimiter("m")
+    limiter.observe(FakeResponse(200, {"X-RateLimit-Limit": "120", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "30"}))
+    assert limiter.snapshot()["requests_per_minute"] == 120
+    assert limiter.paused_until - time.monotonic() == pytest.approx(30, abs=1)
+
+    configured = report_transport.ModelRateLimiter("m", requests_per_minute=20)
+    configured.observe(FakeResponse(200, {"X-RateLimit-Limit": "120"}))
+    assert configured.snapshot()["requests_per_minute"] == 20
+
+
+def test_acquire_waits_in_order_and_cancelled_waiter_leaves_queue():
+    report_transport.configure_rate_limit({"rate_limit": {"initial_concurrency": 1}})
+    limiter = report_transport.ModelRateLimiter("m")
+    limiter.acquire()
+    token = report_transport.CancelToken()
+    errors = []
+
+    def _waiter():
+        try:
+            limiter.acquire(cancel_token=token)
+        except report_transport.RequestCancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_waiter)
+    thread.start()
+    deadline = time.monotonic() + 2
+    while limiter.snapshot()["queued"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert limiter.snapshot()["queued"] == 1
+    token.cancel()
+    thread.join(2)
+    assert errors and limiter.snapshot()["queued"] == 0
+    limiter.release()
+    limiter.acquire() # 中断した待機者が枠を塞がない
+    assert limiter.snapshot()["in_flight"] == 1
+
+
+def test_get_rate_limiter_uses_model_patterns():
+    assert report_transport.get_rate_limiter("vendor/model:free").snapshot()["requests_per_minute"] == 20
+    assert report_transport.get_rate_limiter("vendor/model").snapshot()["requests_per_minute"] == 0
+    assert report_transport.get_rate_limiter("vendor/model") is report_transport.get_rate_limiter("vendor/model")
+    report_transport.configure_rate_limit({"rate_limit": {"enabled": False}})
+    assert report_transport.get_rate_limiter("vendor/model") is None
@@ -0,0 +1,78 @@
+import hashlib
+
+import pytest
+
+import llm_report_tool as tool
+import report_materials
+import report_stores
+
+
+def _settings(theme, **overrides):
+    return dict(report_materials.DEFAULT_REPORT_SETTINGS, theme=theme, material_type="テキスト資料", text_material="資料の本文です。",
+                model="vendor/model", **overrides)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = report_stores.ReportArchive(tmp_path / "archive.sqlite3")
+    archive.add("gui", _settings("地球温暖化の影響"), {"content": "海面の上昇と異常気象が増えている。"})
+    archive.add("gui", _settings("AIと教育"), {"content": "生成AIは授業の準備を変えつつある。"})
+    archive.add("batch", _settings("100%の再生可能エネルギー"), {"content": "電力の脱炭素化について。"})
+    return archive
+
+
+def _themes(results):
+    return sorted(result["theme"] for result in results)
+
+
+@pytest.mark.parametrize("query, themes", [
+    ("", ["100%の再生可能エネルギー", "AIと教育", "地球温暖化の影響"]),
+    ("温暖化", ["地球温暖化の影響"]),                   # trigram の索引 (3文字以上)
+    ("異常気象", ["地球温暖化の影響"]),                 # 本文も検索する
+    ("温暖", ["地球温暖化の影響"]),                     # 2文字以下は LIKE で探す
+    ("AI", ["AIと教育"]),
+    ("海", ["地球温暖化の影響"]),
+    ("温暖化 海面", ["地球温暖化の影響"]),              # 空白区切りは AND
+    ("温暖化 教育", []),
+    ("経済", []),
+    ("原子力発電", []),
+    ("%", ["100%の再生可能エネルギー"]),                # LIKE の特殊文字はそのまま探す
+])
+def test_search_hits_and_misses(archive, query, themes):
+    assert _themes(archive.search(query)) == themes
+
+
+def test_long_term_search_returns_a_highlighted_snippet(archive):
+    (result,) = archive.search("異常気象")
+    assert "【異常気象】" in result["snippet"]
+
+
+def test_add_stores_metadata_columns(archive):
+    result = {"content": "本文です。", "model": "other/model", "ttft": 0.5, "elapsed": 2.0,
+              "usage": {"prompt_tokens": 120, "completion_tokens": 30}}
+    report_id = archive.add("fanout", _settings("メタデータ", word_count="800", tone="である調"), result)
+    report = archive.get(report_id)
+    assert report["source"] == "fanout"
+    assert report["model"] == "other/model" # 採用されたモデル (フォールバック時は設定と異なる)
+    assert (report["theme"], report["word_count"], report["tone"], report["material_type"]) == ("メタデータ", "800", "である調", "テキスト資料")
+    assert report["material_hash"] == hashlib.sha256("資料の本文です。".encode("utf-8")).hexdigest()
+    assert report["settings"]["theme"] == "メタデータ"
+    assert "メタデータ" in report["prompt"]
+    assert (report["chars"], report["ttft"], report["elapsed"]) == (5, 0.5, 2.0)
+    assert (report["prompt_tokens"], report["completion_tokens"]) == (120, 30)
+    archive.delete(report_id)
+    assert archive.get(report_id) is None and archive.search("メタデータ") == []
+
+
+def test_batch_run_archives_generated_reports_but_not_cached_ones(server, tmp_path):
+    jobs = [dict(_settings("アーカイブ"), id="a")]
+    assert tool.run_batch(jobs, "test-key", tmp_path / "out", default_model="vendor/model") == 1
+    report_stores.configure_job_store({"job_store": {"enabled": False}}) # 応答キャッシュから返させる
+    assert tool.run_batch([dict(_settings("アーカイブ"), id="a")], "test-key", tmp_path / "out", default_model="vendor/model") == 1
+    assert server.stats["requests"] == 1
+
+    (summary,) = report_stores.get_report_archive().search("アーカイブ")
+    report = report_stores.get_report_archive().get(summary["id"])
+    assert report["source"] == "batch" and report["model"] == "vendor/model"
+    assert report["content"] == (tmp_path / "out" / "a.txt").read_text(encoding="utf-8")
+    assert report["prompt_tokens"] == 100
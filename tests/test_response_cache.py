@@ -0,0 +1,40 @@
+import itertools
+
+import pytest
+
+import report_stores
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 最終参照の順序が同じ時刻にならないよう、呼ばれるたびに1秒進む時計にする
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(report_stores.time, "time", lambda: float(next(ticks)))
+
+
+def test_put_evicts_least_recently_accessed_entries(tmp_path, clock):
+    cache = report_stores.ResponseCache(tmp_path / "cache.sqlite3", max_bytes=30)
+    cache.put("a", "m", "a" * 10)
+    cache.put("b", "m", "b" * 10)
+    cache.put("c", "m", "c" * 10)
+    assert cache.get("a") == "a" * 10 # a を参照したので b が最も古くなる
+    cache.put("d", "m", "d" * 10)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a" * 10, "c" * 10, "d" * 10]
+
+
+def test_size_is_counted_in_utf8_bytes(tmp_path, clock):
+    cache = report_stores.ResponseCache(tmp_path / "cache.sqlite3", max_bytes=12)
+    cache.put("a", "m", "あ" * 3) # 9バイト
+    cache.put("b", "m", "い" * 3)
+    assert cache.get("a") is None
+    assert cache.get("b") == "い" * 3
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = report_stores.ResponseCache(tmp_path / "cache.sqlite3", max_bytes=1024, ttl_seconds=5)
+    cache.put("a", "m", "content")
+    assert cache.get("a") == "content"
+    for _ in range(5):
+        report_stores.time.time()
+    assert cache.get("a") is None
@@ -0,0 +1,108 @@
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import report_generation
+import report_materials
+import report_transport
+
+OUTLINE = {"sections": [{"heading": "背景", "points": "現状", "chars": 1000},
+                        {"heading": "課題", "points": "問題点", "chars": 2000},
+                        {"heading": "提言", "points": "対策", "chars": 3000}]}
+
+
+@pytest.fixture
+def sectioned():
+    report_generation.configure_sectioned({"sectioned": {"min_sections": 3, "max_sections": 5}})
+    yield
+    report_generation.configure_sectioned({})
+
+
+@pytest.mark.parametrize("text", [
+    json.dumps(OUTLINE, ensure_ascii=False),
+    "構成案は次のとおりです。\n```json\n" + json.dumps(OUTLINE, ensure_ascii=False) + "\n```", # 前置き・コードブロック付き
+])
+def test_parse_outline_reads_sections_and_rescales_chars(sectioned, text):
+    sections = report_generation.parse_outline(text, 3000)
+    assert [section["heading"] for section in sections] == ["背景", "課題", "提言"]
+    assert [section["chars"] for section in sections] == [500, 1000, 1500]
+    assert sections[1]["points"] == "問題点"
+
+
+def test_parse_outline_normalizes_headings_and_missing_chars(sectioned):
+    outline = {"sections": [{"heading": "## 背景"}, {"heading": "  "}, {"heading": "課題", "chars": "不明"},
+                            {"heading": "提言", "chars": 500}, *[{"heading": f"補足{i}"} for i in range(5)]]}
+    sections = report_generation.parse_outline(json.dumps(outline, ensure_ascii=False), 5000)
+    assert [section["heading"] for section in sections] == ["背景", "課題", "提言", "補足0"] # 空の見出しは除き、max_sections で切る
+    assert [section["chars"] for section in sections] == [1250] * 4 # 文字数が無いものがあれば均等に割り振る
+
+
+@pytest.mark.parametrize("text, error", [
+    ("構成案を作成できませんでした。", ValueError),
+    ('{"sections": [{"heading": "背景"}, {"heading": "課題"}]}', ValueError), # min_sections 未満
+    ('{"sections": [{"heading": "背景",}]}', json.JSONDecodeError),
+    ("", ValueError),
+])
+def test_parse_outline_rejects_malformed_outlines(sectioned, text, error):
+    with pytest.raises(error):
+        report_generation.parse_outline(text, 3000)
+
+
+def _settings():
+    return dict(report_materials.DEFAULT_REPORT_SETTINGS, theme="エネルギー政策", word_count="6000", structure="セクション分け",
+                material_type="資料なし", model="sectioned/model")
+
+
+def _route(start_mock, responder):
+    mock = start_mock(responder=responder)
+    report_transport.configure_providers({"providers": {"sectioned": {"base_url": mock.base_url, "models": ["sectioned/*"]}}})
+    return mock
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_sections_are_assembled_in_outline_order_when_they_finish_out_of_order(server, start_mock, sectioned, stream):
+    finished = []
+    lock = threading.Lock()
+
+    def responder(prompt):
+        if "構成案を作成してください" in prompt:
+            return json.dumps(OUTLINE, ensure_ascii=False)
+        index, heading = re.search(r"(\d+)番目のセクション「(.+?)」", prompt).groups()
+        time.sleep(0.1 * (4 - int(index))) # 後ろのセクションほど先に完成する
+        with lock:
+            finished.append(heading)
+        return f"## {heading}\n{heading}の本文です。"
+
+    mock = _route(start_mock, responder)
+    settings = _settings()
+    assert report_generation.should_generate_sectioned(settings)
+    deltas = []
+    result = report_generation.generate_sectioned_report("test-key", report_materials.build_api_payload(settings), ["sectioned/model"],
+                                                         settings, stream=stream, on_delta=deltas.append, use_cache=False)
+    assert finished == ["提言", "課題", "背景"]
+    assert result["sections"] == ["背景", "課題", "提言"]
+    assert result["content"] == "## 背景\n背景の本文です。\n\n## 課題\n課題の本文です。\n\n## 提言\n提言の本文です。"
+    assert "".join(deltas) == result["content"] and deltas[0].startswith("## 背景")
+    assert result["model"] == "sectioned/model" and result["ttft"] is not None
+    assert result["usage"]["prompt_tokens"] == 400 # 構成案 + 3セクション
+    assert mock.stats["requests"] == 4 and server.stats["requests"] == 0
+
+
+def test_unreadable_outline_falls_back_to_a_single_request(server, start_mock, sectioned):
+    prompts = []
+
+    def responder(prompt):
+        prompts.append(prompt)
+        return "構成案を作れませんでした。" if len(prompts) == 1 else "一括で生成したレポートです。"
+
+    mock = _route(start_mock, responder)
+    settings = _settings()
+    result = report_generation.generate_sectioned_report("test-key", report_materials.build_api_payload(settings), ["sectioned/model"],
+                                                         settings, use_cache=False)
+    assert result["content"] == "一括で生成したレポートです。"
+    assert "sections" not in result
+    assert mock.stats["requests"] == 2
+    assert "エネルギー政策" in prompts[1] and "構成案を作成してください" not in prompts[1]
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import llm_report_tool as tool
+import report_generation
+import report_materials
+import report_transport
+
+
+def _settings(theme="気候変動", **overrides):
+    settings = dict(report_materials.DEFAULT_REPORT_SETTINGS, theme=theme, material_type="テキスト資料", text_material="資料の本文です。",
+                    model="vendor/model")
+    settings.update(overrides)
+    return settings
+
+
+def _texts(payload):
+    return [item.get("text") for item in payload["messages"][0]["content"]]
+
+
+def test_session_mode_puts_the_material_first_and_the_instruction_last():
+    content = report_materials.build_api_payload(_settings(session_mode=True))["messages"][0]["content"]
+    intro, material, separator, instruction = content
+    assert intro["text"] == "以下のテキスト資料の内容を考慮してレポートを作成してください。"
+    assert material["text"] == f"{report_materials.MATERIAL_HEADING}\n資料の本文です。"
+    assert separator == {"type": "text", "text": report_materials.SESSION_MATERIAL_END_TEXT, "cache_control": {"type": "ephemeral"}}
+    assert instruction["text"] == report_materials.build_instruction_text(_settings(session_mode=True))
+
+
+def test_session_mode_keeps_the_prefix_identical_across_reports():
+    first = report_materials.build_api_payload(_settings("気候変動", session_mode=True, tone="である調"))
+    second = report_materials.build_api_payload(_settings("再生可能エネルギー", session_mode=True, word_count="400"))
+    assert _texts(first)[:-1] == _texts(second)[:-1] # 変わるのは末尾の指示文だけ
+    assert _texts(first)[-1] != _texts(second)[-1]
+
+
+def test_session_mode_with_attachments_moves_every_file_before_the_instruction(tmp_path):
+    paths = [tmp_path / "a.pdf", tmp_path / "b.png"]
+    for path in paths:
+        path.write_bytes(b"\0")
+    settings = _settings(material_type=report_materials.MULTI_MATERIAL_TYPE, attachments=[str(path) for path in paths], session_mode=True)
+    content = report_materials.build_api_payload(settings)["messages"][0]["content"]
+    assert [item["type"] for item in content] == ["text", "file", "image_url", "text", "text"]
+    assert "cache_control" in content[3] and content[4]["text"].startswith("以下の条件に従い")
+
+
+@pytest.mark.parametrize("settings", [
+    _settings(),                                                  # session_mode でなければ従来どおり指示文が先頭
+    _settings(material_type="資料なし", session_mode=True),       # 資料が無ければ並べ替えない
+])
+def test_order_is_unchanged_without_a_material_to_cache(settings):
+    content = report_materials.build_api_payload(settings)["messages"][0]["content"]
+    assert not any("cache_control" in item for item in content)
+    assert content[1]["text"].startswith("以下の条件に従い")
+
+
+def test_strip_cache_control_copies_only_what_it_changes(tmp_path):
+    path = tmp_path / "photo.png"
+    path.write_bytes(b"\0")
+    payload = report_materials.build_api_payload(_settings(material_type="画像", material_path=str(path), session_mode=True))
+    stripped = report_generation.strip_cache_control(payload)
+    assert not any("cache_control" in item for item in stripped["messages"][0]["content"])
+    assert any("cache_control" in item for item in payload["messages"][0]["content"]) # 元のペイロードはそのまま
+    original_url = payload["messages"][0]["content"][1]["image_url"]["url"]
+    assert stripped["messages"][0]["content"][1]["image_url"]["url"] is original_url # 添付ファイルは複製しない
+    assert report_generation.strip_cache_control(stripped) is stripped
+
+
+@pytest.mark.parametrize("model, expected", [
+    ("anthropic/claude-sonnet-4", True),
+    ("google/gemini-2.5-pro", True),
+    ("openai/gpt-4o", False),
+    (None, False),
+])
+def test_supports_cache_control(model, expected):
+    assert report_generation.supports_cache_control(model) is expected
+
+
+def test_batch_sends_followers_after_the_first_job_of_each_material(server, start_mock, tmp_path):
+    sent = []
+    lock = threading.Lock()
+
+    def responder(prompt):
+        with lock:
+            sent.append((next(theme for theme in themes if f"「{theme}」" in prompt), time.perf_counter()))
+        time.sleep(0.3)
+        return "レポート"
+
+    themes = ["先頭", "後続1", "後続2", "別資料"]
+    mock = start_mock(responder=responder)
+    report_transport.configure_providers({"providers": {"session": {"base_url": mock.base_url, "models": ["session/*"]}}})
+    jobs = [_settings(theme, model="session/model", id=theme) for theme in themes]
+    jobs[-1]["text_material"] = "別の資料です。"
+    assert tool.run_batch(jobs, "test-key", tmp_path / "out", workers=4, use_cache=False, session_mode=True) == 4
+    times = dict(sent)
+    assert abs(times["別資料"] - times["先頭"]) < 0.2 # 資料の異なるジョブは待たずに並列で送る
+    for follower in ("後続1", "後続2"):
+        assert times[follower] - times["先頭"] >= 0.3 # 同じ資料の残りは最初の1件の完了後に送る
+    assert abs(times["後続1"] - times["後続2"]) < 0.2
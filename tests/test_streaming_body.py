@@ -0,0 +1,62 @@
+import base64
+import json
+
+import pytest
+
+import report_transport
+
+
+def _payload(data_urls):
+    return {
+        "model": "vendor/model",
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "資料を要約してください。\n\"引用符\" も含む"},
+            *[{"type": "file", "file": {"filename": f"file{i}", "file_data": url}} for i, url in enumerate(data_urls)]
+        ]}],
+        "plugins": [{"id": "file-parser"}]
+    }
+
+
+def _data_url(path, mime_type):
+    return f"data:{mime_type};base64," + base64.b64encode(path.read_bytes()).decode("ascii")
+
+
+@pytest.mark.parametrize("sizes", [[0], [1], [2], [3], [1000, 5], [report_transport.BASE64_READ_CHUNK + 1]])
+def test_streamed_body_matches_plain_json_dumps(tmp_path, sizes):
+    paths = []
+    for index, size in enumerate(sizes):
+        path = tmp_path / f"file{index}.bin"
+        path.write_bytes(bytes(range(256)) * (size // 256) + bytes(range(size % 256)))
+        paths.append(path)
+    body = report_transport.StreamingJSONBody(_payload([report_transport.FileDataURL(path, "application/pdf") for path in paths]))
+
+    data = b"".join(body)
+    assert len(body) == len(data)
+    expected = json.dumps(_payload([_data_url(path, "application/pdf") for path in paths]), ensure_ascii=False)
+    assert json.loads(data.decode("utf-8")) == json.loads(expected)
+
+
+def test_read_returns_the_same_bytes_in_blocks(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"\x89PNG" * 1000)
+    body = report_transport.StreamingJSONBody(_payload([report_transport.FileDataURL(path, "image/png")]))
+    blocks = []
+    while True:
+        block = body.read(1000)
+        if not block:
+            break
+        assert len(block) <= 1000
+        blocks.append(block)
+    assert len(body) == sum(len(block) for block in blocks)
+    assert json.loads(b"".join(blocks))["messages"][0]["content"][1]["file"]["file_data"] == _data_url(path, "image/png")
+
+
+def test_read_raises_after_cancel(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"x" * 10)
+    token = report_transport.CancelToken()
+    body = report_transport.StreamingJSONBody(_payload([report_transport.FileDataURL(path, "application/pdf")]), cancel_token=token)
+    assert body.read(10)
+    token.cancel()
+    with pytest.raises(report_transport.RequestCancelled):
+        body.read(10)
@@ -0,0 +1,48 @@
+import report_generation
+import report_materials
+
+
+def _material_payload(body):
+    return {"messages": [{"role": "user", "content": [
+        {"type": "text", "text": "以下の条件に従いレポートを作成してください。"},
+        {"type": "text", "text": f"{report_materials.MATERIAL_HEADING}\n{body}"},
+    ]}]}
+
+
+def _material_text(payload):
+    return payload["messages"][0]["content"][1]["text"]
+
+
+def test_heading_first_material_keeps_first_section_when_truncating():
+    # 見出しで始まる資料では _split_sections の先頭が空の断片になる
+    body = "".join(f"# 見出し{i}\n" + "あ" * 5000 + "\n" for i in range(10))
+    fitted, info = report_generation.fit_payload_to_budget(_material_payload(body), 2000, "truncate")
+    text = _material_text(fitted)
+    assert info["applied"] == ["compress", "drop", "truncate"]
+    assert 1500 < info["after"] <= 2000
+    assert "# 見出し0\n" in text
+    assert text.endswith(report_generation.TRUNCATION_NOTE)
+    assert "# 見出し1\n" not in text
+
+
+def test_drop_policy_never_removes_the_only_remaining_section():
+    body = "".join(f"# 見出し{i}\n" + "あ" * 5000 + "\n" for i in range(10))
+    fitted, info = report_generation.fit_payload_to_budget(_material_payload(body), 2000, "drop")
+    assert info["applied"] == ["compress", "drop"]
+    assert "# 見出し0\n" + "あ" * 5000 in _material_text(fitted)
+
+
+def test_estimate_tokens_counts_non_ascii_per_char_and_ascii_per_four_chars():
+    assert report_generation.estimate_tokens("") == 0
+    assert report_generation.estimate_tokens("あいう") == 3
+    assert report_generation.estimate_tokens("abcd") == 1
+    assert report_generation.estimate_tokens("abcde") == 2
+    assert report_generation.estimate_tokens("ab日本") == 3
+    assert report_generation.estimate_tokens("😀") == 1 # 4バイト文字も1文字として数える
+
+
+def test_split_sections_splits_at_headings_and_page_markers():
+    assert report_generation._split_sections("前文\n# A\nx\n[p.2]\ny\n#タグ") == ["前文\n", "# A\nx\n", "[p.2]\ny\n#タグ"]
+    # 見出しで始まる場合は先頭に空の断片が入る (fit_payload_to_budget はこれを節として扱わない)
+    assert report_generation._split_sections("# A\nx\n## B\ny") == ["", "# A\nx\n", "## B\ny"]
+    assert "".join(report_generation._split_sections("# A\nx\n## B\ny")) == "# A\nx\n## B\ny"